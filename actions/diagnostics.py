@@ -16,6 +16,7 @@ import sys
 
 import charmhelpers.core.hookenv as hookenv
 
+import ntp_host_facts
 import ntp_implementation
 
 
@@ -70,6 +71,12 @@ def kernel_actions():
     )
 
 
+def host_facts_actions():
+    """Gather the saved facts about the host, with their ages and the time taken to collect them"""
+    facts = ntp_host_facts.describe_facts()
+    return [('host-facts.' + name, facts[name]) for name in sorted(facts)]
+
+
 def chronyd_actions():
     """Gather chronyd sources, tracking, and log files."""
     return itertools.chain(
@@ -102,6 +109,7 @@ def collect_actions():
     return itertools.chain(
         [('ntp.implementation', implementation)],
         kernel_actions(),
+        host_facts_actions(),
         implementation_actions(),
     )
 
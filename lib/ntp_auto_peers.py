@@ -0,0 +1,53 @@
+# Copyright (c) 2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+# This module calculates the auto_peers topology.  Each unit publishes its
+# suitability score on the peer relation; the leader reads all of the scores,
+# chooses the upstream units, and publishes them as a single leader setting.
+# The other units only read that setting: upstream units use the configured
+# sources, and the remaining units use the upstream units as their sources.
+# This means that a change in the peer relation costs the leader one read of
+# each peer's score, and every other unit a single leader-get, rather than
+# every unit reading every peer's score.
+
+import json
+
+# the leader setting containing the topology
+LEADER_KEY = 'auto-peers'
+
+
+def choose_upstream(scores, topN):
+    """Return a dict of the unit names and addresses of the topN units with the best scores.
+    scores is a dict of each unit name and its (address, score); units with no score are never
+    chosen.  If there are not more than topN units with scores, they are all upstream."""
+    scored = [(unit, scores[unit]) for unit in scores if scores[unit][1] is not None]
+    # ties are broken by unit name, so that the same scores always give the same units
+    best = sorted(scored, key=lambda x: (-x[1][1], x[0]))[0:topN]
+    return dict((unit, address) for (unit, (address, score)) in best)
+
+
+def encode(upstream):
+    """Return the leader setting for the given upstream units.  The keys are sorted, so that
+    the setting (and the configuration of the other units) only changes when they do."""
+    return json.dumps({'upstream': upstream}, separators=(',', ':'), sort_keys=True)
+
+
+def decode(setting):
+    """Return the upstream units in the leader setting, or None if it is missing or invalid"""
+    if not setting:
+        return None
+    try:
+        upstream = json.loads(setting)['upstream']
+    except (KeyError, TypeError, ValueError):
+        return None
+    return upstream if isinstance(upstream, dict) else None
+
+
+def get_sources(setting, unit):
+    """Return the sorted list of sources for the given unit from the leader setting, or None if
+    the unit is upstream (or no units are upstream), in which case it uses the configured sources."""
+    upstream = decode(setting)
+    if not upstream or unit in upstream:
+        return None
+    return sorted(upstream.values())
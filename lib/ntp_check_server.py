@@ -0,0 +1,25 @@
+# Copyright (c) 2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+# This module describes the systemd service which runs check_ntpmon.py as a
+# server answering the NRPE check (see src/checkserver.py).  The unit file is
+# rendered from ntpmon's source directory in the charm, using the options of
+# the ntpmon layer.
+
+SERVICE_NAME = 'ntpmon-check'
+TEMPLATE = 'src/' + SERVICE_NAME + '.systemd'     # relative to the charm directory
+UNIT_FILE = '/etc/systemd/system/' + SERVICE_NAME + '.service'
+SOCKET_GROUP = 'nagios'     # the group as which NRPE runs the check
+
+
+def get_context(options):
+    """Return the template context for the unit file from the ntpmon layer options,
+    whose names are hyphenated and so cannot be used directly in the template.
+    The server runs as the ntpmon user, but only NRPE may connect to it."""
+    return {
+        'group': options['group'],
+        'install_dir': options['install-dir'],
+        'socket_group': SOCKET_GROUP,
+        'user': options['user'],
+    }
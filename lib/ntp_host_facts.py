@@ -0,0 +1,115 @@
+# Copyright (c) 2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+# This module gathers facts about the host which only change when it reboots,
+# such as its virtualisation type and release, and saves them in unitdata with
+# the kernel's boot ID, so that they are gathered at most once per boot and
+# shared by every hook and action.  Each fact is gathered when it is first
+# needed; the time it was gathered and how long that took are saved with it,
+# and reported by the diagnostics action.  Facts which can change at runtime,
+# such as the current clocksource, must not be added here.  The exception is
+# the release, which do-release-upgrade changes before the host reboots; it is
+# gathered again whenever the file it is read from changes.
+
+import time
+
+from charmhelpers.core import unitdata
+
+import ntp_status
+
+
+def get_virtual():
+    import ntp_virt
+    return ntp_virt.detect_virtual()
+
+
+def get_lsb_release():
+    from charmhelpers.core import host
+    return host.lsb_release()
+
+
+def get_hyperv_sync_device():
+    import ntp_hyperv
+    return ntp_hyperv.find_host_sync_device()
+
+
+# the functions which gather each fact
+_facts = {
+    'hyperv-sync-device': get_hyperv_sync_device,
+    'lsb-release': get_lsb_release,
+    'virtual': get_virtual,
+}
+
+# the files from which facts are read, if they can change without a reboot
+_sources = {
+    'lsb-release': '/etc/lsb-release',
+}
+
+
+def load(kv):
+    """Return the facts saved during this boot, or a new set of facts"""
+    boot_id = ntp_status.get_boot_id()
+    saved = kv.get('host_facts')
+    if boot_id is None or not isinstance(saved, dict) or saved.get('boot-id') != boot_id:
+        saved = {'boot-id': boot_id, 'facts': {}}
+    return saved
+
+
+def save(kv, saved):
+    """Save the facts, unless the boot ID is unknown, in which case they are never reused"""
+    if saved['boot-id'] is not None:
+        kv.set('host_facts', saved)
+
+
+def gather(saved, name):
+    """Gather the named fact into the saved facts, unless it is already there and its source
+    file (if any) has not changed since; return its value"""
+    fact = saved['facts'].get(name)
+    mtime = ntp_status.get_mtime(_sources[name]) if name in _sources else None
+    if fact is None or fact.get('mtime') != mtime:
+        start = time.time()
+        value = _facts[name]()
+        fact = {'elapsed': time.time() - start, 'mtime': mtime, 'time': start, 'value': value}
+        saved['facts'][name] = fact
+    return fact['value']
+
+
+def get_fact(name, kv=None):
+    """Return the named fact, gathering it if it has not been gathered since the host booted"""
+    if kv is None:
+        kv = unitdata.kv()
+    saved = load(kv)
+    value = gather(saved, name)
+    save(kv, saved)
+    return value
+
+
+def get_facts(kv=None):
+    """Return all of the facts, gathering any which are missing, with the times they were
+    gathered and the time taken to gather each"""
+    if kv is None:
+        kv = unitdata.kv()
+    saved = load(kv)
+    for name in sorted(_facts):
+        gather(saved, name)
+    # facts saved by older versions of this module are forgotten
+    saved['facts'] = dict((name, saved['facts'][name]) for name in _facts)
+    save(kv, saved)
+    return saved['facts']
+
+
+def format_value(value):
+    """Return the fact's value as text; dicts (such as the lsb-release) are shown as they appear in their files"""
+    if isinstance(value, dict):
+        return ' '.join('%s=%s' % (k, value[k]) for k in sorted(value))
+    return str(value)
+
+
+def describe_facts(kv=None, now=None):
+    """Return a hash of each fact's name and a description of its value, age, and collection time"""
+    if now is None:
+        now = time.time()
+    facts = get_facts(kv)
+    return dict((name, '%s (%ds old, collected in %.3fs)' % (
+        format_value(facts[name]['value']), now - facts[name]['time'], facts[name]['elapsed'])) for name in facts)
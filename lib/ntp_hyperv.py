@@ -6,6 +6,8 @@
 import os
 import sys
 
+import ntp_host_facts
+
 """Hyper-V host clock sync handling for NTP charm
 
 References:
@@ -22,7 +24,7 @@ def log(msg):
     print(msg, file=sys.stderr)
 
 
-def _find_host_sync_device():
+def find_host_sync_device():
     """Search for a vmbus device directory whose class matches _device_class"""
     try:
         for d in os.listdir(os.path.join(_vmbus_dir, 'devices')):
@@ -75,7 +77,7 @@ def sync_status():
     """Check Hyper-V host clock sync status; disable if detected.
 
     Return a sensible status message if we attempted changes."""
-    device_id = _find_host_sync_device()
+    device_id = ntp_host_facts.get_fact('hyperv-sync-device')
     if device_id and _check_host_sync(device_id):
         if _disable_host_sync(device_id):
             return 'Hyper-V host sync disabled'
@@ -6,12 +6,13 @@
 """NTP implementation details"""
 
 import charmhelpers.contrib.templating.jinja as templating
-import charmhelpers.core.host
 import charmhelpers.core.hookenv
 import charmhelpers.osplatform
 import os.path
 import shutil
 
+import ntp_host_facts
+
 
 class NTPImplementation:
     """Base class for NTP implementations."""
@@ -138,7 +139,7 @@ def get_implementation(implementation_name=None):
 
     # anything else: auto mode
     platform = charmhelpers.osplatform.get_platform()
-    version = float(charmhelpers.core.host.lsb_release()['DISTRIB_RELEASE'])
+    version = float(ntp_host_facts.get_fact('lsb-release')['DISTRIB_RELEASE'])
 
     ntp_package = charmhelpers.core.hookenv.config('ntp_package')
     if ntp_package == "ntp":
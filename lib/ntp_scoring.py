@@ -8,40 +8,79 @@
 # container, or VM) and software running locally.  It reduces the score
 # for nodes with OpenStack ceph, nova, or swift services running, in order
 # to decrease the likelihood that they will be selected as upstreams.
+# A history of the delays to each source address is kept, so that only
+# sources which are new or have not been probed recently need to be probed
+# when the score is recalculated.
 
 import atexit
+import hashlib
 import json
 import sys
 import time
 
 from charmhelpers.core import hookenv, unitdata
 
+import ntp_host_facts
+import ntp_scoring_service
 import ntp_source_score
 
+# Process name matchers and score divisors for services which should not be upstreams;
+# the process table is rescanned at most every PROCESS_INDEX_MAX_AGE seconds while
+# previously-found processes are still running.
+_package_matchers = {
+    'ceph': lambda name: name.startswith('ceph-') and not name.startswith('ceph-osd'),
+    'ceph-osd': lambda name: name.startswith('ceph-osd'),
+    'nova-compute': lambda name: name.startswith('nova-compute'),
+    'swift': lambda name: name.startswith('swift-'),
+}
+_package_weights = {
+    'ceph': 1.1,
+    'ceph-osd': 1.25,
+    'nova-compute': 1.25,
+    'swift': 1.1,
+}
+PROCESS_INDEX_MAX_AGE = 3600
+
+# Re-probe each source once its delay history is older than SOURCE_MAX_AGE seconds.
+SOURCE_MAX_AGE = 7 * 86400
+
+# Bound the time spent verifying the configured sources during update-status to
+# VERIFY_BUDGET seconds.  Sources are re-verified once their result is older than
+# VERIFY_OK_MAX_AGE seconds if they answered, or VERIFY_FAILED_MAX_AGE if they did not.
+VERIFY_BUDGET = 10
+VERIFY_OK_MAX_AGE = 3600
+VERIFY_FAILED_MAX_AGE = 600
+
+# the scoring storage, shared by everything run during a hook
+_kv = None
+
 
 def log(msg):
     print(msg, file=sys.stderr)
 
 
 def packages_to_install():
-    return ["facter", "ntpdate", "python3-psutil", "virt-what"]
+    return ["python3-psutil", "virt-what"]
 
 
-def get_virt_type():
-    """Work out what type of environment we're running in"""
-    for line in ntp_source_score.run_cmd('facter virtual'):
-        fields = str(line).split()
-        if len(fields) > 0:
-            if fields[0] in ['physical', 'xen0']:
-                return 'physical'
-            if fields[0] in ['docker', 'lxc', 'openvz']:
-                return 'container'
+def classify_virtual(virtual):
+    """Return the environment type for the virtualisation type reported by ntp_virt"""
+    if virtual in ['physical', 'xen0']:
+        return 'physical'
+    if virtual in ['docker', 'lxc', 'openvz', 'systemd_nspawn']:
+        return 'container'
     # Anything not one of the above-mentioned types is assumed to be a VM
     return 'vm'
 
 
-def get_virt_multiplier():
-    virt_type = get_virt_type()
+def get_virt_type():
+    """Work out what type of environment we're running in"""
+    return classify_virtual(ntp_host_facts.get_fact('virtual'))
+
+
+def get_virt_multiplier(virt_type=None):
+    if virt_type is None:
+        virt_type = get_virt_type()
     if virt_type == 'container':
         # containers should be synchronized from their host
         return -1
@@ -53,41 +92,84 @@ def get_virt_multiplier():
         return 1
 
 
-def get_package_divisor():
+def get_package_divisor(state=None):
     """Check for running ceph, swift, & nova-compute services,
-    and increase divisor for each."""
+    and increase divisor for each.  If state is provided, it is used
+    to cache the process lookups, and may be persisted between hooks."""
     try:
-        import psutil
-    except Exception:
+        # procindex requires psutil, which may not be installed
+        import procindex
+    except ImportError:
         # If we can't read the process table, assume a worst-case.
         # (Normally, if every process is running, this will return
         # 1.1 * 1.1 * 1.25 * 1.25 = 1.890625.)
         return 2
 
     # set the weight for each process (regardless of how many there are running)
-    running = {}
-    for p in psutil.process_iter():
-        name = p.name() if psutil.version_info >= (2, 0) else p.name
-        if name.startswith('nova-compute'):
-            running['nova-compute'] = 1.25
-        if name.startswith('ceph-osd'):
-            running['ceph-osd'] = 1.25
-        elif name.startswith('ceph-'):
-            running['ceph'] = 1.1
-        elif name.startswith('swift-'):
-            running['swift'] = 1.1
+    index = procindex.ProcessIndex(_package_matchers, max_age=PROCESS_INDEX_MAX_AGE, state=state)
+    running = index.getpids()
 
     # increase the divisor for each discovered process type
     divisor = 1
-    for r in running:
-        log('[SCORE] %s running - score divisor %.3f' % (r, running[r]))
-        divisor *= running[r]
+    for r in sorted(running):
+        log('[SCORE] %s running - score divisor %.3f' % (r, _package_weights[r]))
+        divisor *= _package_weights[r]
     return divisor
 
 
-def check_score(seconds=None):
+def get_host_list():
+    """Return the list of configured sources, peers, and pools"""
+    sources = hookenv.config('source').split()
+    peers = hookenv.config('peers').split()
+    pools = hookenv.config('pools').split()
+    return sources + peers + pools
+
+
+def get_fingerprint(host_list, virt_type, divisor):
+    """Return a hash of the inputs to the score: the configured hosts (regardless
+    of order), the virtualisation type, and the package divisor"""
+    inputs = json.dumps([sorted(set(host_list)), virt_type, round(divisor, 6)])
+    return hashlib.sha256(inputs.encode()).hexdigest()
+
+
+def use_service():
+    """Return True if source scoring is delegated to the background scoring service,
+    which is only supported under systemd"""
+    if not hookenv.config('scoring_service'):
+        return False
+    from charmhelpers.core import host
+    return host.init_is_systemd()
+
+
+def get_service_score(score, host_list):
+    """Copy the raw score published by the scoring service into score, if it was
+    calculated for the same hosts.  Return False if no such score is available yet."""
+    published = ntp_scoring_service.read_score()
+    if published is None or set(published.get('host-list', [])) != set(host_list):
+        return False
+    for key in ['cutoff', 'probed', 'raw', 'time']:
+        score[key] = published[key]
+    return True
+
+
+def get_raw_score(score, history, host_list, seconds):
+    """Probe the sources without recent history, merge the results into the
+    history, and return the raw score for all of the sources"""
+    score['probed'] = ntp_source_score.stale_sources(history, host_list, seconds, SOURCE_MAX_AGE)
+    (probes, score['cutoff']) = ntp_source_score.get_source_delays(
+        score['probed'], budget=ntp_scoring_service.HOOK_SCORE_BUDGET,
+        good_enough=ntp_scoring_service.HOOK_SCORE_GOOD_ENOUGH)
+    if len(score['cutoff']):
+        log('[SCORE] %d hosts cut off before probing completed' % (len(score['cutoff']),))
+    ntp_source_score.update_history(history, score['probed'], probes, score['cutoff'], seconds)
+    return ntp_source_score.history_score(history, host_list, verbose=True)
+
+
+def check_score(seconds=None, history=None, virt_type=None, divisor=None):
     if seconds is None:
         seconds = time.time()
+    if history is None:
+        history = ntp_source_score.new_history()
     score = {
         'divisor': 1,
         'multiplier': 0,
@@ -110,60 +192,101 @@ def check_score(seconds=None):
         return score
 
     # skip scoring if we have no sources
-    sources = hookenv.config('source').split()
-    peers = hookenv.config('peers').split()
-    pools = hookenv.config('pools').split()
-    host_list = sources + peers + pools
+    host_list = get_host_list()
     if len(host_list) == 0:
         log('[SCORE] No sources configured')
         return score
 
     # skip scoring if we're in a container
-    multiplier = get_virt_multiplier()
+    multiplier = get_virt_multiplier(virt_type)
     score['multiplier'] = multiplier
     if multiplier <= 0:
         log('[SCORE] running in a container - skipped scoring')
         return score
 
     # Now that we've passed all those checks, check upstreams, calculate a score, and return the result
-    divisor = get_package_divisor()
+    if divisor is None:
+        divisor = get_package_divisor()
     score['divisor'] = divisor
     score['host-list'] = host_list
-    score['raw'] = ntp_source_score.get_source_score(host_list, verbose=True)
+    if use_service():
+        # never wait for the network; use the latest score from the service
+        if not get_service_score(score, host_list):
+            log('[SCORE] waiting for scoring service to score current sources')
+            return score
+    else:
+        score['raw'] = get_raw_score(score, history, host_list, seconds)
     score['score'] = score['raw'] * multiplier / divisor
     log('[SCORE] Suitability score: %.3f' % (score['score'],))
     return score
 
 
+def get_kv():
+    """Return the dedicated unitdata storage db used for scoring.  It is opened once per
+    process, so that every caller in a hook shares its connection (a second connection
+    would wait on the first's uncommitted writes), and flushed once when the hook exits."""
+    global _kv
+    if _kv is None:
+        # use a dedicated unitdata storage db to ensure the score is always saved regardless of hook completion
+        path = unitdata.kv().db_path.replace('.db', '') + '.ntp_scoring.db'
+        _kv = unitdata.Storage(path=path)
+        atexit.register(_kv.flush)
+    return _kv
+
+
 def get_score(max_seconds=86400):
     # if auto_peers is disabled, don't display saved score from unitdata
     if not hookenv.config('auto_peers'):
         return {}
 
     # get any score saved from an older charm version
-    default_kv = unitdata.kv()
-    default_score = default_kv.get('ntp_score')
-
-    # use a dedicated unitdata storage db to ensure the score is always saved regardless of hook completion
-    path = default_kv.db_path.replace('.db', '') + '.ntp_scoring.db'
-    kv = unitdata.Storage(path=path)
-    atexit.register(kv.flush)
+    default_score = unitdata.kv().get('ntp_score')
 
+    kv = get_kv()
     score = kv.get('ntp_score', default=default_score)
     if score is not None:
         saved_time = score.get('time', 0)
     else:
         saved_time = 0
 
+    # only use the saved score if it was calculated from the same inputs
+    virt_type = get_virt_type()
+    process_index = kv.get('process_index') or {}
+    divisor = get_package_divisor(process_index)
+    kv.set('process_index', process_index)
+    fingerprint = get_fingerprint(get_host_list(), virt_type, divisor)
+    changed = score is not None and score.get('fingerprint') != fingerprint
+    if changed:
+        log('[SCORE] score inputs changed - recalculating')
+
     now = time.time()
-    if score is None or now - saved_time > max_seconds:
-        score = check_score(now)
+    if use_service():
+        # the scoring service's latest result is always used if it is enabled,
+        # but only saved when the service has published a new one
+        latest = check_score(now, None, virt_type, divisor)
+        latest['fingerprint'] = fingerprint
+        if score is None or changed or get_published_time(latest) != get_published_time(score):
+            score = latest
+            kv.set('ntp_score', score)
+            log('[SCORE] saved %s' % (json.dumps(score),))
+    elif score is None or changed or now - saved_time > max_seconds:
+        # sources with recent history are not probed again
+        history = kv.get('ntp_history') or ntp_source_score.new_history()
+        score = check_score(now, history, virt_type, divisor)
+        score['fingerprint'] = fingerprint
+        kv.set('ntp_history', history)
         kv.set('ntp_score', score)
         log('[SCORE] saved %s' % (json.dumps(score),))
 
     return score
 
 
+def get_published_time(score):
+    """Return the time at which the score's raw score was published by the scoring service,
+    or None if it has no raw score (e.g. because the service has not scored its sources yet)"""
+    return score.get('time') if 'raw' in score else None
+
+
 def get_score_string(score=None, max_seconds=86400):
     if score is None:
         score = get_score(max_seconds)
@@ -174,3 +297,35 @@ def get_score_string(score=None, max_seconds=86400):
         score['multiplier'] / score['divisor'],
         time.ctime(score['time'])
     )
+
+
+def verify_expired(result, now):
+    """Return True if the saved verification result is missing or has expired"""
+    if result is None:
+        return True
+    max_age = VERIFY_OK_MAX_AGE if result['ok'] else VERIFY_FAILED_MAX_AGE
+    return not 0 <= now - result['time'] <= max_age
+
+
+def get_unverified_servers(servers, now=None):
+    """Return the list of servers which could not be verified as reachable.  Only the
+    servers whose saved result has expired are probed, all at once; servers which could
+    not be resolved within the budget are not saved, so that they are probed next time."""
+    if now is None:
+        now = time.time()
+    kv = get_kv()
+    saved = kv.get('ntp_verified') or {}
+    expired = [s for s in servers if verify_expired(saved.get(s), now)]
+    if len(expired):
+        expired = sorted(set(expired))
+        (verified, cutoff) = ntp_source_score.verify_sources(expired, budget=VERIFY_BUDGET)
+        for server in expired:
+            if server in cutoff:
+                saved.pop(server, None)
+            else:
+                saved[server] = {'ok': server in verified, 'time': now}
+        log('[VERIFY] verified %d of %d servers' % (len(verified), len(expired)))
+    # forget servers which are no longer configured
+    saved = dict((s, saved[s]) for s in servers if s in saved)
+    kv.set('ntp_verified', saved)
+    return [s for s in servers if not saved.get(s, {}).get('ok')]
@@ -0,0 +1,126 @@
+#!/usr/bin/python3
+
+# Copyright (c) 2017-2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+# This module implements a small service which calculates the raw source score
+# in the background, so that juju hooks never have to wait for the network.
+# The hooks write the list of hosts to score to CONFIG_FILE; the service
+# re-probes them whenever that list changes, and otherwise every interval
+# seconds, and atomically publishes the result to SCORE_FILE, which the hooks
+# read.  Like ntp_source_score, it has no dependencies on juju, charmhelpers,
+# or the other modules in this charm, so that it can be run by the system
+# python interpreter.
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+import ntp_source_score
+
+SERVICE_NAME = 'ntp-scoring'
+STATE_DIR = '/var/lib/ntp-scoring'
+CONFIG_FILE = os.path.join(STATE_DIR, 'config.json')
+HISTORY_FILE = os.path.join(STATE_DIR, 'history.json')
+SCORE_FILE = os.path.join(STATE_DIR, 'score.json')
+
+INTERVAL = 3600         # default number of seconds between scoring runs
+POLL_INTERVAL = 10      # seconds between checks for a changed configuration
+
+# Bound the time spent probing sources: stop after SCORE_BUDGET seconds, or as
+# soon as SCORE_GOOD_ENOUGH good addresses have answered.  Hooks which probe the
+# sources themselves (when this service is not used) have tighter bounds.
+SCORE_BUDGET = 30
+SCORE_GOOD_ENOUGH = 64
+HOOK_SCORE_BUDGET = 10
+HOOK_SCORE_GOOD_ENOUGH = 32
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def read_json(path):
+    """Return the decoded contents of the JSON file, or None if it is missing or invalid"""
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_json(path, data):
+    """Atomically replace the file with the JSON encoding of data, so that
+    readers never see a partially-written file"""
+    (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.' + os.path.basename(path))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+    except Exception:
+        os.unlink(tmp)
+        raise
+
+
+def read_score(path=SCORE_FILE):
+    """Return the most recently published score, or None if there is none"""
+    return read_json(path)
+
+
+def rescore(config, history, now):
+    """Probe the configured hosts which have not been probed within the
+    configured interval, merge the results into the history, and return the
+    score to be published."""
+    hosts = config.get('hosts', [])
+    interval = config.get('interval', INTERVAL)
+    probed = ntp_source_score.stale_sources(history, hosts, now, interval)
+    (probes, cutoff) = ntp_source_score.get_source_delays(
+        probed, budget=SCORE_BUDGET, good_enough=SCORE_GOOD_ENOUGH)
+    ntp_source_score.update_history(history, probed, probes, cutoff, now)
+    return {
+        'cutoff': cutoff,
+        'host-list': hosts,
+        'probed': probed,
+        'raw': ntp_source_score.history_score(history, hosts),
+        'time': now,
+    }
+
+
+def run(config_file=CONFIG_FILE, history_file=HISTORY_FILE, score_file=SCORE_FILE, once=False):
+    """Publish a new score whenever the configuration changes or the interval expires."""
+    history = read_json(history_file) or ntp_source_score.new_history()
+    last_config = None
+    last_time = 0
+    while True:
+        config = read_json(config_file)
+        now = time.time()
+        if config is not None and (config != last_config or now - last_time >= config.get('interval', INTERVAL)):
+            score = rescore(config, history, now)
+            write_json(history_file, history)
+            write_json(score_file, score)
+            log('Published score %.3f for %d hosts (probed %d, cut off %d)' % (
+                score['raw'], len(score['host-list']), len(score['probed']), len(score['cutoff'])))
+            last_config = config
+            last_time = now
+        if once:
+            break
+        time.sleep(POLL_INTERVAL)
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='Publish NTP source scores in the background')
+    parser.add_argument('--config', default=CONFIG_FILE, help='Configuration file written by the charm')
+    parser.add_argument('--history', default=HISTORY_FILE, help='Delay history file')
+    parser.add_argument('--score', default=SCORE_FILE, help='File to which scores are published')
+    parser.add_argument('--once', action='store_true', help='Publish a single score and exit')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = get_args()
+    run(args.config, args.history, args.score, args.once)
@@ -4,27 +4,46 @@
 # License: GPLv3
 # Author: Paul Gear
 
-# This module runs ntpdate in test mode against the provided list of sources
+# This module sends NTPv4 client mode probes to the provided list of sources
 # in order to determine this node's suitability as an NTP server, based on the
-# number of reachable sources, and the network delay in reaching them.  Up to
-# MAX_THREADS (default 32) threads will be spawned to run ntpdate, in order
-# to minimise the time taken to calculate a score.
+# number of reachable sources, and the network delay in reaching them.  Each
+# source name is resolved once, and every address it resolves to is probed
+# and scored separately, so that the score reflects real servers.  All
+# probes are sent and received from a single asyncio event loop, with up to
+# MAX_PROBES (default 256) addresses being probed at once, in order to
+# minimise the time taken to calculate a score.
 
 # A main method is included to allow this module to be called separately from
 # juju hooks for diagnostic purposes.  It has no dependencies on juju,
 # charmhelpers, or the other modules in this charm.
 
 import argparse
+import asyncio
+import collections
 import math
-import queue
 import random
+import socket
 import statistics
+import struct
 import subprocess
-import threading
 import time
 
 rand = random.SystemRandom()
-MAX_THREADS = 32
+
+# The loop running the current coroutine; get_event_loop() returns the same
+# when called from a coroutine on the python versions (before 3.7) without it.
+get_running_loop = getattr(asyncio, 'get_running_loop', asyncio.get_event_loop)
+
+EWRMS_ALPHA = 0.125     # decay factor for exponentially weighted rms
+GOOD_DELAY = 0.1        # maximum rms delay in seconds of a good address
+HISTORY_MAX_AGE = 30 * 86400    # forget addresses not seen for this many seconds
+HISTORY_SAMPLES = 16    # delay samples kept for each address
+MAX_PROBES = 256        # maximum number of addresses probed concurrently
+NTP_EPOCH = 2208988800  # seconds between the NTP (1900) and Unix (1970) epochs
+NTP_PACKET = struct.Struct('!BBbbII4sQQQQ')
+NTP_PORT = 123
+PROBE_SAMPLES = 4       # samples per address, as per ntpdate's default
+PROBE_TIMEOUT = 0.2     # seconds to wait for each response, as per 'ntpdate -t 0.2'
 
 
 def rms(l):
@@ -36,6 +55,18 @@ def rms(l):
         return float('nan')
 
 
+def ewrms(values, alpha=EWRMS_ALPHA):
+    """Return the exponentially weighted root mean square of the list, which
+    is ordered from oldest to newest.  Each older value carries (1 - alpha)
+    times the weight of the value after it."""
+    if len(values) > 0:
+        weights = [(1 - alpha) ** i for i in range(len(values) - 1, -1, -1)]
+        squares = [w * x ** 2 for (w, x) in zip(weights, values)]
+        return math.sqrt(math.fsum(squares) / math.fsum(weights))
+    else:
+        return float('nan')
+
+
 def run_cmd(cmd):
     """Run the output, return a list of lines returned; ignore errors"""
     lines = []
@@ -47,44 +78,246 @@ def run_cmd(cmd):
     return lines
 
 
-def get_source_delays(source):
-    """Run ntpdate on the source, which may resolve to multiple addresses;
-    return the list of delay values. This can take several seconds, depending
-    on bandwidth and distance of the sources."""
-    delays = []
-    cmd = 'ntpdate -d -t 0.2 ' + source
-    for line in run_cmd(cmd):
-        fields = line.split()
-        if len(fields) >= 2 and fields[0] == 'delay':
-            delay = float(fields[1].split(',')[0])
-            if delay > 0:
-                delays.append(delay)
-    return delays
-
-
-def worker(num, src, dst, debug=False):
-    """Thread worker for parallelising ntpdate runs.  Gets host name
-    from src queue and places host and delay list in dst queue."""
-    if debug:
-        print('[%d] Starting' % (num,))
-    while True:
-        host = src.get()
-        if host is None:
-            break
+def to_ntp_time(t):
+    """Convert a Unix time in seconds to a 64-bit NTP timestamp"""
+    return int((t + NTP_EPOCH) * 2 ** 32) & 0xffffffffffffffff
+
+
+def from_ntp_time(ntp):
+    """Convert a 64-bit NTP timestamp to a Unix time in seconds"""
+    return ntp / 2 ** 32 - NTP_EPOCH
+
+
+def make_request(transmit):
+    """Return an NTPv4 client mode request packet with the given NTP transmit timestamp."""
+    # LI = 0 (no warning), VN = 4, Mode = 3 (client)
+    return NTP_PACKET.pack(0x23, 0, 0, 0, 0, 0, b'\0' * 4, 0, 0, 0, transmit)
+
+
+def parse_response(data, transmit, t1, elapsed):
+    """Validate a server response to the request sent with the given NTP transmit
+    timestamp at Unix time t1, received elapsed seconds later.  Return a tuple
+    of the delay and offset as defined in RFC 5905, or None if the response is
+    unusable."""
+    if len(data) < NTP_PACKET.size:
+        return None
+    (flags, stratum, poll, precision, rootdelay, rootdisp, refid,
+     reference, origin, receive, server_transmit) = NTP_PACKET.unpack_from(data)
+    leap = flags >> 6
+    mode = flags & 0x7
+    if mode != 4 or origin != transmit:
+        # not a server response to our request
+        return None
+    if leap == 3 or stratum == 0 or stratum > 15:
+        # unsynchronised server or kiss-o'-death
+        return None
+    t2 = from_ntp_time(receive)
+    t3 = from_ntp_time(server_transmit)
+    t4 = t1 + elapsed
+    delay = elapsed - (t3 - t2)
+    offset = ((t2 - t1) + (t3 - t4)) / 2
+    return (delay, offset)
+
+
+class NTPProbeProtocol(asyncio.DatagramProtocol):
+    """Datagram protocol which sends one request at a time to a single address
+    and resolves the pending future with the matching response."""
+
+    def __init__(self):
+        self.transport = None
+        self.response = None
+        self.transmit = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.response is None or self.response.done():
+            return
+        # ignore late responses to earlier requests
+        if data[24:32] == struct.pack('!Q', self.transmit):
+            self.response.set_result((data, time.perf_counter()))
+
+    def error_received(self, exc):
+        if self.response is not None and not self.response.done():
+            self.response.set_exception(exc)
+
+    async def query(self, timeout):
+        """Send a single request; return the (delay, offset) tuple, or None on timeout or error."""
+        loop = get_running_loop()
+        self.response = loop.create_future()
+        # randomise the low-order bits, which are below the precision of the system clock
+        t1 = time.time()
+        self.transmit = to_ntp_time(t1) ^ rand.getrandbits(8)
+        start = time.perf_counter()
+        self.transport.sendto(make_request(self.transmit))
+        try:
+            (data, end) = await asyncio.wait_for(self.response, timeout)
+        except (asyncio.TimeoutError, OSError):
+            return None
+        return parse_response(data, self.transmit, t1, end - start)
+
+
+async def probe_address(family, sockaddr, samples=PROBE_SAMPLES, timeout=PROBE_TIMEOUT):
+    """Send up to samples requests to the given address, one at a time.
+    Return the list of (delay, offset) tuples from valid responses."""
+    loop = get_running_loop()
+    try:
+        (transport, protocol) = await loop.create_datagram_endpoint(
+            NTPProbeProtocol, family=family, remote_addr=sockaddr)
+    except OSError:
+        return []
+    results = []
+    try:
+        for i in range(samples):
+            result = await protocol.query(timeout)
+            if result is not None:
+                results.append(result)
+    finally:
+        transport.close()
+    return results
 
-        # lower-numbered threads sleep for a shorter time, on average
-        s = rand.random() * num / MAX_THREADS
-        if debug:
-            print('[%d] Sleeping %.3f' % (num, s))
-        time.sleep(s)
 
+async def resolve(source, port=NTP_PORT):
+    """Resolve the source name; return the list of unique (family, sockaddr) tuples."""
+    loop = get_running_loop()
+    try:
+        infos = await loop.getaddrinfo(source, port, type=socket.SOCK_DGRAM, proto=socket.IPPROTO_UDP)
+    except (OSError, UnicodeError):
+        return []
+    addresses = []
+    for (family, socktype, proto, canonname, sockaddr) in infos:
+        if (family, sockaddr) not in addresses:
+            addresses.append((family, sockaddr))
+    return addresses
+
+
+class Resolver(object):
+    """Resolve each source name at most once per scoring run, so that sources
+    which are configured more than once are not looked up repeatedly."""
+
+    def __init__(self, port=NTP_PORT):
+        self.port = port
+        self.cache = {}
+
+    def lookup(self, source):
+        """Return a future for the list of unique (family, sockaddr) tuples for the source."""
+        if source not in self.cache:
+            self.cache[source] = asyncio.ensure_future(resolve(source, self.port))
+        return self.cache[source]
+
+    async def resolve(self, source):
+        """Return the list of unique (family, sockaddr) tuples for the source."""
+        return await self.lookup(source)
+
+
+def is_good(delays):
+    """Return True if the list of delay values indicates a good source"""
+    return len(delays) > 0 and rms(delays) <= GOOD_DELAY
+
+
+async def cancel_all(futures):
+    """Cancel the futures and wait for them to finish cleaning up."""
+    for f in futures:
+        f.cancel()
+    if len(futures):
+        await asyncio.wait(futures)
+
+
+def group_addresses(hosts, lookups, debug=False):
+    """Group the completed lookups by address.  Return an ordered hash of addresses
+    and their (family, sockaddr) tuples, a hash of addresses and the list of host
+    names which resolved to them, and the list of hosts whose lookups were cut off."""
+    addresses = collections.OrderedDict()
+    names = {}
+    cutoff = []
+    for host in hosts:
+        if lookups[host].cancelled():
+            cutoff.append(host)
+            continue
+        addrs = lookups[host].result()
+        if debug and len(addrs) == 0:
+            print('Could not resolve [%s]' % (host,))
+        for (family, sockaddr) in addrs:
+            address = sockaddr[0]
+            addresses.setdefault(address, (family, sockaddr))
+            names.setdefault(address, [])
+            if host not in names[address]:
+                names[address].append(host)
+    return (addresses, names, cutoff)
+
+
+async def collect_probes(tasks, remaining, good_enough=None):
+    """Collect the results of the probe tasks as they complete, until remaining()
+    returns zero, or good_enough good addresses have answered.  Return the list of
+    results, and the set of tasks which did not complete."""
+    probes = []
+    good = 0
+    pending = set(tasks)
+    while len(pending) and (good_enough is None or good < good_enough):
+        (done, pending) = await asyncio.wait(pending, timeout=remaining(), return_when=asyncio.FIRST_COMPLETED)
+        if len(done) == 0:
+            # out of time
+            break
+        for t in done:
+            probes.append(t.result())
+            if is_good(probes[-1][2]):
+                good += 1
+    return (probes, pending)
+
+
+async def probe_sources(hosts, concurrency, debug=False, port=NTP_PORT, resolver=None,
+                        budget=None, good_enough=None):
+    """Resolve all of the hosts, and probe every resulting address concurrently.
+    Addresses returned by more than one host are only probed once.
+
+    Results are consumed as they arrive.  Outstanding lookups and probes are
+    cancelled once budget seconds have elapsed, or once good_enough good
+    addresses have answered.  Return a tuple of the list of address, host name
+    list, and delay list tuples, and the list of hosts and addresses which were
+    cut off."""
+    loop = get_running_loop()
+    deadline = None if budget is None else loop.time() + budget
+
+    def remaining():
+        return None if deadline is None else max(deadline - loop.time(), 0)
+
+    if resolver is None:
+        resolver = Resolver(port)
+    lookups = dict((h, resolver.lookup(h)) for h in hosts)
+    if len(lookups):
+        (done, pending) = await asyncio.wait(set(lookups.values()), timeout=remaining())
+        await cancel_all(pending)
+    (addresses, names, cutoff) = group_addresses(hosts, lookups, debug)
+
+    limit = asyncio.Semaphore(concurrency)
+
+    async def probe(address, family, sockaddr):
+        async with limit:
+            samples = await probe_address(family, sockaddr)
+        delays = [d for (d, o) in samples if d > 0]
         if debug:
-            print('[%d] Getting results for [%s]' % (num, host))
-        delays = get_source_delays(host)
-        src.task_done()
-        if len(delays):
-            result = (host, delays)
-            dst.put(result)
+            print('Got %d results for %s [%s]' % (len(delays), address, ', '.join(names[address])))
+        return (address, names[address], delays)
+
+    tasks = dict((asyncio.ensure_future(probe(a, f, s)), a) for (a, (f, s)) in addresses.items())
+    (probes, pending) = await collect_probes(tasks, remaining, good_enough)
+    await cancel_all(pending)
+    cutoff.extend(sorted(tasks[t] for t in pending))
+    if debug and len(cutoff):
+        print('Cut off %d hosts: %s' % (len(cutoff), ', '.join(cutoff)))
+    return (probes, cutoff)
+
+
+def run_loop(coro):
+    """Run the coroutine to completion in a private event loop; return its result."""
+    loop = asyncio.new_event_loop()
+    try:
+        asyncio.set_event_loop(loop)
+        return loop.run_until_complete(coro)
+    finally:
+        asyncio.set_event_loop(None)
+        loop.close()
 
 
 def get_delay_score(delay):
@@ -93,21 +326,6 @@ def get_delay_score(delay):
     return -math.log(delay)
 
 
-def start_workers(threads, num_threads, src, dst, debug=False):
-    """Start all of the worker threads."""
-    for i in range(num_threads):
-        t = threading.Thread(target=worker, args=(i, src, dst, debug))
-        t.start()
-        threads.append(t)
-
-
-def stop_workers(threads, src):
-    """Send the workers a None object, causing them to stop work.
-    We enqueue one stop object for each worker."""
-    for i in range(len(threads)):
-        src.put(None)
-
-
 def calculate_score(delays):
     """Return the rms, mean, standard deviation, and overall
     score for the passed list of delay values."""
@@ -123,56 +341,127 @@ def calculate_score(delays):
     return (r, m, s, score)
 
 
-def calculate_results(q, verbose=False):
-    """Get the scores for all the hosts.
-    Return a hash of hosts and their cumulative scores."""
+def calculate_results(probes, verbose=False):
+    """Get the scores for all the addresses from the list of address, host name list,
+    and delay list tuples.  Return a hash of addresses and their scores."""
     results = {}
-    while not q.empty():
-        (host, delays) = q.get()
+    for (address, names, delays) in probes:
+        if len(delays) == 0:
+            continue
         (rms, mean, stdev, score) = calculate_score(delays)
-        delaystrings = [str(x) for x in delays]
+        delaystrings = ['%.6f' % (x,) for x in delays]
         if verbose:
-            print('%s score=%.3f rms=%.3f mean=%.3f stdevp=%.3f [%s]' %
-                  (host, score, rms, mean, stdev, ", ".join(delaystrings)))
-        if host in results:
-            results[host] += score
-        else:
-            results[host] = score
+            print('%s (%s) score=%.3f rms=%.3f mean=%.3f stdevp=%.3f [%s]' %
+                  (address, ', '.join(names), score, rms, mean, stdev, ", ".join(delaystrings)))
+        results[address] = score
     return results
 
 
-def wait_workers(threads):
-    """Wait for the given list of threads to complete."""
-    for t in threads:
-        t.join()
+def get_source_delays(hosts, debug=False, concurrency=None, budget=None, good_enough=None):
+    """Probe the listed hosts, stopping early if the budget in seconds runs out or
+    good_enough good addresses have answered.  Return the list of address, host
+    name list, and delay list tuples, and the list of hosts and addresses which
+    were cut off."""
+    if concurrency is None:
+        concurrency = MAX_PROBES
+    return run_loop(probe_sources(hosts, concurrency, debug, budget=budget, good_enough=good_enough))
+
+
+def verify_sources(hosts, budget=None):
+    """Probe all of the listed hosts concurrently, for at most budget seconds.
+    Return the set of hosts with an address which gave a valid response, and
+    the list of hosts which were cut off before they could be resolved."""
+    (probes, cutoff) = get_source_delays(hosts, budget=budget)
+    verified = set()
+    for (address, names, delays) in probes:
+        if len(delays):
+            verified.update(names)
+    return (verified, [h for h in hosts if h in cutoff and h not in verified])
 
 
-def run_checks(hosts, debug=False, numthreads=None, verbose=False):
-    """Perform a check of the listed hosts.
-    Can take several seconds per host."""
-    sources = queue.Queue()
-    results = queue.Queue()
-    threads = []
-    for h in hosts:
-        sources.put(h)
-    if numthreads is None:
-        numthreads = min(len(hosts), MAX_THREADS)
-    start_workers(threads, numthreads, sources, results, debug)
-    sources.join()
-    stop_workers(threads, sources)
-    # wait_workers(threads)
-    return calculate_results(results, verbose)
+def run_checks(hosts, debug=False, concurrency=None, verbose=False, budget=None, good_enough=None):
+    """Perform a check of the listed hosts, stopping early if the budget in seconds
+    runs out or good_enough good addresses have answered.  Return a hash of addresses
+    and their scores, and the list of hosts and addresses which were cut off.
+    Takes about a second, regardless of the number of hosts."""
+    (probes, cutoff) = get_source_delays(hosts, debug, concurrency, budget, good_enough)
+    if verbose and len(cutoff):
+        print('Cut off before completion: %s' % (', '.join(cutoff),))
+    return (calculate_results(probes, verbose), cutoff)
 
 
-def get_source_score(hosts, debug=False, numthreads=None, verbose=False):
-    """Check NTP connectivity to the given list of sources - return a single overall score"""
-    results = run_checks(hosts, debug, numthreads, verbose)
-    if results is None:
-        return 0
+def get_source_score(hosts, debug=False, concurrency=None, verbose=False, budget=None, good_enough=None):
+    """Check NTP connectivity to the given list of sources - return a single overall score,
+    and the list of hosts and addresses which were cut off by the budget or good_enough limits."""
+    (results, cutoff) = run_checks(hosts, debug, concurrency, verbose, budget, good_enough)
 
     total = 0
     for host in results:
         total += results[host]
+    return (total, cutoff)
+
+
+def new_history():
+    """Return an empty delay history"""
+    return {'addresses': {}, 'sources': {}}
+
+
+def stale_sources(history, host_list, now, max_age):
+    """Return the list of hosts which have no history, or whose history is older than max_age seconds"""
+    stale = []
+    for host in host_list:
+        source = history['sources'].get(host)
+        if source is None or now - source['time'] > max_age:
+            stale.append(host)
+    return stale
+
+
+def update_history(history, hosts, probes, cutoff, now):
+    """Merge the results of probing hosts into the history.  Hosts which were cut
+    off before they could be resolved are not updated, so that they will be
+    re-probed next time; addresses which were cut off keep their existing history."""
+    for host in hosts:
+        if host in cutoff:
+            continue
+        old = history['sources'].get(host, {}).get('addresses', [])
+        history['sources'][host] = {
+            'addresses': [a for a in old if a in cutoff],
+            'time': now,
+        }
+    for (address, names, delays) in probes:
+        for host in names:
+            history['sources'][host]['addresses'].append(address)
+        entry = history['addresses'].setdefault(address, {'delays': []})
+        if len(delays):
+            entry['delays'] = (entry['delays'] + [round(d, 6) for d in delays])[-HISTORY_SAMPLES:]
+        else:
+            # unreachable addresses don't contribute to the score, as before
+            entry['delays'] = []
+        entry['time'] = now
+
+    for address in list(history['addresses'].keys()):
+        if now - history['addresses'][address].get('time', 0) > HISTORY_MAX_AGE:
+            del history['addresses'][address]
+
+
+def history_score(history, host_list, verbose=False):
+    """Return the sum of the scores for each address which the hosts last resolved
+    to, based on the exponentially weighted rms of each address's delay history."""
+    total = 0
+    addresses = set()
+    for host in host_list:
+        source = history['sources'].get(host)
+        if source is not None:
+            addresses.update(source['addresses'])
+    for address in sorted(addresses):
+        delays = history['addresses'].get(address, {}).get('delays', [])
+        if len(delays) == 0:
+            continue
+        r = ewrms(delays)
+        score = get_delay_score(r)
+        if verbose:
+            print('%s score=%.3f ewrms=%.3f samples=%d' % (address, score, r, len(delays)))
+        total += score
     return total
 
 
@@ -186,14 +475,17 @@ def display_results(results):
 
 def get_args():
     parser = argparse.ArgumentParser(description='Get NTP server/peer/pool scores')
-    parser.add_argument('--debug', '-d', action='store_true', help='Enable thread debug output')
+    parser.add_argument('--debug', '-d', action='store_true', help='Enable probe debug output')
     parser.add_argument('--verbose', '-v', action='store_true', help='Display scoring detail')
+    parser.add_argument('--budget', '-b', type=float, help='Stop probing after this many seconds')
+    parser.add_argument('--good-enough', '-g', type=int, help='Stop probing after this many good addresses answer')
     parser.add_argument('hosts', nargs=argparse.REMAINDER, help='List of hosts to check')
     return parser.parse_args()
 
 
 if __name__ == '__main__':
     args = get_args()
-    results = run_checks(args.hosts, debug=args.debug, verbose=args.verbose)
+    (results, cutoff) = run_checks(args.hosts, debug=args.debug, verbose=args.verbose,
+                                   budget=args.budget, good_enough=args.good_enough)
     if results:
         display_results(results)
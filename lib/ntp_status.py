@@ -0,0 +1,107 @@
+# Copyright (c) 2017-2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+# This module memoises the components of the workload status which is set on
+# every update-status hook.  Each component is saved in unitdata along with a
+# key describing what it depends on (for example, the dpkg status file's mtime
+# for the package version, or the time of ntpmon's latest sample for the
+# nagios check), and is only recalculated when that key changes or the saved value becomes too old.
+# The time taken to produce each component is recorded, so that slow hooks can
+# be diagnosed from the unit's log.
+
+import json
+import os
+import sys
+import time
+
+BOOT_ID = '/proc/sys/kernel/random/boot_id'
+DPKG_STATUS = '/var/lib/dpkg/status'
+NTPMON_STATE = '/run/ntpmon/state.json'     # ntpmon's latest sample; see src/state.py
+
+# The score is also recalculated by other hooks, so the status shows the saved
+# score string for at most SCORE_MAX_AGE seconds.
+SCORE_MAX_AGE = 3600
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+def get_boot_id():
+    """Return the kernel's boot ID, which changes on every reboot, or None if it is unavailable"""
+    try:
+        with open(BOOT_ID) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+
+def get_mtime(path):
+    """Return the modification time of the file, or None if it does not exist"""
+    try:
+        return os.stat(path).st_mtime
+    except OSError:
+        return None
+
+
+def get_ntpmon_sample(now=None, path=NTPMON_STATE):
+    """Return the time of ntpmon's latest sample and the interval between its samples,
+    or None if there is no sample from within the last two intervals"""
+    try:
+        with open(path) as f:
+            state = json.load(f)
+        (sampled, interval) = (float(state['time']), float(state['interval']))
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if now is None:
+        now = time.time()
+    if not 0 <= now - sampled <= 2 * interval:
+        return None
+    return (sampled, interval)
+
+
+class StatusCache(object):
+    """Memoised status components, saved in the given unitdata storage"""
+
+    def __init__(self, kv, now=None):
+        self.kv = kv
+        self.now = time.time() if now is None else now
+        self.saved = kv.get('status_cache') or {}
+        self.timings = []
+
+    def get(self, name, key, func, max_age=None):
+        """Return the saved value of the named component if it was calculated with the same
+        key within max_age seconds (if given); otherwise, call func to calculate it.
+        A key of None means that the dependencies are unknown, so the value is always calculated."""
+        if key is None:
+            return self.timed(name, func)
+        # the key is compared with the saved copy, so it must survive the round trip through JSON
+        key = json.loads(json.dumps(key))
+        entry = self.saved.get(name)
+        start = time.time()
+        if (entry is None or entry['key'] != key or
+                max_age is not None and not 0 <= self.now - entry['time'] <= max_age):
+            entry = {'key': key, 'time': self.now, 'value': func()}
+            self.saved[name] = entry
+            cached = False
+        else:
+            cached = True
+        self.timings.append((name, time.time() - start, cached))
+        return entry['value']
+
+    def timed(self, name, func):
+        """Call func, which is never memoised, and record the time it takes"""
+        start = time.time()
+        value = func()
+        self.timings.append((name, time.time() - start, False))
+        return value
+
+    def timing_string(self):
+        return ', '.join('%s %.3fs%s' % (name, elapsed, ' (cached)' if cached else '')
+                         for (name, elapsed, cached) in self.timings)
+
+    def save(self):
+        """Save the components, and log the time taken to produce each one"""
+        self.kv.set('status_cache', self.saved)
+        log('[STATUS] ' + self.timing_string())
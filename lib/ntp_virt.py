@@ -0,0 +1,108 @@
+# Copyright (c) 2018 Canonical Ltd
+# License: GPLv3
+# Author: Paul Gear
+
+"""Detect the virtualisation type of the host, using the same names as 'facter virtual'
+
+Containers are detected first, since they see the host's DMI and CPU details:
+- the container variable in the environment of process 1 (set by LXC, systemd-nspawn, podman)
+- marker files left by docker, podman, and LXD
+- the control groups of process 1
+- OpenVZ's /proc/vz (without the /proc/bc which is only present on the host)
+
+Virtual machines are detected from the Xen capabilities, the DMI vendor and product
+strings, and the hypervisor CPUID flag reported in /proc/cpuinfo.
+"""
+
+import os
+
+ROOT = '/'
+
+_container_names = {
+    'docker': 'docker',
+    'lxc': 'lxc',
+    'lxc-libvirt': 'lxc',
+    'oci': 'docker',
+    'podman': 'docker',
+    'systemd-nspawn': 'systemd_nspawn',
+}
+
+_container_files = [
+    ('/.dockerenv', 'docker'),
+    ('/run/.containerenv', 'docker'),
+    ('/dev/lxd/sock', 'lxc'),
+]
+
+_container_cgroups = [
+    ('/docker', 'docker'),
+    ('/kubepods', 'docker'),
+    ('/lxc', 'lxc'),
+]
+
+_dmi_files = ['sys_vendor', 'product_name', 'bios_vendor', 'board_vendor']
+
+_dmi_vms = [
+    ('Microsoft Corporation Virtual Machine', 'hyperv'),
+    ('KVM', 'kvm'),
+    ('QEMU', 'kvm'),
+    ('OpenStack', 'openstack'),
+    ('VMware', 'vmware'),
+    ('VirtualBox', 'virtualbox'),
+    ('innotek', 'virtualbox'),
+    ('Xen', 'xenhvm'),
+    ('Parallels', 'parallels'),
+    ('BHYVE', 'bhyve'),
+    ('Bochs', 'bochs'),
+]
+
+
+def _path(root, path):
+    return os.path.join(root, path.lstrip('/'))
+
+
+def _read(root, path):
+    """Return the contents of the file, or an empty string if it cannot be read"""
+    try:
+        with open(_path(root, path), errors='replace') as f:
+            return f.read()
+    except OSError:
+        return ''
+
+
+def container_type(root=ROOT):
+    """Return the type of container we are running in, or None"""
+    for var in _read(root, '/proc/1/environ').split('\0'):
+        if var.startswith('container='):
+            value = var[len('container='):]
+            return _container_names.get(value, value)
+    for (path, name) in _container_files:
+        if os.path.exists(_path(root, path)):
+            return name
+    cgroups = _read(root, '/proc/1/cgroup')
+    for (marker, name) in _container_cgroups:
+        if marker in cgroups:
+            return name
+    if os.path.exists(_path(root, '/proc/vz')) and not os.path.exists(_path(root, '/proc/bc')):
+        return 'openvz'
+    return None
+
+
+def vm_type(root=ROOT):
+    """Return the type of virtual machine we are running in, or None"""
+    if os.path.exists(_path(root, '/proc/xen')):
+        if 'control_d' in _read(root, '/proc/xen/capabilities'):
+            return 'xen0'
+        return 'xenu'
+    dmi = ' '.join(_read(root, '/sys/class/dmi/id/' + f).strip() for f in _dmi_files)
+    for (marker, name) in _dmi_vms:
+        if marker in dmi:
+            return name
+    for line in _read(root, '/proc/cpuinfo').split('\n'):
+        if line.startswith('flags') and 'hypervisor' in line.split():
+            return 'virtual'
+    return None
+
+
+def detect_virtual(root=ROOT):
+    """Return the virtualisation type of the host, as reported by 'facter virtual'"""
+    return container_type(root) or vm_type(root) or 'physical'
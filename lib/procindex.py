@@ -0,0 +1,110 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Find processes by name without scanning the whole process table every time.
+
+A ProcessIndex remembers the PID of the first process found for each of a set
+of named matchers.  Cached PIDs are revalidated cheaply by comparing the start
+time recorded in /proc/<pid>/stat, which detects PID reuse; the full process
+table is only scanned again when a cached process has gone, or when the last
+scan is older than max_age seconds.
+"""
+
+import time
+
+import psutil
+
+
+# Check for old psutil per http://grodola.blogspot.com.au/2014/01/psutil-20-porting.html
+PSUTIL2 = psutil.version_info >= (2, 0)
+
+
+def starttime(pid):
+    """
+    Return the start time of the process in clock ticks since boot, from /proc/<pid>/stat,
+    or None if it cannot be read.
+    """
+    try:
+        with open('/proc/%d/stat' % (pid,)) as f:
+            stat = f.read()
+        # the process name may contain spaces or parentheses, so skip past the last one;
+        # starttime is field 22, which is the 20th field after the name
+        return int(stat[stat.rindex(')') + 2:].split()[19])
+    except (OSError, TypeError, ValueError, IndexError):
+        return None
+
+
+class ProcessIndex(object):
+
+    def __init__(self, matchers, max_age=None, state=None):
+        """
+        matchers is a dict of keys and functions which return True if the given process name matches.
+        If state is provided, it is used (and updated) as the cache, so that it may be persisted.
+        """
+        self.matchers = matchers
+        self.max_age = max_age
+        self.state = state if state is not None else {}
+        self.state.setdefault('pids', {})
+        self.state.setdefault('time', 0)
+
+    def valid(self, now):
+        """
+        Return True if the cache is recent enough and all of the cached processes are still running.
+        """
+        if self.max_age is not None and now - self.state['time'] > self.max_age:
+            return False
+        if self.max_age is None and len(self.state['pids']) == 0:
+            # without an age limit, a scan which found nothing must be repeated
+            return False
+        for (pid, start) in self.state['pids'].values():
+            if starttime(pid) != start:
+                return False
+        return True
+
+    def scan(self, now):
+        """
+        Search the process table for the first process matching each matcher.
+        Only processes whose start time can be read are cached.
+        """
+        pids = {}
+        found = {}
+        for proc in psutil.process_iter():
+            try:
+                name = proc.name() if PSUTIL2 else proc.name
+            except psutil.Error:
+                continue
+            for key in self.matchers:
+                if key not in found and self.matchers[key](name):
+                    found[key] = proc.pid
+                    start = starttime(proc.pid)
+                    if start is not None:
+                        pids[key] = [proc.pid, start]
+        self.state['pids'] = pids
+        self.state['time'] = now
+        return found
+
+    def getpids(self):
+        """
+        Return a dict of matcher keys and the PID of a matching process.
+        Keys for which no matching process is running are omitted.
+        """
+        now = time.time()
+        if self.valid(now):
+            return dict((key, pid) for (key, (pid, start)) in self.state['pids'].items())
+        return self.scan(now)
@@ -5,6 +5,7 @@ import subprocess
 import sys
 
 from charmhelpers.contrib.charmsupport import nrpe
+import charmhelpers.contrib.templating.jinja as templating
 from charmhelpers.core import hookenv, host, unitdata
 from charms import layer
 import charmhelpers.fetch as fetch
@@ -20,9 +21,13 @@ from charms.reactive.decorators import (
     when_not,
 )
 
+import ntp_auto_peers
+import ntp_check_server
 import ntp_hyperv
 import ntp_implementation
 import ntp_scoring
+import ntp_scoring_service
+import ntp_status
 
 implementation = ntp_implementation.get_implementation()
 
@@ -54,45 +59,53 @@ def get_relation_attributes(relation_name, attribute=None):
                 yield (addr, attr)
 
 
-def get_peer_sources(topN=6):
+def get_peer_scores():
+    """Return a dict of each unit in the peer relation (including this one) and its (address, score).
+    The score is None if the unit has not published one."""
+    scores = {}
+    for relid in hookenv.relation_ids('ntp-peers'):
+        for unit in hookenv.related_units(relid=relid):
+            settings = hookenv.relation_get(unit=unit, rid=relid) or {}
+            try:
+                score = float(settings['score'])
+            except (KeyError, TypeError, ValueError):
+                score = None
+            scores[unit] = (settings.get('private-address'), score)
+    ourscore = get_score()
+    scores[hookenv.local_unit()] = (hookenv.unit_private_ip(), ourscore.get('score') if ourscore else None)
+    return scores
+
+
+def publish_auto_peers(topN=6):
     """
-    Read the peer private addresses and their scores.
-    Determine whether we're in the top N scores;
-    if so, we're upstream - return None
-    Otherwise, return the list of the top N peers.
+    Choose the topN units with the best scores as the upstream units, and
+    publish them in the leader settings.  Must only be called on the leader.
     """
     if topN is None:
         topN = 6
-    ourscore = get_score()
-    if ourscore is None:
-        return None
-
     hookenv.status_set('maintenance', 'Retrieving peer scores')
-    peers = list(get_relation_attributes('ntp-peers', 'score'))
+    scores = get_peer_scores()
     hookenv.status_set('maintenance', 'Retrieved peer scores')
+    upstream = ntp_auto_peers.choose_upstream(scores, topN)
+    log('[AUTO_PEER] {} of {} units upstream: {}'.format(len(upstream), len(scores), ' '.join(sorted(upstream))))
+    setting = ntp_auto_peers.encode(upstream)
+    if hookenv.leader_get(ntp_auto_peers.LEADER_KEY) != setting:
+        hookenv.leader_set({ntp_auto_peers.LEADER_KEY: setting})
 
-    if len(peers) < topN:
-        # we don't have enough peers to do auto-peering
-        log('[AUTO_PEER] There are only {} peers; not doing auto-peering'.format(len(peers)))
-        return None
-
-    # list of hosts with scores better than ours
-    hosts = list(filter(lambda x: float(x[1]) > ourscore['score'], peers))
-    log('[AUTO_PEER] {} peers better than us, topN == {}'.format(len(hosts), topN))
 
-    # if the list is less than topN long, we're in the topN hosts
-    if len(hosts) < topN:
-        return None
-    else:
-        # sort list of hosts by score, keep only the topN
-        topNhosts = sorted(hosts, key=lambda x: float(x[1]), reverse=True)[0:topN]
-        # return only the host addresses
-        return map(lambda x: x[0], topNhosts)
+def get_peer_sources():
+    """
+    Read this unit's assignment from the topology published by the leader.
+    If we're upstream - return None
+    Otherwise, return the list of upstream units' addresses.
+    """
+    return ntp_auto_peers.get_sources(hookenv.leader_get(ntp_auto_peers.LEADER_KEY), hookenv.local_unit())
 
 
 @hook('upgrade-charm')
 def upgrade():
     remove_state('ntp.installed')
+    remove_state('ntp.scoring.configured')
     # If we're upgrading from non-reactive to reactive, the
     # nrpe layer won't automatically fire, so do it manually.
     if hookenv.relation_ids('nrpe-external-master'):
@@ -146,12 +159,26 @@ def set_peer_relation_score(context=None):
 
 @hook('ntp-peers-relation-changed')
 def peers_relation_changed(context=None):
-    if hookenv.config('auto_peers'):
+    # only the leader reads the peer scores; the other units are reconfigured
+    # when it publishes a new topology
+    if hookenv.config('auto_peers') and hookenv.is_leader():
         remove_state('ntp.configured')
 
 
 @hook('ntp-peers-relation-departed')
 def peers_relation_departed(context=None):
+    if hookenv.config('auto_peers') and hookenv.is_leader():
+        remove_state('ntp.configured')
+
+
+@hook('leader-elected')
+def leader_elected(context=None):
+    if hookenv.config('auto_peers'):
+        remove_state('ntp.configured')
+
+
+@hook('leader-settings-changed')
+def leader_settings_changed(context=None):
     if hookenv.config('auto_peers'):
         remove_state('ntp.configured')
 
@@ -169,6 +196,31 @@ def master_relation_departed(context=None):
 @when('config.changed')
 def config_changed():
     remove_state('ntp.configured')
+    remove_state('ntp.scoring.configured')
+
+
+@when('ntp.installed')
+@when_not('ntp.scoring.configured')
+def configure_scoring_service():
+    """Install and configure the background scoring service if it is enabled; otherwise stop it."""
+    service_name = ntp_scoring_service.SERVICE_NAME
+    unit_file = '/etc/systemd/system/' + service_name + '.service'
+    if ntp_scoring.use_service() and hookenv.config('auto_peers'):
+        hookenv.status_set('maintenance', 'Configuring scoring service')
+        host.mkdir(ntp_scoring_service.STATE_DIR)
+        ntp_scoring_service.write_json(ntp_scoring_service.CONFIG_FILE, {
+            'hosts': ntp_scoring.get_host_list(),
+            'interval': ntp_scoring_service.INTERVAL,
+        })
+        with open(unit_file, 'w') as conffile:
+            conffile.write(templating.render(service_name + '.service', {'charm_dir': hookenv.charm_dir()}))
+        subprocess.call(['systemctl', 'daemon-reload'])
+        host.service_resume(service_name)
+        # pick up any new charm code
+        host.service_restart(service_name)
+    elif os.path.exists(unit_file):
+        host.service_pause(service_name)
+    set_state('ntp.scoring.configured')
 
 
 @when('ntp.installed')
@@ -206,7 +258,9 @@ def write_config():
         kv.unset('auto_peer')
     elif auto_peers and hookenv.relation_ids('ntp-peers'):
         # use auto_peers
-        auto_peer_list = get_peer_sources(hookenv.config('auto_peers_upstream'))
+        if hookenv.is_leader():
+            publish_auto_peers(hookenv.config('auto_peers_upstream'))
+        auto_peer_list = get_peer_sources()
         if auto_peer_list is None:
             # we are upstream - use configured sources, pools, peers
             kv.set('auto_peer', 'upstream')
@@ -238,6 +292,20 @@ def write_config():
     assess_status()
 
 
+def configure_check_server(options):
+    """Install and start the check_ntpmon server which answers the NRPE check, if systemd is in use.
+    Without it, check_ntpmon_client.py runs check_ntpmon.py itself."""
+    if not host.init_is_systemd():
+        return
+    with open(ntp_check_server.UNIT_FILE, 'w') as conffile:
+        conffile.write(templating.render(ntp_check_server.TEMPLATE, ntp_check_server.get_context(options),
+                                         template_dir=hookenv.charm_dir()))
+    subprocess.call(['systemctl', 'daemon-reload'])
+    host.service_resume(ntp_check_server.SERVICE_NAME)
+    # pick up any new ntpmon code
+    host.service_restart(ntp_check_server.SERVICE_NAME)
+
+
 @when_all('nrpe-external-master.available', 'ntpmon.installed')
 @when_not('ntp.nrpe.configured')
 def update_nrpe_config():
@@ -259,7 +327,9 @@ def update_nrpe_config():
 
     nagios_ntpmon_checks = hookenv.config('nagios_ntpmon_checks').split()
 
-    check_cmd = os.path.join(options['install-dir'], 'check_ntpmon.py') + ' --check ' + ' '.join(nagios_ntpmon_checks)
+    configure_check_server(options)
+    check_cmd = os.path.join(options['install-dir'], 'check_ntpmon_client.py') + ' --check ' + ' '.join(
+        nagios_ntpmon_checks)
     unitdata.kv().set('check_cmd', check_cmd)
     nrpe_setup.add_check(
         check_cmd=check_cmd,
@@ -311,35 +381,30 @@ def prefer_non_dhcp_ntp_servers():
 
 @hook('update-status')
 def assess_status():
+    # components which have not changed since the last hook are reused
+    cache = ntp_status.StatusCache(unitdata.kv())
+
     package = implementation.package_name()
-    version = fetch.get_upstream_version(package)
+    version = cache.get('version', [package, ntp_status.get_mtime(ntp_status.DPKG_STATUS)],
+                        lambda: fetch.get_upstream_version(package))
     if version is not None:
         hookenv.application_version_set(version)
 
     status = []
     if hookenv.config('verify_ntp_servers'):
-        failed_servers = []
-        if hookenv.config('source'):
-            for server in hookenv.config('source').split():
-                try:
-                    subprocess.check_call(
-                        ["ntpdate", "-qd", server],
-                        stderr=subprocess.DEVNULL,
-                    )
-                except subprocess.CalledProcessError:
-                    failed_servers.append(server)
-                    continue
-
-            if failed_servers:
-                _servers = '; '.join(failed_servers)
-                hookenv.status_set(
-                    'blocked',
-                    'NTP servers are not reachable: %s' % _servers
-                )
-                return
+        failed_servers = cache.timed('verify', lambda: ntp_scoring.get_unverified_servers(
+            (hookenv.config('source') or '').split()))
+        if failed_servers:
+            _servers = '; '.join(failed_servers)
+            hookenv.status_set(
+                'blocked',
+                'NTP servers are not reachable: %s' % _servers
+            )
+            cache.save()
+            return
 
     # service status
-    if host.service_running(implementation.service_name()):
+    if cache.timed('service', lambda: host.service_running(implementation.service_name())):
         state = 'active'
         status.append('Ready')
     else:
@@ -347,24 +412,36 @@ def assess_status():
         status.append('Not running')
 
     # container status
-    if ntp_scoring.get_virt_type() == 'container':
+    if cache.timed('virt', ntp_scoring.get_virt_type) == 'container':
         status.append('time sync disabled in container')
     else:
         check_cmd = unitdata.kv().get('check_cmd')
         if check_cmd:
-            status.append(get_nagios_result(check_cmd))
+            # the result only changes when ntpmon publishes a new sample; without a recent
+            # sample, the check is always run, so that it reports that ntpmon has stopped
+            sample = ntp_status.get_ntpmon_sample()
+            if sample is None:
+                status.append(cache.timed('nagios', lambda: get_nagios_result(check_cmd)))
+            else:
+                (sampled, interval) = sample
+                status.append(cache.get('nagios', [check_cmd, sampled], lambda: get_nagios_result(check_cmd),
+                                        max_age=2 * interval))
 
-    # Hyper-V status
-    status.append(ntp_hyperv.sync_status())
+    # Hyper-V status (not memoised, since host sync may be re-enabled at any time)
+    status.append(cache.timed('hyperv', ntp_hyperv.sync_status))
 
     # scoring status
     # (don't force update of the score from update-status more than once a month)
     max_age = 31 * 86400
-    status.append(ntp_scoring.get_score_string(max_seconds=max_age))
+    scoring = [hookenv.config(k) for k in ('auto_peers', 'source', 'peers', 'pools')]
+    status.append(cache.get('score', scoring, lambda: ntp_scoring.get_score_string(max_seconds=max_age),
+                            max_age=ntp_status.SCORE_MAX_AGE))
 
     # auto_peer status
     status.append(unitdata.kv().get('auto_peer'))
 
+    cache.save()
+
     # join the non-None results in a single string
     status = package + ': ' + ', '.join([x for x in status if x])
     hookenv.status_set(state, status)
@@ -70,6 +70,8 @@ def install_ntpmon():
         log('installing ntpmon')
         host.mkdir(os.path.dirname(install_dir))
         host.rsync('src/', '{}/'.format(install_dir))
+        # the process index is shared with the charm's scoring, so it lives in lib
+        host.rsync('lib/procindex.py', '{}/'.format(install_dir))
 
         if service_name:
             if using_systemd:
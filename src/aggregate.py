@@ -0,0 +1,98 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Aggregate peer samples taken more often than the reporting interval, so that
+transient offset spikes between reports are not lost.
+"""
+
+import math
+
+from peers import NTPPeers
+
+
+"""
+Peer fields which are aggregated, and the statistics reported for each
+"""
+fields = ['delay', 'jitter', 'offset']
+stats = ['min', 'max', 'mean', 'p50', 'p99']
+
+
+def percentile(values, p):
+    """
+    Return the pth percentile of the sorted list of values, using the nearest-rank method.
+    """
+    rank = int(math.ceil(p / 100.0 * len(values)))
+    return values[max(rank, 1) - 1]
+
+
+def summarise(values):
+    """
+    Return a dict of the statistics for the list of values.
+    """
+    values = sorted(values)
+    return {
+        'count': len(values),
+        'min': values[0],
+        'max': values[-1],
+        'mean': sum(values) / len(values),
+        'p50': percentile(values, 50),
+        'p99': percentile(values, 99),
+    }
+
+
+class NTPAggregator(object):
+
+    def __init__(self, peertype='survivor'):
+        """
+        Aggregate the fields of peers of the given type (by default, all peers
+        which survived the selection algorithm, including the sync peer).
+        """
+        self.peertype = peertype
+        self.reset()
+
+    def reset(self):
+        """
+        Discard the samples for the last reporting interval.
+        """
+        self.samples = 0
+        self.values = dict((f, []) for f in fields)
+
+    def add(self, peers):
+        """
+        Add a sample from the NTPPeers object; ignore a missing sample.
+        """
+        if peers is None:
+            return
+        self.samples += 1
+        mask = NTPPeers.typebits[self.peertype]
+        for f in fields:
+            self.values[f].extend(peers.table.column(f, mask))
+
+    def getmetrics(self):
+        """
+        Return the statistics for each field with at least one value, named
+        'aggregate-<field>-<stat>', and the number of samples taken.
+        """
+        metrics = {'aggregate-samples': self.samples}
+        for f in fields:
+            if len(self.values[f]):
+                summary = summarise(self.values[f])
+                for stat in summary:
+                    metrics['aggregate-%s-%s' % (f, stat)] = summary[stat]
+        return metrics
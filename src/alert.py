@@ -24,11 +24,11 @@ gathered), and creating messages for display to the user.  It contains a few
 special cases which require knowledge of the rest of the application.
 """
 
+import math
 import metrics
-import pprint
 import sys
 
-from classifier import MetricClassifier
+from classifier import MetricClassifier, return_code_for_classification
 
 
 """
@@ -105,6 +105,7 @@ Metric types for collectd
 _collectdtypes = {
 
     'frequency': 'frequency/frequency_offset',
+    'missed': 'missed/count',
     'offset': 'offset/time_offset',
     'reach': 'reachability/percent',
     'rootdelay': 'rootdelay/time_offset',
@@ -136,12 +137,37 @@ _peer_types = {
 
 }
 
+"""
+Metric types for aggregated peer fields in collectd
+"""
+_aggregate_types = {
+
+    'delay': 'time_offset',
+    'jitter': 'time_offset',
+    'offset': 'time_offset',
+
+}
+
+"""
+Metric types for individual peers in collectd, and whether they are integers in telegraf
+"""
+_peer_address_types = {
+
+    'delay': ('time_offset', None),
+    'jitter': ('time_offset', None),
+    'offset': ('time_offset', None),
+    'reach': ('percent', None),
+    'stratum': ('count', 'i'),
+
+}
+
 """
 Metric types for telegraf
 """
 _telegraf_types = {
 
     'frequency': None,
+    'missed': 'i',
     'offset': None,
     'reach': None,
     'rootdelay': None,
@@ -157,12 +183,42 @@ _telegraf_types = {
 }
 
 
+def promvalue(value):
+    """
+    Format the value for Prometheus
+    """
+    value = float(value)
+    if math.isnan(value):
+        return 'NaN'
+    elif math.isinf(value):
+        return '+Inf' if value > 0 else '-Inf'
+    return repr(value)
+
+
+def promlabels(**labels):
+    """
+    Format the labels for Prometheus, escaping their values
+    """
+    escaped = []
+    for name in sorted(labels):
+        value = str(labels[name]).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append('%s="%s"' % (name, value))
+    return '{' + ','.join(escaped) + '}'
+
+
 class NTPAlerter(object):
  
-    def __init__(self, checks):
+    def __init__(self, checks, peerlimit=0, peerallow=None):
+        """
+        If peerlimit is positive, also report metrics for up to that many individual peers,
+        restricted to the addresses in peerallow if it is supplied.
+        """
         self.checks = checks
+        self.peerlimit = peerlimit
+        self.peerallow = peerallow
         self.mc = MetricClassifier(_metricdefs)
         self.metrics = {}
+        self.objmetrics = {}
         self.objs = {}
 
     def collectmetrics(self, checkobjs, debug):
@@ -171,19 +227,29 @@ class NTPAlerter(object):
         """
         self.metrics = {}
         self.objs = checkobjs
+        self.objmetrics = dict((o, self.objs[o].getmetrics()) for o in self.objs)
         for o in self.objs:
-            self.metrics.update(self.objs[o].getmetrics())
+            self.metrics.update(self.objmetrics[o])
         if debug:
+            import pprint
             pprint.pprint(self.metrics)
         metrics.addaliases(self.metrics, _aliases)
         if 'proc' in self.checks:
-            self.checks.append('runtime')
+            self.addcheck('runtime')
         if 'trace' in self.checks:
-            self.checks.append('tracehosts')
-            self.checks.append('traceloops')
-            self.checks.append('tracetime')
+            self.addcheck('tracehosts')
+            self.addcheck('traceloops')
+            self.addcheck('tracetime')
         if 'vars' in self.checks and 'offset' not in self.checks:
-            self.checks.append('sysoffset')
+            self.addcheck('sysoffset')
+
+    def addcheck(self, check):
+        """
+        Add a check derived from those requested, if not already present
+        (metrics are collected every interval by ntpmon).
+        """
+        if check not in self.checks:
+            self.checks.append(check)
 
     def custom_message(self, metric, result):
         """
@@ -244,7 +310,12 @@ class NTPAlerter(object):
             self.alert_collectd(hostname, interval)
         elif format == 'telegraf':
             self.alert_telegraf()
+        elif format == 'prometheus':
+            self.alert_prometheus()
         self.alert_peers(hostname, interval, format)
+        self.alert_missed(hostname, interval, format)
+        self.alert_aggregate(hostname, interval, format)
+        self.alert_peer_addresses(hostname, interval, format)
         self.finished_output()
 
     def alert_collectd(self, hostname, interval):
@@ -273,9 +344,68 @@ class NTPAlerter(object):
                 telegraf_metrics.append(s)
         print(','.join(telegraf_metrics))
 
+    def alert_prometheus(self):
+        """
+        Produce Prometheus text format output for the metrics, with each metric as a gauge
+        """
+        families = []
+        for metric in sorted(_telegraf_types):
+            if metric in self.metrics:
+                families.append((metric, [('', self.metrics[metric])]))
+        families.append(('result', [('', self.metrics['result'])]))
+        families.append(('classification', [
+            (promlabels(metric=m), return_code_for_classification(self.mc.results[m]))
+            for m in sorted(set(self.checks)) if m in self.mc.results
+        ]))
+        families.append(('peers', [
+            (promlabels(peertype=t), self.metrics[t]) for t in sorted(_peer_types) if self.metrics.get(t) is not None
+        ]))
+        families.append(('missed_check', [
+            (promlabels(check=m[len('missed-'):]), self.metrics[m])
+            for m in sorted(self.metrics) if m.startswith('missed-')
+        ]))
+        families.extend(self.prometheus_aggregate())
+        families.extend(self.prometheus_peer_addresses())
+
+        lines = []
+        for (name, samples) in families:
+            if len(samples):
+                lines.append('# TYPE ntpmon_%s gauge' % (name,))
+                for (labels, value) in samples:
+                    lines.append('ntpmon_%s%s %s' % (name, labels, promvalue(value)))
+        print('\n'.join(lines))
+
+    def prometheus_aggregate(self):
+        """
+        Return the Prometheus metric families for peer fields sampled during the interval
+        """
+        import aggregate
+        families = [('aggregate_' + stat, []) for stat in ['count'] + aggregate.stats]
+        for field in aggregate.fields:
+            prefix = 'aggregate-%s-' % (field,)
+            if prefix + 'count' in self.metrics:
+                for (name, samples) in families:
+                    samples.append((promlabels(field=field), self.metrics[prefix + name[len('aggregate_'):]]))
+        return families
+
+    def prometheus_peer_addresses(self):
+        """
+        Return the Prometheus metric families for individual peers
+        """
+        peers = self.selectpeers()
+        families = []
+        for metric in sorted(_peer_address_types):
+            families.append(('peer_' + metric, [
+                (promlabels(address=p['address'], peertype=p['peertype']), p[metric]) for p in peers if metric in p
+            ]))
+        return families
+
     def alert_peers(self, hostname, interval, format):
         for metric in _peer_types:
             value = self.metrics.get(metric)
+            if value is None:
+                # the peers check did not complete
+                continue
             if format == 'collectd':
                 print('PUTVAL "%s/ntpmon-%s" interval=%d N:%.9f' % (
                     hostname,
@@ -286,6 +416,100 @@ class NTPAlerter(object):
             elif format == 'telegraf':
                 print('ntpmon_peers,peertype=%s count=%di' % (metric, value))
 
+    def alert_missed(self, hostname, interval, format):
+        """
+        Report which checks missed the collection deadline, if one was set
+        """
+        for metric in sorted(self.metrics):
+            if not metric.startswith('missed-'):
+                continue
+            check = metric[len('missed-'):]
+            if format == 'collectd':
+                print('PUTVAL "%s/ntpmon-missed/count-%s" interval=%d N:%d' % (
+                    hostname,
+                    check,
+                    interval,
+                    self.metrics[metric],
+                ))
+            elif format == 'telegraf':
+                print('ntpmon_missed,check=%s missed=%di' % (check, self.metrics[metric]))
+
+    def alert_aggregate(self, hostname, interval, format):
+        """
+        Report the statistics for peer fields sampled during the interval, if any
+        """
+        import aggregate
+        for field in aggregate.fields:
+            prefix = 'aggregate-%s-' % (field,)
+            if prefix + 'count' not in self.metrics:
+                continue
+            if format == 'collectd':
+                for stat in aggregate.stats:
+                    print('PUTVAL "%s/ntpmon-aggregate-%s/%s-%s" interval=%d N:%.9f' % (
+                        hostname,
+                        field,
+                        _aggregate_types[field],
+                        stat,
+                        interval,
+                        self.metrics[prefix + stat],
+                    ))
+            elif format == 'telegraf':
+                values = ['%s=%.9f' % (stat, self.metrics[prefix + stat]) for stat in aggregate.stats]
+                print('ntpmon_aggregate,field=%s count=%di,%s' % (
+                    field,
+                    self.metrics[prefix + 'count'],
+                    ','.join(values),
+                ))
+
+    def selectpeers(self):
+        """
+        Return the individual peers to report: those in the allowlist (if any),
+        preferring the sync peer and survivors, up to the peer limit
+        """
+        if self.peerlimit <= 0 or 'peers' not in self.objs:
+            return []
+        from peers import NTPPeers
+        peers = self.objs['peers'].getpeers()
+        if self.peerallow:
+            peers = [p for p in peers if p['address'] in self.peerallow]
+        peers.sort(key=lambda p: (NTPPeers.typeorder.index(p['peertype']), p['address']))
+        return peers[:self.peerlimit]
+
+    def alert_peer_addresses(self, hostname, interval, format):
+        """
+        Report the metrics of individual peers, tagged with their address, in a single write
+        """
+        import re
+        lines = []
+        for peer in self.selectpeers():
+            if format == 'collectd':
+                instance = re.sub(r'[^\w.]', '_', peer['address'])
+                for metric in sorted(_peer_address_types):
+                    if metric in peer:
+                        lines.append('PUTVAL "%s/ntpmon-peer-%s/%s-%s" interval=%d N:%.9f' % (
+                            hostname,
+                            instance,
+                            _peer_address_types[metric][0],
+                            metric,
+                            interval,
+                            peer[metric],
+                        ))
+            elif format == 'telegraf':
+                fields = []
+                for metric in sorted(_peer_address_types):
+                    if metric in peer:
+                        if _peer_address_types[metric][1] == 'i':
+                            fields.append('%s=%di' % (metric, peer[metric]))
+                        else:
+                            fields.append('%s=%.9f' % (metric, peer[metric]))
+                lines.append('ntpmon_peer,address=%s,peertype=%s %s' % (
+                    re.sub(r'([, =])', r'\\\1', peer['address']),
+                    peer['peertype'],
+                    ','.join(fields),
+                ))
+        if len(lines):
+            print('\n'.join(lines))
+
     @staticmethod
     def finished_output():
         if sys.stdout.isatty():
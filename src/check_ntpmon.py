@@ -20,12 +20,15 @@
 import argparse
 import sys
 
-from alert import NTPAlerter
-from peers import NTPPeers
-from process import ntpchecks
+from check_ntpmon_client import SOCKET
+from state import STATE_FILE, StateFile
 
 
-def get_args(checks):
+validchecks = ['proc', 'offset', 'peers', 'reach', 'reachability', 'sync', 'trace', 'vars']
+defaultchecks = ['proc', 'offset', 'peers', 'reach', 'sync', 'vars']
+
+
+def get_args(checks, argv=None):
     parser = argparse.ArgumentParser(description='NTPmon - Nagios check')
     parser.add_argument(
         '--check',
@@ -36,44 +39,111 @@ def get_args(checks):
         '--debug',
         action='store_true',
         help='Include command output and internal state dump along with check results.')
+    parser.add_argument(
+        '--max-age',
+        type=float,
+        help='Maximum age in seconds of a sample published by ntpmon which may be used instead of querying the '
+             'NTP daemon; 0 always queries it (default: twice the interval at which ntpmon reports).')
     parser.add_argument(
         '--run-time',
         default=512,
         type=int,
         help='Time in seconds (default: 512) for which to always return OK after NTP daemon startup.')
+    parser.add_argument(
+        '--serve',
+        nargs='?',
+        const=SOCKET,
+        help='Run as a server answering check requests from check_ntpmon_client.py on this Unix domain socket '
+             '(default: %s).' % (SOCKET,))
     parser.add_argument(
         '--test',
         action='store_true',
         help='Obtain peer stats on standard input instead of from running daemon.')
-    args = parser.parse_args()
+    parser.add_argument(
+        '--socket-group',
+        help='Group allowed to send requests to the --serve socket (default: the group of the server).')
+    parser.add_argument(
+        '--state-file',
+        help='File in which ntpmon publishes its latest sample (default: %s).' % (STATE_FILE,))
+    args = parser.parse_args(argv)
     return args
 
 
-def main():
-    validchecks = ['proc', 'offset', 'peers', 'reach', 'reachability', 'sync', 'trace', 'vars']
-    defaultchecks = ['proc', 'offset', 'peers', 'reach', 'sync', 'vars']
-    args = get_args(validchecks)
+def runchecks(args):
+    """
+    Run the checks selected by the arguments, print the result, and return the Nagios return code.
+    """
     if args.check is None or len(args.check) < 1:
-        args.check = defaultchecks
+        args.check = list(defaultchecks)
     else:
         # turn 'reachability' into 'reach' for backwards compatibility
         for i in range(0, len(args.check)):
             if args.check[i] == 'reachability':
                 args.check[i] = 'reach'
 
+    # modules are imported only when needed, since this runs for every NRPE check
     if args.test:
         # read from standard input in test mode
+        from peers import NTPPeers
         checkobjs = {
             'peers': NTPPeers([x.rstrip() for x in sys.stdin.readlines()]),
         }
     else:
-        # run the checks
-        checkobjs = ntpchecks(args.check, debug=args.debug)
+        checkobjs = None
+        if not args.debug and args.max_age != 0:
+            # use ntpmon's latest sample, if it is fresh
+            checkobjs = StateFile(args.state_file or STATE_FILE).load(args.check, max_age=args.max_age)
+        if checkobjs is None:
+            # run the checks
+            from process import ntpchecks
+            checkobjs = ntpchecks(args.check, debug=args.debug)
 
     # alert on what we've collected
+    from alert import NTPAlerter
     alerter = NTPAlerter(args.check)
     alerter.alert_nagios(checkobjs=checkobjs, debug=args.debug)
-    sys.exit(alerter.return_code())
+    return alerter.return_code()
+
+
+def runrequest(argv, state_file=None):
+    """
+    Run the checks for the arguments of a check server request, and return the Nagios return code.
+    Requests may only select the checks; the state file is the server's.
+    """
+    try:
+        args = get_args(validchecks, argv)
+        if args.serve or args.test or args.debug or args.socket_group is not None or args.state_file is not None:
+            print('UNKNOWN: --serve, --test, --debug, --socket-group, and --state-file cannot be passed to the '
+                  'check server')
+            return 3
+        args.state_file = state_file
+        return runchecks(args)
+    except SystemExit as se:
+        # argument errors, and fatal errors from the process module
+        return se.code if isinstance(se.code, int) else 3
+    except Exception as e:
+        print('UNKNOWN: %s' % (e,))
+        return 3
+
+
+def serve(path, group=None, state_file=None):
+    """
+    Answer check requests on the Unix domain socket until killed.
+    """
+    import checkserver
+    # load everything needed for the checks up front
+    import alert        # NOQA: F401
+    import process      # NOQA: F401
+    server = checkserver.CheckServer(path, lambda argv: runrequest(argv, state_file), group)
+    server.serve_forever()
+
+
+def main():
+    args = get_args(validchecks)
+    if args.serve:
+        serve(args.serve, args.socket_group, args.state_file)
+    else:
+        sys.exit(runchecks(args))
 
 
 if __name__ == '__main__':
@@ -0,0 +1,77 @@
+#!/usr/bin/python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+NRPE entry point for check_ntpmon.  Pass the arguments to a check_ntpmon server
+(check_ntpmon.py --serve) over its Unix domain socket, then print its output and
+exit with its return code.  If no server is listening, run check_ntpmon.py in
+place of this process.
+
+This runs for every check, so it imports as little as possible.
+"""
+
+import json
+import os
+import socket
+import sys
+
+
+SOCKET = '/run/ntpmon-check/check.sock'
+TIMEOUT = 60
+
+
+def request(argv, path=SOCKET, timeout=TIMEOUT):
+    """
+    Return the output and return code of the check server for the arguments,
+    or None if the server is not listening.
+    """
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.settimeout(timeout)
+    try:
+        sock.connect(path)
+    except OSError:
+        sock.close()
+        return None
+    try:
+        sock.sendall(json.dumps(argv).encode('utf-8') + b'\n')
+        reply = b''
+        while True:
+            data = sock.recv(65536)
+            if not data:
+                break
+            reply += data
+        reply = json.loads(reply.decode('utf-8'))
+        return (reply['output'], reply['rc'])
+    except (OSError, ValueError, KeyError) as e:
+        return ('UNKNOWN: No reply from check server %s: %s\n' % (path, e), 3)
+    finally:
+        sock.close()
+
+
+def main():
+    result = request(sys.argv[1:])
+    if result is None:
+        check = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'check_ntpmon.py')
+        os.execv(check, [check] + sys.argv[1:])
+    sys.stdout.write(result[0])
+    sys.exit(result[1])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Run check_ntpmon as a long-lived server, so that the modules used by the checks
+(and psutil's view of the process table) are loaded once rather than by every
+NRPE check.  Each request from check_ntpmon_client is a JSON list of command
+line arguments terminated by a newline; the reply is a JSON object with the
+check's output and return code.  Requests are answered one at a time, since the
+check's output is captured by replacing sys.stdout.
+"""
+
+import contextlib
+import grp
+import io
+import json
+import os
+import socketserver
+import stat
+
+
+class CheckHandler(socketserver.StreamRequestHandler):
+
+    def handle(self):
+        try:
+            argv = json.loads(self.rfile.readline().decode('utf-8'))
+        except ValueError:
+            return
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+            rc = self.server.run(argv)
+        self.wfile.write(json.dumps({'output': output.getvalue(), 'rc': rc}).encode('utf-8'))
+
+
+class CheckServer(socketserver.UnixStreamServer):
+
+    def __init__(self, path, run, group=None):
+        """
+        Listen on the Unix domain socket at path, replacing any left by a previous server.
+        run is called with each request's arguments, and returns the check's return code.
+        Only the server's user and members of group (by default, the server's group) may
+        connect to the socket.
+        """
+        if os.path.exists(path) and stat.S_ISSOCK(os.stat(path).st_mode):
+            os.unlink(path)
+        socketserver.UnixStreamServer.__init__(self, path, CheckHandler)
+        # NRPE runs checks as a different user from the server, but in its group
+        if group is not None:
+            os.chown(path, -1, grp.getgrnam(group).gr_gid)
+        os.chmod(path, 0o660)
+        self.run = run
@@ -0,0 +1,472 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Query chronyd and ntpd directly over their control protocols, and return
+structured peer records and metrics for NTPPeers and NTPVars, without running
+chronyc or ntpq and parsing their output.
+
+chronyd is queried using its command protocol (as used by chronyc), over its
+Unix domain socket if we are permitted to create our own socket beside it, or
+otherwise over UDP to localhost port 323.  ntpd is queried using the NTP mode 6
+control protocol (as used by ntpq) over UDP to localhost port 123.
+"""
+
+import ipaddress
+import os
+import random
+import socket
+import struct
+import time
+
+
+CHRONY_SOCKET = '/run/chrony/chronyd.sock'
+CHRONY_PORT = 323
+NTPD_PORT = 123
+TIMEOUT = 1.0
+
+NTP_EPOCH = 2208988800  # seconds between the NTP (1900) and Unix (1970) epochs
+
+rand = random.SystemRandom()
+
+
+class ControlError(Exception):
+    """The NTP daemon could not be queried, or returned an unusable response."""
+    pass
+
+
+def local_address(port):
+    """Return the (family, sockaddr) to use for a UDP query to localhost on the given port."""
+    return (socket.AF_INET, ('127.0.0.1', port))
+
+
+def exchange(sock, request, check, timeout=TIMEOUT):
+    """
+    Send the request (if any) on the connected socket, and return the first reply for which
+    check returns True.  Raise ControlError if no such reply arrives before the timeout.
+    """
+    deadline = time.time() + timeout
+    try:
+        if request:
+            sock.send(request)
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                raise ControlError('timed out waiting for reply')
+            sock.settimeout(remaining)
+            reply = sock.recv(4096)
+            if check(reply):
+                return reply
+    except socket.timeout:
+        raise ControlError('timed out waiting for reply')
+    except OSError as e:
+        raise ControlError(str(e))
+
+
+"""
+chronyd command protocol, from candm.h
+"""
+_chrony_version = 6
+_chrony_request = struct.Struct('!BBBBHHIII')
+_chrony_reply = struct.Struct('!BBBBHHHHHHIII')
+_chrony_source_data = struct.Struct('!16sHHhHHHHHIIII')
+_chrony_tracking = struct.Struct('!I16sHHHHIIIIIIIIIIII')
+
+# command: (request code, request data length, reply code, reply data length)
+_chrony_commands = {
+    'n_sources': (14, 0, 2, 4),
+    'source_data': (15, 4, 3, _chrony_source_data.size),
+    'tracking': (33, 0, 5, _chrony_tracking.size),
+}
+
+# source modes & states, as displayed by chronyc
+_chrony_modes = '^=#'
+_chrony_states = '*?x~+-'
+
+
+def chrony_float(f):
+    """Convert chronyd's 32-bit floating point format (7-bit exponent, 25-bit coefficient) to a float."""
+    exp = f >> 25
+    if exp >= 1 << 6:
+        exp -= 1 << 7
+    exp -= 25
+    coef = f % (1 << 25)
+    if coef >= 1 << 24:
+        coef -= 1 << 25
+    return coef * 2.0 ** exp
+
+
+def chrony_address(addr, family):
+    """Convert a chronyd IPAddr to a string, or None if it is unspecified."""
+    if family == 1:
+        return str(ipaddress.IPv4Address(addr[:4]))
+    elif family == 2:
+        return str(ipaddress.IPv6Address(addr))
+    return None
+
+
+def chrony_request(command, sequence, data=b''):
+    """
+    Return a chronyd request packet.  Requests are padded to the length of the
+    reply, as chronyd requires, so that it can't be used for traffic amplification.
+    """
+    (code, length, reply, reply_length) = _chrony_commands[command]
+    packet = _chrony_request.pack(_chrony_version, 1, 0, 0, code, 0, sequence, 0, 0) + data
+    return packet + b'\0' * (_chrony_reply.size + reply_length - len(packet))
+
+
+def chrony_reply(command, sequence, reply):
+    """Validate the chronyd reply and return its data, or raise ControlError."""
+    (code, length, reply_code, reply_length) = _chrony_commands[command]
+    if len(reply) < _chrony_reply.size + reply_length:
+        raise ControlError('chronyd reply too short')
+    (version, pkt_type, res1, res2, cmd, rpy, status, pad1, pad2, pad3,
+     seq, pad4, pad5) = _chrony_reply.unpack_from(reply)
+    if status != 0:
+        raise ControlError('chronyd returned status %d' % (status,))
+    if rpy != reply_code:
+        raise ControlError('chronyd returned reply %d, expected %d' % (rpy, reply_code))
+    return reply[_chrony_reply.size:_chrony_reply.size + reply_length]
+
+
+def chrony_matches(command, sequence):
+    """Return a function which checks whether a packet is the reply to the given request."""
+    code = _chrony_commands[command][0]
+
+    def check(reply):
+        if len(reply) < _chrony_reply.size:
+            return False
+        header = _chrony_reply.unpack_from(reply)
+        return header[1] == 2 and header[4] == code and header[10] == sequence
+
+    return check
+
+
+def chrony_query(sock, command, data=b''):
+    """Send a command to chronyd and return the reply data."""
+    sequence = rand.getrandbits(32)
+    reply = exchange(sock, chrony_request(command, sequence, data), chrony_matches(command, sequence))
+    return chrony_reply(command, sequence, reply)
+
+
+def chrony_source_record(data):
+    """
+    Convert chronyd source data to a peer record with the same fields and values as
+    NTPPeers produces from 'chronyc -c sources' output, except that the tally code
+    has not yet been converted to a peer type.
+    """
+    (addr, family, pad, poll, stratum, state, mode, flags, reach, since,
+     orig_latest_meas, latest_meas, latest_meas_err) = _chrony_source_data.unpack(data)
+    if mode == 2:
+        # reference clocks are identified by their reference ID
+        address = addr[:4].rstrip(b'\0').decode('ascii', 'replace')
+    else:
+        address = chrony_address(addr, family)
+    return {
+        'mode': _chrony_modes[mode] if mode < len(_chrony_modes) else '?',
+        'tally': _chrony_states[state] if state < len(_chrony_states) else '?',
+        'address': address,
+        'stratum': stratum,
+        'poll': 2 ** poll,
+        'reach': bin(reach & 0xff).count('1') * 100 / 8,
+        'when': since if since != 0xffffffff else '-',
+        'moffset': round(chrony_float(latest_meas), 6),
+        'offset': round(chrony_float(orig_latest_meas), 6),
+        'error': round(chrony_float(latest_meas_err), 6),
+    }
+
+
+def chrony_tracking_metrics(data):
+    """
+    Convert chronyd tracking data to the same metrics as NTPVars produces from
+    'chronyc -c tracking' output.
+    """
+    fields = _chrony_tracking.unpack(data)
+    (sec_high, sec_low, nsec) = fields[6:9]
+    if sec_high == 0x7fffffff:
+        sec_high = 0
+    floats = [chrony_float(f) for f in fields[9:]]
+    return {
+        'stratum': fields[4],
+        'systime': (sec_high << 32) + sec_low + nsec / 1e9,
+        'sysoffset': floats[0],
+        'lastoffset': floats[1],
+        'rmsoffset': floats[2],
+        'frequency': floats[3],
+        'residualfreq': floats[4],
+        'skew': floats[5],
+        'rootdelay': floats[6],
+        'rootdisp': floats[7],
+    }
+
+
+class ChronyClient(object):
+
+    def __init__(self, path=CHRONY_SOCKET, port=CHRONY_PORT):
+        """
+        Connect to chronyd's Unix domain socket if we can bind our own socket in
+        the same directory (normally only root or the chrony user can); otherwise
+        use UDP to localhost.
+        """
+        self.local = None
+        directory = os.path.dirname(path)
+        if os.path.exists(path) and os.access(directory, os.W_OK):
+            self.local = os.path.join(directory, 'ntpmon.%d.sock' % (os.getpid(),))
+            self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            try:
+                if os.path.exists(self.local):
+                    os.unlink(self.local)
+                self.sock.bind(self.local)
+                os.chmod(self.local, 0o666)
+                self.sock.connect(path)
+                return
+            except OSError:
+                self.close()
+        (family, sockaddr) = local_address(port)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.connect(sockaddr)
+
+    def close(self):
+        self.sock.close()
+        if self.local is not None:
+            try:
+                os.unlink(self.local)
+            except OSError:
+                pass
+            self.local = None
+
+    def sources(self):
+        """Return the list of source peer records."""
+        (count,) = struct.unpack('!I', chrony_query(self.sock, 'n_sources'))
+        return [chrony_source_record(chrony_query(self.sock, 'source_data', struct.pack('!i', i)))
+                for i in range(count)]
+
+    def tracking(self):
+        """Return the tracking metrics."""
+        return chrony_tracking_metrics(chrony_query(self.sock, 'tracking'))
+
+
+"""
+NTP mode 6 control protocol, from RFC 1305 appendix B and ntpd's ntp_control.c
+"""
+_mode6_header = struct.Struct('!BBHHHHH')
+_mode6_flags = (2 << 3) | 6     # LI = 0, VN = 2 (as used by ntpq), Mode = 6
+_mode6_response = 0x80
+_mode6_error = 0x40
+_mode6_more = 0x20
+_mode6_readstat = 1
+_mode6_readvar = 2
+
+# peer selection status, as displayed by ntpq
+_ntpd_tallies = ' x.-+#*o'
+
+
+def mode6_request(opcode, sequence, associd, data=b''):
+    """Return a mode 6 request packet, padded to a multiple of 4 bytes."""
+    packet = _mode6_header.pack(_mode6_flags, opcode, sequence, 0, associd, 0, len(data)) + data
+    return packet + b'\0' * (-len(packet) % 4)
+
+
+def mode6_query(sock, opcode, associd=0, timeout=TIMEOUT):
+    """
+    Send a mode 6 request to ntpd and return the reassembled response data,
+    which may arrive in several fragments.
+    """
+    sequence = rand.getrandbits(16)
+    deadline = time.time() + timeout
+    fragments = {}
+    last = None
+
+    def check(reply):
+        if len(reply) < _mode6_header.size:
+            return False
+        (flags, op, seq, status, assoc, offset, count) = _mode6_header.unpack_from(reply)
+        return flags & 0x7 == 6 and op & 0x1f == opcode and op & _mode6_response and seq == sequence
+
+    request = mode6_request(opcode, sequence, associd)
+    while True:
+        reply = exchange(sock, request, check, deadline - time.time())
+        (flags, op, seq, status, assoc, offset, count) = _mode6_header.unpack_from(reply)
+        if op & _mode6_error:
+            raise ControlError('ntpd returned error %d' % (status >> 8,))
+        fragments[offset] = reply[_mode6_header.size:_mode6_header.size + count]
+        if not op & _mode6_more:
+            last = offset + count
+        if last is not None:
+            data = mode6_reassemble(fragments, last)
+            if data is not None:
+                return data
+        # wait for the remaining fragments without resending the request
+        request = b''
+
+
+def mode6_reassemble(fragments, length):
+    """Return the data from the fragments if they are contiguous up to length, otherwise None."""
+    data = b''
+    while len(data) < length:
+        if len(data) not in fragments:
+            return None
+        data += fragments[len(data)]
+    return data
+
+
+def mode6_vars(data):
+    """Convert a mode 6 variable list to a dict of names and (unquoted) string values."""
+    text = data.decode('ascii', 'replace')
+    variables = {}
+    item = ''
+    quoted = False
+    for c in text + ',':
+        if c == '"':
+            quoted = not quoted
+        elif c == ',' and not quoted:
+            item = item.strip()
+            if len(item):
+                (name, sep, value) = item.partition('=')
+                variables[name.strip()] = value.strip()
+            item = ''
+        else:
+            item += c
+    return variables
+
+
+def ntp_time(value):
+    """Convert an ntpd hex timestamp string (e.g. 0xdda17a5b.af7c528b) to Unix time, or None."""
+    try:
+        (seconds, sep, fraction) = value.partition('.')
+        ntp = int(seconds, 16) + (int(fraction, 16) / 2 ** 32 if fraction else 0)
+    except ValueError:
+        return None
+    return ntp - NTP_EPOCH if ntp else None
+
+
+def ntpd_refid(refid):
+    """Return the refid as ntpq displays it: addresses as-is, and reference IDs between dots."""
+    try:
+        ipaddress.ip_address(refid)
+        return refid
+    except ValueError:
+        return '.%s.' % (refid,)
+
+
+def ntpd_peer_record(status, variables, now):
+    """
+    Convert the status word and variables of an ntpd association to a peer record
+    with the same fields and values as NTPPeers produces from 'ntpq -pn' output,
+    except that the tally code has not yet been converted to a peer type.
+    Return None if any of the required variables are missing.
+    """
+    try:
+        received = ntp_time(variables.get('rec', '0'))
+        return {
+            'tally': _ntpd_tallies[(status >> 8) & 0x7],
+            'address': variables['srcadr'],
+            'refid': ntpd_refid(variables['refid']),
+            'stratum': int(variables['stratum']),
+            'mode': variables.get('hmode'),
+            'when': int(now - received) if received is not None else '-',
+            'poll': 2 ** min(int(variables['ppoll']), int(variables['hpoll'])),
+            'reach': bin(int(variables['reach'], 0) & 0xff).count('1') * 100 / 8,
+            'delay': round(float(variables['delay']) / 1000.0, 6),
+            'offset': round(float(variables['offset']) / 1000.0, 6),
+            'jitter': round(float(variables['jitter']) / 1000.0, 6),
+        }
+    except (KeyError, ValueError):
+        return None
+
+
+"""
+Variables reported by 'ntpq -nc readvar' in milliseconds, and their NTPVars names
+"""
+_ntpd_var_ms = {
+    'offset': 'sysoffset',
+    'rootdelay': 'rootdelay',
+    'rootdisp': 'rootdisp',
+    'sys_jitter': 'sysjitter',
+}
+
+
+def ntpd_system_metrics(variables):
+    """Convert ntpd system variables to the same metrics as NTPVars produces from 'ntpq -nc readvar' output."""
+    metrics = {}
+    for (name, value) in variables.items():
+        try:
+            if name in _ntpd_var_ms:
+                metrics[_ntpd_var_ms[name]] = round(float(value) / 1000.0, 9)
+            else:
+                metrics[name] = float(value)
+        except ValueError:
+            # ignore non-numeric values
+            pass
+    return metrics
+
+
+class NTPdClient(object):
+
+    def __init__(self, port=NTPD_PORT):
+        (family, sockaddr) = local_address(port)
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.sock.connect(sockaddr)
+
+    def close(self):
+        self.sock.close()
+
+    def associations(self):
+        """Return a list of association ID and status word tuples."""
+        data = mode6_query(self.sock, _mode6_readstat)
+        return [struct.unpack_from('!HH', data, i) for i in range(0, len(data) - 3, 4)]
+
+    def sources(self):
+        """Return the list of peer records, excluding those ntpq -p would not display metrics for."""
+        records = []
+        now = time.time()
+        for (associd, status) in self.associations():
+            record = ntpd_peer_record(status, mode6_vars(mode6_query(self.sock, _mode6_readvar, associd)), now)
+            if record is not None:
+                records.append(record)
+        return records
+
+    def tracking(self):
+        """Return the system variable metrics."""
+        return ntpd_system_metrics(mode6_vars(mode6_query(self.sock, _mode6_readvar)))
+
+
+_clients = {
+    'chronyd': ChronyClient,
+    'ntpd': NTPdClient,
+}
+
+
+def query(implementation, prog):
+    """
+    Query the named implementation for the data normally produced by the given program
+    ('peers' or 'vars').  Return the peer records or metrics and the elapsed time in seconds.
+    Raise ControlError if the daemon can't be queried.
+    """
+    if implementation not in _clients or prog not in ['peers', 'vars']:
+        raise ControlError('no control protocol support for %s %s' % (implementation, prog))
+    start = time.time()
+    try:
+        client = _clients[implementation]()
+    except OSError as e:
+        raise ControlError(str(e))
+    try:
+        result = client.sources() if prog == 'peers' else client.tracking()
+    finally:
+        client.close()
+    return (result, time.time() - start)
@@ -0,0 +1,159 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Serve metrics to Prometheus over HTTP.
+
+A PrometheusExporter replaces sys.stdout in prometheus mode, like the sinks
+in the sink module: the metrics printed during an interval are collected in a
+buffer, and when the output is flushed at the end of the interval, the body of
+the /metrics response (plain and gzipped) and its ETag are rendered once and
+published.  Scrapes only return the latest published body, so they never cause
+any checks to be run.
+"""
+
+import gzip
+import hashlib
+import http.server
+import socket
+import socketserver
+import threading
+
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+LISTEN = ':9650'
+
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn, http.server.HTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, handler, family=socket.AF_INET):
+        # the family must be set before the socket is created
+        self.address_family = family
+        http.server.HTTPServer.__init__(self, address, handler)
+
+
+def accepts_gzip(header):
+    """
+    Return True if the Accept-Encoding header allows a gzipped response, i.e. it
+    lists gzip (or *, if gzip is not listed) with a non-zero quality value.
+    """
+    qvalues = {}
+    for item in header.split(','):
+        params = item.split(';')
+        coding = params[0].strip().lower()
+        q = 1.0
+        for param in params[1:]:
+            (name, sep, value) = param.partition('=')
+            if name.strip().lower() == 'q':
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        qvalues[coding] = q
+    for coding in ['gzip', 'x-gzip', '*']:
+        if coding in qvalues:
+            return qvalues[coding] > 0
+    return False
+
+
+class MetricsHandler(http.server.BaseHTTPRequestHandler):
+
+    def do_GET(self):
+        if self.path.split('?')[0] != '/metrics':
+            self.send_error(404)
+            return
+        # a single reference, so that we use a consistent set of values
+        (body, gzipped, etag) = self.server.exporter.published
+        if etag is not None and self.headers.get('If-None-Match') == etag:
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.end_headers()
+            return
+        usegzip = accepts_gzip(self.headers.get('Accept-Encoding', ''))
+        content = gzipped if usegzip else body
+        self.send_response(200)
+        self.send_header('Content-Type', CONTENT_TYPE)
+        self.send_header('Content-Length', str(len(content)))
+        self.send_header('Vary', 'Accept-Encoding')
+        if usegzip:
+            self.send_header('Content-Encoding', 'gzip')
+        if etag is not None:
+            self.send_header('ETag', etag)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        # don't log every scrape
+        pass
+
+
+def parse_listen(listen):
+    """Convert a [host]:port string to an address tuple; an empty host means all addresses."""
+    (host, sep, port) = listen.rpartition(':')
+    return (host.strip('[]'), int(port))
+
+
+def resolve_listen(listen):
+    """Return the address family and socket address to listen on for a [host]:port string."""
+    (host, port) = parse_listen(listen)
+    infos = socket.getaddrinfo(host or None, port, type=socket.SOCK_STREAM, flags=socket.AI_PASSIVE)
+    (family, socktype, proto, canonname, sockaddr) = infos[0]
+    return (family, sockaddr)
+
+
+class PrometheusExporter(object):
+
+    def __init__(self, listen=LISTEN):
+        """
+        Start serving metrics on the given [host]:port in a background thread.
+        Until the first interval's metrics are published, the body is empty.
+        """
+        self.buffer = []
+        self.published = (b'', gzip.compress(b''), None)
+        (family, address) = resolve_listen(listen)
+        self.server = ThreadingHTTPServer(address, MetricsHandler, family)
+        self.server.exporter = self
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        """
+        Add the string to the current interval's metrics.
+        """
+        self.buffer.append(s)
+        return len(s)
+
+    def flush(self):
+        """
+        Render and publish the current interval's metrics, if there are any.
+        """
+        if len(self.buffer) == 0:
+            return
+        body = ''.join(self.buffer).encode('utf-8')
+        self.buffer = []
+        etag = '"%s"' % (hashlib.sha1(body).hexdigest()[:16],)
+        self.published = (body, gzip.compress(body), etag)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
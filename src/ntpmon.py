@@ -23,8 +23,12 @@ import socket
 import sys
 import time
 
+import aggregate
 import alert
+import exporter
 import process
+import sink
+import state
 
 
 def get_args():
@@ -32,31 +36,87 @@ def get_args():
     parser.add_argument(
         '--mode',
         type=str,
-        choices=['collectd', 'telegraf'],
+        choices=['collectd', 'prometheus', 'telegraf'],
         help='Collectd is the default if collectd environment variables are detected.',
     )
+    parser.add_argument(
+        '--listen',
+        type=str,
+        default=exporter.LISTEN,
+        help='Address (in [host]:port format) on which to serve /metrics in prometheus mode (default: %s)' % (
+            exporter.LISTEN,),
+    )
     parser.add_argument(
         '--connect',
         type=str,
-        help='Connect string (in host:port format) to use when sending data to telegraf (default: 127.0.0.1:8094)',
+        help='Connect string to use when sending data to telegraf: host:port or tcp://host:port for TCP, '
+             'udp://host:port for UDP, unix:///path or unixgram:///path for Unix domain stream or datagram '
+             'sockets (default: 127.0.0.1:8094)',
         default='127.0.0.1:8094',
     )
+    parser.add_argument(
+        '--mtu',
+        type=int,
+        default=sink.MTU,
+        help='MTU of the network path to telegraf; UDP output is packed into datagrams which fit (default: %d)' % (
+            sink.MTU,),
+    )
     parser.add_argument(
         '--interval',
         type=int,
         help='How often to report statistics (default: the value of the COLLECTD_INTERVAL environment variable, '
              'or 60 seconds if COLLECTD_INTERVAL is not set).',
     )
+    parser.add_argument(
+        '--sample-interval',
+        type=int,
+        help='How often to sample peers between reports; if set, report the minimum, maximum, mean, median, '
+             'and 99th percentile of peer offset, delay, and jitter over each interval (default: no sampling).',
+    )
+    parser.add_argument(
+        '--peer-metrics',
+        action='store_true',
+        help='Report offset, delay, jitter, reach, and stratum for individual peers, tagged by address.',
+    )
+    parser.add_argument(
+        '--peer-limit',
+        type=int,
+        default=16,
+        help='Maximum number of individual peers to report, preferring the sync peer and survivors (default: 16).',
+    )
+    parser.add_argument(
+        '--peer-allow',
+        type=str,
+        action='append',
+        help='Only report individual peers with this address (may be given more than once; default: all peers).',
+    )
+    parser.add_argument(
+        '--state-file',
+        type=str,
+        default=state.STATE_FILE,
+        help='File to which the latest sample is published for check_ntpmon; an empty string disables it '
+             '(default: %s)' % (state.STATE_FILE,),
+    )
     args = parser.parse_args()
     return args
 
 
+DEADLINE_MARGIN = 0.1   # fraction of the interval reserved for reporting
+
+
+def interval_end(interval):
+    """
+    Return the time at the end of the current interval
+    """
+    now = time.time()
+    return now + interval - now % interval
+
+
 def sleep_until(interval):
     """
     sleep until the end of the interval
     """
-    now = time.time()
-    s = interval - now % interval
+    s = max(interval_end(interval) - time.time(), 0)
     if sys.stdout.isatty():
         print('Sleeping %g seconds' % (s,))
     time.sleep(s)
@@ -64,10 +124,24 @@ def sleep_until(interval):
         print(time.asctime())
 
 
-def main():
-    checks = ['proc', 'offset', 'peers', 'reach', 'sync', 'vars']
-    args = get_args()
+def sample_until(interval, sample_interval, aggregator, implementation):
+    """
+    sample peers every sample_interval until the end of the interval
+    """
+    end = interval_end(interval)
+    while interval_end(sample_interval) < end - DEADLINE_MARGIN * sample_interval:
+        sleep_until(sample_interval)
+        deadline = interval_end(sample_interval) - DEADLINE_MARGIN * sample_interval
+        checkobjs = process.ntpchecks(['peers'], debug=False, implementation=implementation, deadline=deadline)
+        if checkobjs is not None:
+            aggregator.add(checkobjs.get('peers'))
+    sleep_until(interval)
 
+
+def get_environment(args):
+    """
+    Override the arguments from collectd's environment variables, if present.  Return the hostname.
+    """
     if 'COLLECTD_HOSTNAME' in os.environ:
         args.mode = 'collectd'
         hostname = os.environ['COLLECTD_HOSTNAME']
@@ -82,14 +156,26 @@ def main():
     if args.interval is None:
         args.interval = 60
 
+    return hostname
+
+
+def main():
+    checks = ['proc', 'offset', 'peers', 'reach', 'sync', 'vars']
+    args = get_args()
+    hostname = get_environment(args)
+
     if args.mode == 'telegraf' and not sys.stdout.isatty():
-        (host, port) = args.connect.split(':')
-        port = int(port)
-        s = socket.socket()
-        s.connect((host, port))
-        sys.stdout = s.makefile(mode='w')
+        sys.stdout = sink.open_sink(args.connect, args.mtu)
+    elif args.mode == 'prometheus':
+        sys.stdout = exporter.PrometheusExporter(args.listen)
 
-    alerter = alert.NTPAlerter(checks)
+    aggregator = None
+    if args.sample_interval is not None and 0 < args.sample_interval < args.interval:
+        aggregator = aggregate.NTPAggregator()
+
+    alerter = alert.NTPAlerter(checks, peerlimit=args.peer_limit if args.peer_metrics else 0,
+                               peerallow=args.peer_allow)
+    statefile = state.StateFile(args.state_file) if args.state_file else None
     implementation = None
     while True:
         # cache implementation for the lifetime of ntpmon
@@ -97,12 +183,23 @@ def main():
             implementation = process.detect_implementation()
 
         if implementation:
-            # run the checks
-            checkobjs = process.ntpchecks(checks, debug=False, implementation=implementation)
+            # run the checks, allowing them until shortly before the end of the interval
+            deadline = interval_end(args.interval) - DEADLINE_MARGIN * args.interval
+            checkobjs = process.ntpchecks(checks, debug=False, implementation=implementation, deadline=deadline)
+            if aggregator is not None:
+                # include this sample, and report the whole interval's samples
+                aggregator.add(checkobjs.get('peers'))
+                checkobjs['aggregate'] = aggregator
             # alert on what we've collected
             alerter.alert(checkobjs=checkobjs, hostname=hostname, interval=args.interval, format=args.mode)
-
-        sleep_until(args.interval)
+            if statefile is not None:
+                statefile.publish(alerter, args.interval)
+
+        if aggregator is not None and implementation:
+            aggregator.reset()
+            sample_until(args.interval, args.sample_interval, aggregator, implementation)
+        else:
+            sleep_until(args.interval)
 
 
 if __name__ == '__main__':
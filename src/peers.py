@@ -18,36 +18,164 @@
 #
 
 """
-Parse 'ntpq -pn' or 'chronyc -c sources' output and extract metrics.
+Parse 'ntpq -pn' or 'chronyc -c sources' output (or the equivalent records
+obtained directly from the NTP daemon by the control module) and extract metrics.
 """
 
+import array
 import math
 import re
-import statistics
 import sys
 
 
-class NTPPeers():
+def summarise(values):
+    """
+    Return the mean, population standard deviation, and root mean square of the
+    list of values, or NaNs if there are none.
+    """
+    n = len(values)
+    if n == 0:
+        return (float('nan'),) * 3
+    mean = math.fsum(values) / n
+    stdev = math.sqrt(math.fsum((x - mean) ** 2 for x in values) / n)
+    rms = math.sqrt(math.fsum(x * x for x in values) / n)
+    return (mean, stdev, rms)
 
-    @staticmethod
-    def getmean(l):
+
+class RunningStats(object):
+
+    def __init__(self):
         """
-        Get the mean of the values in the list, or NaN if there is none.
+        Accumulate the count, mean, sum of squared differences from the mean (M2),
+        and sum of squares of a series of values in one pass, using Welford's method.
         """
-        if len(l) > 0:
-            return statistics.mean(l)
-        else:
-            return float('nan')
+        self.count = 0
+        self.mean = 0.0
+        self.m2 = 0.0
+        self.sumsq = 0.0
+
+    def add(self, x):
+        self.count += 1
+        delta = x - self.mean
+        self.mean += delta / self.count
+        self.m2 += delta * (x - self.mean)
+        self.sumsq += x * x
+
+    def merge(self, other):
+        """
+        Combine the statistics of another series of values into this one.
+        """
+        count = self.count + other.count
+        if count == 0:
+            return
+        delta = other.mean - self.mean
+        self.mean += delta * other.count / count
+        self.m2 += other.m2 + delta * delta * self.count * other.count / count
+        self.sumsq += other.sumsq
+        self.count = count
+
+    def summary(self):
+        """
+        Return the mean, population standard deviation, and root mean square of the
+        values added, or NaNs if there are none.
+        """
+        if self.count == 0:
+            return (float('nan'),) * 3
+        return (self.mean, math.sqrt(self.m2 / self.count), math.sqrt(self.sumsq / self.count))
 
-    @staticmethod
-    def getstdev(l, mean):
+
+class NTPPeerTable(object):
+
+    """
+    Numeric peer fields, stored in columns of doubles; fields which an
+    implementation doesn't report (e.g. chrony has no jitter) are NaN.
+    """
+    floatfields = ['delay', 'error', 'jitter', 'moffset', 'offset', 'reach']
+
+    """
+    Fields for which running statistics are kept for each peer type
+    """
+    statsfields = ['offset', 'reach']
+
+    def __init__(self):
         """
-        Get the standard deviation of the values in the list, or NaN if there is none.
+        Create an empty table.  Each row holds one peer, and a bitmask of all the
+        peer types it belongs to, so that no peer is stored more than once.
+        Counts and running statistics are kept for each distinct bitmask.
         """
-        if len(l) > 0:
-            return statistics.pstdev(l, mean)
-        else:
-            return float('nan')
+        self.address = []
+        self.stratum = array.array('i')
+        self.types = array.array('H')
+        self.columns = dict((f, array.array('d')) for f in self.floatfields)
+        self.counts = {}
+        self.stats = {}
+
+    def __len__(self):
+        return len(self.types)
+
+    def append(self, peer, types):
+        """
+        Add a validated peer, belonging to the peer types in the bitmask.
+        """
+        nan = float('nan')
+        self.address.append(peer['address'])
+        self.stratum.append(peer['stratum'])
+        self.types.append(types)
+        for f in self.floatfields:
+            self.columns[f].append(peer.get(f, nan))
+
+        # update the count & running statistics of peers with the same combination of types
+        if types not in self.stats:
+            self.counts[types] = 0
+            self.stats[types] = dict((f, RunningStats()) for f in self.statsfields)
+        self.counts[types] += 1
+        for f in self.statsfields:
+            if f in peer and not math.isnan(peer[f]):
+                self.stats[types][f].add(peer[f])
+
+    def rows(self, mask):
+        """
+        Return the indexes of the rows matching the peer type mask.
+        """
+        return [i for (i, types) in enumerate(self.types) if types & mask]
+
+    def column(self, field, mask):
+        """
+        Return the list of values of the field for the peers matching the type mask, omitting missing values.
+        """
+        if field == 'address':
+            return [self.address[i] for i in self.rows(mask)]
+        elif field == 'stratum':
+            return [self.stratum[i] for i in self.rows(mask)]
+        values = self.columns[field]
+        return [values[i] for i in self.rows(mask) if not math.isnan(values[i])]
+
+    def count(self, mask):
+        """
+        Return the number of peers matching the type mask.
+        """
+        return len(self.rows(mask))
+
+    def typecount(self, bit):
+        """
+        Return the number of peers of the type represented by the bit.
+        """
+        return sum(self.counts[types] for types in self.counts if types & bit)
+
+    def typesummary(self, field, bit):
+        """
+        Return the mean, standard deviation, and root mean square of the field for
+        peers of the type represented by the bit, by combining the running statistics
+        of each combination of types which includes it.
+        """
+        stats = RunningStats()
+        for types in self.stats:
+            if types & bit:
+                stats.merge(self.stats[types][field])
+        return stats.summary()
+
+
+class NTPPeers():
 
     @staticmethod
     def time2seconds(t):
@@ -65,17 +193,6 @@ class NTPPeers():
         else:
             return int(t)
 
-    @staticmethod
-    def rms(l):
-        """
-        Return the root mean square of the values in the list, or NaN if there is none.
-        """
-        if len(l) > 0:
-            squares = [x ** 2 for x in l]
-            return math.sqrt(statistics.mean(squares))
-        else:
-            return float('nan')
-
     """
     List of peer types by tally code
     For more information, see:
@@ -96,80 +213,98 @@ class NTPPeers():
         'all': '',
     }
 
+    """
+    Peer types of previously-seen single-character tally codes
+    """
+    _tallies = {}
+
     @classmethod
     def tallytotype(cls, s):
         """
         Convert the given tally code string to a peer type.
         Return 'unknown' if it doesn't match any known tally code.
         """
+        if s in cls._tallies:
+            return cls._tallies[s]
+        result = 'unknown'
         for peertype in cls.peertypes:
             if s in cls.peertypes[peertype]:
-                return peertype
-        return 'unknown'
+                result = peertype
+                break
+        if len(s) <= 1:
+            cls._tallies[s] = result
+        return result
 
     noiselines = (
         r'^=*$',    # matches blank lines as well as headers
         r'remote\s+refid\s+st\s+t\s+when\s+poll\s+reach\s+',
         r'No association ID.s returned',
     )
+    _noise = re.compile('|'.join('(?:%s)' % (regex,) for regex in noiselines))
 
     @classmethod
     def isnoiseline(cls, line):
         """
         Return true if the line is known to be non-interesting.
         """
-        for regex in cls.noiselines:
-            if re.search(regex, line) is not None:
-                return True
-        return False
+        return cls._noise.search(line) is not None
 
     @classmethod
     def peerline(cls, line):
         """
-        Return a list containing the peer type and the 10 peer fields,
-        if the line is a correctly-formatted peer line.
+        Return a dict containing the peer type and the 10 peer fields, converted to
+        numeric values in seconds, if the line is a correctly-formatted peer line.
         """
-        if cls.isnoiseline(line):
+        if cls._noise.search(line) is not None:
             return None
 
         # 10 comma-separated fields are chronyc
-        fields = line.split(',')
-        if len(fields) == 10:
-            fields = cls.chrony_peerline(fields)
-            if fields:
-                return cls.validate_peerfields(fields, False)
-            else:
-                return None
+        if ',' in line:
+            fields = line.split(',')
+            if len(fields) == 10:
+                return cls.chrony_peerline(fields)
 
         # 10 space-separated fields are ntpq
         fields = line[1:].split()
         if len(fields) == 10:
-            fields = cls.ntpd_peerline(line[0], fields)
-            if fields:
-                return cls.validate_peerfields(fields, True)
-            else:
-                return None
+            return cls.ntpd_peerline(line[0], fields)
 
         # Anything else is an error
         return None
 
+    @staticmethod
+    def reachpercent(reach):
+        """
+        Convert the octal reachability string to the percentage of polls which succeeded.
+        """
+        return bin(int(reach, 8)).count('1') * 100 / 8
+
     @classmethod
     def chrony_peerline(cls, fields):
-        """Convert chrony peer line to named fields"""
-        if len(fields) != 10:
+        """Convert and validate chrony peer fields; return None if they are invalid"""
+        (mode, tally, address, stratum, poll_pow2, reach, when, moffset, offset, error) = fields
+        peertype = cls.tallytotype(tally)
+        if peertype == 'unknown':
+            return None
+        try:
+            stratum = int(stratum)
+            if stratum < 0 or stratum > 15:
+                return None
+            return {
+                'mode': mode,
+                'tally': peertype,
+                'address': address,
+                'stratum': stratum,
+                'poll_pow2': poll_pow2,
+                'poll': 2 ** int(poll_pow2),
+                'reach': cls.reachpercent(reach),
+                'when': when if when == '-' else cls.time2seconds(when),
+                'moffset': round(float(moffset), 6),
+                'offset': round(float(offset), 6),
+                'error': round(float(error), 6),
+            }
+        except ValueError:
             return None
-        return {
-            'mode': fields[0],
-            'tally': fields[1],
-            'address': fields[2],
-            'stratum': fields[3],
-            'poll_pow2': fields[4],
-            'reach': fields[5],
-            'when': fields[6],
-            'moffset': fields[7],
-            'offset': fields[8],
-            'error': fields[9],
-        }
 
     ignorerefids = (
         '.INIT.',
@@ -181,122 +316,33 @@ class NTPPeers():
 
     @classmethod
     def ntpd_peerline(cls, tally, fields):
-        """Convert ntpd peer line to named fields"""
-        if len(fields) != 10:
-            return None
-        if fields[1] in cls.ignorerefids:
+        """Convert and validate ntpd peer fields, converting times from milliseconds to seconds;
+        return None if they are invalid"""
+        (address, refid, stratum, mode, when, poll, reach, delay, offset, jitter) = fields
+        if refid in cls.ignorerefids:
             return None
-        return {
-            'tally': tally,
-            'address': fields[0],
-            'refid': fields[1],
-            'stratum': fields[2],
-            'mode': fields[3],
-            'when': fields[4],
-            'poll': fields[5],
-            'reach': fields[6],
-            'delay': fields[7],
-            'offset': fields[8],
-            'jitter': fields[9],
-        }
-
-    @classmethod
-    def validate_tally(cls, fields):
-        peertype = cls.tallytotype(fields['tally'])
+        peertype = cls.tallytotype(tally)
         if peertype == 'unknown':
-            # Unknown peer tally code
-            return False
-        else:
-            fields['tally'] = peertype
-        return True
-
-    @classmethod
-    def validate_stratum(cls, fields):
-        # stratum should be an integer between 0 & 15
-        try:
-            fields['stratum'] = int(fields['stratum'])
-            if fields['stratum'] < 0 or fields['stratum'] > 15:
-                # stratum out of bounds
-                return False
-        except ValueError:
-            # stratum not an integer
-            return False
-        return True
-
-    @classmethod
-    def validate_when(cls, fields):
-        # when should be an integer or '-'
-        try:
-            if fields['when'] != '-':
-                fields['when'] = NTPPeers.time2seconds(fields['when'])
-        except ValueError:
-            # last poll time not an integer
-            return False
-        return True
-
-    @classmethod
-    def validate_poll(cls, fields):
-        # poll should be an integer in seconds
-        if 'poll_pow2' in fields:
-            try:
-                fields['poll'] = 2 ** int(fields['poll_pow2'])
-            except ValueError:
-                # poll interval not an integer
-                return False
-        try:
-            fields['poll'] = int(fields['poll'])
-        except ValueError:
-            # poll interval not an integer
-            return False
-        return True
-
-    @classmethod
-    def validate_reach(cls, fields):
-        # reachability should be octal
+            return None
         try:
-            # convert from octal string to integer
-            fields['reach'] = int(fields['reach'], 8)
-            # convert integer to binary, count the # of 1s (maximum 8), convert to a percentage
-            fields['reach'] = bin(fields['reach']).count('1') * 100 / 8
+            stratum = int(stratum)
+            if stratum < 0 or stratum > 15:
+                return None
+            return {
+                'tally': peertype,
+                'address': address,
+                'refid': refid,
+                'stratum': stratum,
+                'mode': mode,
+                'when': when if when == '-' else cls.time2seconds(when),
+                'poll': int(poll),
+                'reach': cls.reachpercent(reach),
+                'delay': round(float(delay) / 1000.0, 6),
+                'offset': round(float(offset) / 1000.0, 6),
+                'jitter': round(float(jitter) / 1000.0, 6),
+            }
         except ValueError:
-            # reachability not an octal value
-            return False
-        return True
-
-    @classmethod
-    def validate_floats(cls, fields, convert_to_seconds):
-        for i in ['offset', 'moffset', 'delay', 'jitter', 'error']:
-            try:
-                if i in fields:
-                    if convert_to_seconds:
-                        fields[i] = float(fields[i]) / 1000.0
-                    else:
-                        fields[i] = float(fields[i])
-                    # TODO: Do we really want to limit to microsecond accuracy?
-                    # ISTR this was only here to work around python float limitations in the test suite.
-                    fields[i] = round(fields[i], 6)
-            except ValueError:
-                # not numeric
-                return False
-        return True
-
-    @classmethod
-    def validate_peerfields(cls, fields, convert_to_seconds):
-        """Validate the supplied peer fields; if convert_to_seconds is True, convert
-        offset, delay, moffset, error, and jitter from milliseconds to seconds."""
-        if not cls.validate_tally(fields):
-            return None
-        if not cls.validate_stratum(fields):
-            return None
-        if not cls.validate_when(fields):
-            return None
-        if not cls.validate_poll(fields):
-            return None
-        if not cls.validate_reach(fields):
-            return None
-        if not cls.validate_floats(fields, convert_to_seconds):
             return None
-        return fields
 
     peerfields = [
         'address',
@@ -309,90 +355,188 @@ class NTPPeers():
         'stratum',
     ]
 
+    """
+    Bits representing each peer type in NTPPeerTable rows
+    """
+    typebits = dict((t, 1 << i) for (i, t) in enumerate(sorted(peertypes)))
+
     @classmethod
-    def appendpeer(cls, peers, peer):
+    def typemask(cls, peertype):
         """
-        Append the fields from the peer record to the equivalent lists in the peer type dict entry.
+        Return the bitmask of all the types a peer of the given type belongs to.
         """
-        for f in cls.peerfields:
-            if f in peer:
-                peers[peer['tally']][f].append(peer[f])
+        mask = cls.typebits[peertype] | cls.typebits['all']
+        # the pps peer is also a sync peer
+        if peertype == 'pps':
+            mask |= cls.typebits['sync']
+            peertype = 'sync'
+        # the sync & pps peers are also survivors
+        if peertype == 'sync':
+            mask |= cls.typebits['survivor']
+        return mask
 
     @classmethod
-    def newpeerdict(cls):
+    def peerdict(cls, table):
         """
-        Create a dict with an empty entry for each peer type and an empty array for each type's metrics.
+        Return a dict containing a list of each field's values for each peer type in the table.
         """
         peers = {}
         for t in cls.peertypes:
             peers[t] = {}
             for f in cls.peerfields:
-                peers[t][f] = []
+                peers[t][f] = table.column(f, cls.typebits[t])
         return peers
 
     @classmethod
-    def parse(cls, lines):
+    def parsetable(cls, lines):
         """
-        Return a dictionary of peers, parsed from the provided lines.
+        Return a table of peers, parsed from the provided lines.
         """
-        peers = cls.newpeerdict()
+        table = NTPPeerTable()
         if isinstance(lines, str):
             lines = lines.split('\n')
         for l in lines:
             peer = cls.peerline(l)
-            if not peer:
-                continue
-
-            cls.appendpeer(peers, peer)
-            # the pps peer is also a sync peer
-            if peer['tally'] == 'pps':
-                peer['tally'] = 'sync'
-                cls.appendpeer(peers, peer)
-
-            # the sync & pps peers are also survivors
-            if peer['tally'] == 'sync':
-                peer['tally'] = 'survivor'
-                cls.appendpeer(peers, peer)
-
-            # also append the line to the all peer type
-            peer['tally'] = 'all'
-            cls.appendpeer(peers, peer)
-        return peers
+            if peer:
+                table.append(peer, cls.typemask(peer['tally']))
+        return table
+
+    @classmethod
+    def recordpeer(cls, record):
+        """Return a copy of the peer record with its tally code converted to a peer type
+        and its stratum to an integer, or None if either is invalid"""
+        if record.get('refid') in cls.ignorerefids:
+            return None
+        peertype = cls.tallytotype(record['tally'])
+        if peertype == 'unknown':
+            return None
+        try:
+            stratum = int(record['stratum'])
+        except ValueError:
+            return None
+        if stratum < 0 or stratum > 15:
+            return None
+        peer = dict(record)
+        peer['tally'] = peertype
+        peer['stratum'] = stratum
+        return peer
+
+    @classmethod
+    def recordtable(cls, records):
+        """
+        Return a table of peers from the provided peer records, as returned by
+        control.query(), which need only have their tally codes and strata validated.
+        """
+        table = NTPPeerTable()
+        for record in records:
+            peer = cls.recordpeer(record)
+            if peer:
+                table.append(peer, cls.typemask(peer['tally']))
+        return table
+
+    @classmethod
+    def parse(cls, lines):
+        """
+        Return a dictionary of peers, parsed from the provided lines.
+        """
+        return cls.peerdict(cls.parsetable(lines))
+
+    @classmethod
+    def parserecords(cls, records):
+        """
+        Return a dictionary of peers from the provided peer records.
+        """
+        return cls.peerdict(cls.recordtable(records))
+
+    @property
+    def peers(self):
+        """
+        The dict of lists of each field for each peer type, created on first use.
+        """
+        if self._peers is None:
+            self._peers = self.peerdict(self.table)
+        return self._peers
+
+    @staticmethod
+    def addmetrics(metrics, t, count, offset, reach):
+        """
+        Add the metrics for peer type t, given its count and the summaries of its offset and reachability.
+        """
+        # number of peers of this type
+        metrics[t] = count
+
+        # offset of peers of this type
+        (metrics[t + '-offset-mean'], metrics[t + '-offset-stdev'], metrics[t + '-offset-rms']) = offset
+
+        # reachability of peers of this type
+        # The rms of reachability is not very useful, because it's always positive
+        # (so it should be very close to the mean), but we include it for completeness.
+        (metrics[t + '-reach-mean'], metrics[t + '-reach-stdev'], metrics[t + '-reach-rms']) = reach
 
     def getmetrics(self, peers=None):
         """
         Return a set of metrics based on the data in peers.
-        If peers is None, use self.peers.
+        If peers is None, use the running statistics accumulated as the peers were parsed.
         """
-        if peers is None:
-            peers = self.peers
         metrics = {}
         for t in NTPPeers.peertypes:
-            # number of peers of this type
-            metrics[t] = len(peers[t]['address'])
+            if peers is None:
+                bit = NTPPeers.typebits[t]
+                self.addmetrics(metrics, t, self.table.typecount(bit),
+                                self.table.typesummary('offset', bit), self.table.typesummary('reach', bit))
+            else:
+                self.addmetrics(metrics, t, len(peers[t]['address']),
+                                summarise(peers[t]['offset']), summarise(peers[t]['reach']))
+        return metrics
 
-            # offset of peers of this type
-            metrics[t + '-offset-mean'] = NTPPeers.getmean(peers[t]['offset'])
-            metrics[t + '-offset-stdev'] = NTPPeers.getstdev(peers[t]['offset'], metrics[t + '-offset-mean'])
-            metrics[t + '-offset-rms'] = NTPPeers.rms(peers[t]['offset'])
+    """
+    Peer types in order of preference, used to identify a peer's own type from its bitmask
+    """
+    typeorder = ['pps', 'sync', 'survivor', 'backup', 'outlier', 'excess', 'false', 'invalid']
 
-            # reachability of peers of this type
-            metrics[t + '-reach-mean'] = NTPPeers.getmean(peers[t]['reach'])
-            metrics[t + '-reach-stdev'] = NTPPeers.getstdev(peers[t]['reach'], metrics[t + '-reach-mean'])
-            # The rms of reachability is not very useful, because it's always positive
-            # (so it should be very close to the mean), but we include it for completeness.
-            metrics[t + '-reach-rms'] = NTPPeers.rms(peers[t]['reach'])
+    @classmethod
+    def rowtype(cls, types):
+        """
+        Return the peer's own type (rather than the types it is also counted as) from its bitmask.
+        """
+        for t in cls.typeorder:
+            if types & cls.typebits[t]:
+                return t
+        return 'unknown'
 
-        return metrics
+    def getpeers(self):
+        """
+        Return a list of dicts containing the address, type, stratum, and numeric fields
+        (in seconds or percent) of each peer, omitting fields the implementation doesn't report.
+        """
+        result = []
+        for (i, types) in enumerate(self.table.types):
+            peer = {
+                'address': self.table.address[i],
+                'peertype': self.rowtype(types),
+                'stratum': self.table.stratum[i],
+            }
+            for f in NTPPeerTable.floatfields:
+                value = self.table.columns[f][i]
+                if not math.isnan(value):
+                    peer[f] = value
+            result.append(peer)
+        return result
 
     def syncpeer(self):
-        try:
-            return self.peers['sync']['address'][0]
-        except Exception:
-            return None
+        rows = self.table.rows(NTPPeers.typebits['sync'])
+        return self.table.address[rows[0]] if len(rows) else None
 
-    def __init__(self, lines, elapsed=0):
-        self.peers = self.parse(lines)
+    def __init__(self, lines, elapsed=0, records=None):
+        """
+        Parse the given command output lines, or if records is not None,
+        use the peer records obtained directly from the NTP daemon.
+        """
+        if records is not None:
+            self.table = self.recordtable(records)
+        else:
+            self.table = self.parsetable(lines)
+        self._peers = None
         self.elapsed = elapsed      # unused at present
 
 
@@ -17,15 +17,14 @@
 # this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
+import concurrent.futures
 import subprocess
 import sys
 import time
 
 import psutil
 
-from peers import NTPPeers
-from trace import NTPTrace
-from readvar import NTPVars
+from procindex import ProcessIndex
 
 
 _progs = {
@@ -118,15 +117,71 @@ def execute(prog, timeout=30, debug=False, errfatal=False, implementation=None):
         return [output.split('\n'), elapsed]
 
 
+def query(prog, debug=False, implementation=None):
+    """
+    Query the NTP daemon directly for the data normally produced by the given program.
+    Return the records or metrics and the elapsed time in seconds, or None if the
+    daemon could not be queried, in which case the program should be executed instead.
+    """
+    import control
+    try:
+        (result, elapsed) = control.query(implementation, prog)
+    except control.ControlError as ce:
+        if debug:
+            print('%s %s query failed: %s' % (implementation, prog, ce))
+        return None
+    if debug:
+        print(result)
+        print('elapsed time: %.3f seconds' % (elapsed,))
+    return (result, elapsed)
+
+
 def fatal(msg):
     print('UNKNOWN: ' + msg)
     sys.exit(3)
 
 
-def ntpchecks(checks, debug, implementation=None):
+TIMEOUT = 30    # default timeout for each check, in seconds
+
+"""
+Checks which are satisfied by running the peers command
+"""
+_peer_checks = ['offset', 'peers', 'reach', 'sync']
+
+
+def runcheck(check, debug, implementation, timeout):
     """
-    Run all of the checks required by the argument list
+    Run the command or query needed for a single check, and return the resulting object.
+    Each check's parser is imported only when the check is run.
+    """
+    if check == 'peers':
+        from peers import NTPPeers
+        result = query('peers', debug=debug, implementation=implementation)
+        if result is not None:
+            return NTPPeers(None, result[1], records=result[0])
+        (output, elapsed) = execute('peers', timeout=timeout, debug=debug, implementation=implementation)
+        return NTPPeers(output, elapsed)
+    elif check == 'trace':
+        from trace import NTPTrace
+        (output, elapsed) = execute('trace', timeout=timeout, debug=debug, implementation=implementation)
+        return NTPTrace(output, elapsed)
+    elif check == 'vars':
+        from readvar import NTPVars
+        result = query('vars', debug=debug, implementation=implementation)
+        if result is not None:
+            return NTPVars(None, result[1], metrics=result[0])
+        (output, elapsed) = execute('vars', timeout=timeout, debug=debug, implementation=implementation)
+        return NTPVars(output, elapsed)
+
+
+def ntpchecks(checks, debug, implementation=None, deadline=None):
+    """
+    Run all of the checks required by the argument list concurrently
     and return the resulting objects in a hash.
+
+    If deadline (a time in seconds since the epoch) is supplied, return at the
+    deadline with whichever checks have completed, and report the checks which
+    missed the deadline in an NTPMissed object.
     """
     objs = {}
 
@@ -135,27 +190,64 @@ def ntpchecks(checks, debug, implementation=None):
         if implementation is None:
             return None
 
-    for check in checks:
-        if ((check in ['offset', 'peers', 'reach', 'sync'])
-                and 'peers' not in objs):
-            (output, elapsed) = execute('peers', debug=debug, implementation=implementation)
-            objs['peers'] = NTPPeers(output, elapsed)
-            break
-
     if 'proc' in checks:
         objs['proc'] = NTPProcess()
 
-    if 'trace' in checks:
-        (output, elapsed) = execute('trace', debug=debug, implementation=implementation)
-        objs['trace'] = NTPTrace(output, elapsed)
-
-    if 'vars' in checks:
-        (output, elapsed) = execute('vars', debug=debug, implementation=implementation)
-        objs['vars'] = NTPVars(output, elapsed)
+    pending = []
+    if any(check in _peer_checks for check in checks):
+        pending.append('peers')
+    pending.extend(check for check in ['trace', 'vars'] if check in checks)
+    if len(pending) == 0:
+        return objs
+
+    timeout = TIMEOUT if deadline is None else max(deadline - time.time(), 0)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(pending))
+    futures = dict((executor.submit(runcheck, check, debug, implementation, timeout), check) for check in pending)
+    (done, notdone) = concurrent.futures.wait(futures, timeout=None if deadline is None else timeout)
+    # don't wait for stragglers; their commands time out at the deadline anyway
+    executor.shutdown(wait=False)
+
+    for future in done:
+        objs[futures[future]] = future.result()
+    if deadline is not None:
+        objs['missed'] = NTPMissed(pending, [futures[future] for future in notdone])
+        if debug and len(notdone):
+            print('checks missed deadline: %s' % (', '.join(sorted(objs['missed'].missed)),))
 
     return objs
 
 
+class NTPMissed(object):
+
+    def __init__(self, checks, missed):
+        """
+        Record which of the checks run missed their deadline.
+        """
+        self.checks = checks
+        self.missed = missed
+
+    def getmetrics(self):
+        metrics = {'missed': len(self.missed)}
+        for check in self.checks:
+            metrics['missed-' + check] = 1 if check in self.missed else 0
+        return metrics
+
+
+"""
+Process indexes for each list of process names, shared by all NTPProcess objects
+for the lifetime of ntpmon, so that the process table is not scanned every interval.
+"""
+_indexes = {}
+
+
+def get_index(names):
+    """Return the shared ProcessIndex for the given list of process names."""
+    key = tuple(names)
+    if key not in _indexes:
+        _indexes[key] = ProcessIndex(dict((n, lambda name, n=n: name == n) for n in names))
+    return _indexes[key]
+
+
 class NTPProcess(object):
 
     def __init__(self, names=None):
@@ -166,22 +258,24 @@ class NTPProcess(object):
             self.names = ['chronyd', 'ntpd']
         else:
             self.names = names
+        self.name = None
         # Check for old psutil per http://grodola.blogspot.com.au/2014/01/psutil-20-porting.html
         self.PSUTIL2 = psutil.version_info >= (2, 0)
 
     def getprocess(self):
         """
-        Search the process table for a matching process name.
+        Find a process with a matching name, preferring names earlier in the list.
         Return the psutil process object.
         """
-        for proc in psutil.process_iter():
-            try:
-                name = proc.name() if self.PSUTIL2 else proc.name
-                if name in self.names:
-                    self.name = name
-                    return proc
-            except psutil.Error:
-                pass
+        pids = get_index(self.names).getpids()
+        for name in self.names:
+            if name in pids:
+                try:
+                    proc = psutil.Process(pids[name])
+                except psutil.Error:
+                    continue
+                self.name = name
+                return proc
         return None
 
     def getruntime(self):
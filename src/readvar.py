@@ -18,7 +18,8 @@
 #
 
 """
-Parse 'chronyc -c tracking' or 'ntpq -nc readvar' output and extract metrics.
+Parse 'chronyc -c tracking' or 'ntpq -nc readvar' output (or use the equivalent
+metrics obtained directly from the NTP daemon by the control module).
 """
 
 
@@ -68,7 +69,16 @@ def parse_ntpd_vars(vars):
 
 class NTPVars(object):
 
-    def __init__(self, lines=None, elapsed=0):
+    def __init__(self, lines=None, elapsed=0, metrics=None):
+        """
+        Parse the given command output lines, or if metrics is not None,
+        use the metrics obtained directly from the NTP daemon.
+        """
+        if metrics is not None:
+            self.metrics = dict(metrics)
+            self.metrics['varstime'] = elapsed
+            return
+
         if not isinstance(lines, str):
             # multiple lines - join them
             lines = " ".join(lines)
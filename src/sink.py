@@ -0,0 +1,280 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Buffered output of metrics to telegraf (or other collectors), which survives
+collector restarts.
+
+A sink replaces sys.stdout: everything printed during an interval is collected
+in a buffer, and sent when the output is flushed at the end of the interval.
+
+Stream sinks (TCP or Unix domain stream sockets) queue the buffer and send all
+queued intervals in a single write.  If the connection fails, ntpmon keeps
+running; the queued intervals (up to a limit, discarding the oldest) are sent
+after reconnecting, with exponential backoff between connection attempts.
+Lines which were sent before a failure are not sent again.
+
+Datagram sinks (UDP or Unix domain datagram sockets) are fire-and-forget: each
+interval's lines are packed into as few datagrams as fit within the MTU, and
+are not resent if they are lost.
+"""
+
+import collections
+import socket
+import sys
+import time
+
+
+BACKOFF_MIN = 1         # seconds before the first reconnection attempt
+BACKOFF_MAX = 300       # maximum seconds between reconnection attempts
+CONNECT_TIMEOUT = 5
+MAX_QUEUE = 60          # intervals of output kept while telegraf is unavailable
+MTU = 1500
+
+"""
+Bytes of IP & UDP headers to allow for in each datagram
+"""
+_header_sizes = {
+    socket.AF_INET: 20 + 8,
+    socket.AF_INET6: 40 + 8,
+}
+
+
+def log(msg):
+    print(msg, file=sys.stderr)
+
+
+class TCPSink(object):
+
+    def __init__(self, host, port, max_queue=MAX_QUEUE):
+        self.address = (host, port)
+        self.buffer = []
+        self.queue = collections.deque(maxlen=max_queue)
+        self.sock = None
+        self.backoff = BACKOFF_MIN
+        self.retry_at = 0
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        """
+        Add the string to the current interval's output.
+        """
+        self.buffer.append(s)
+        return len(s)
+
+    def flush(self):
+        """
+        Queue the current interval's output, and send everything queued if we can.
+        """
+        if len(self.buffer):
+            if len(self.queue) == self.queue.maxlen:
+                log('Output queue full; discarding oldest interval')
+            self.queue.append(''.join(self.buffer))
+            self.buffer = []
+        self.send()
+
+    def connect(self):
+        """
+        Return a new connection to the destination.
+        """
+        return socket.create_connection(self.address, timeout=CONNECT_TIMEOUT)
+
+    def send(self):
+        """
+        Send all queued intervals in one write, connecting first if necessary.
+        On failure, keep them queued and back off before reconnecting.
+        """
+        if len(self.queue) == 0:
+            return
+        now = time.time()
+        if self.sock is not None and not self.alive():
+            # telegraf has closed the connection since the last interval
+            self.close()
+        if self.sock is None:
+            if now < self.retry_at:
+                return
+            try:
+                self.sock = self.connect()
+            except OSError as e:
+                self.failed(now, 'Cannot connect to %s: %s' % (self.describe(), e))
+                return
+        data = ''.join(self.queue).encode('utf-8')
+        sent = 0
+        try:
+            view = memoryview(data)
+            while sent < len(data):
+                sent += self.sock.send(view[sent:])
+        except OSError as e:
+            self.close()
+            self.unsent(data, sent)
+            self.failed(now, 'Cannot send to %s: %s' % (self.describe(), e))
+            return
+        self.queue.clear()
+        self.backoff = BACKOFF_MIN
+
+    def unsent(self, data, sent):
+        """
+        Replace the queue with the data which was not sent before a failure, so that it
+        is not duplicated when it is resent.  A partly-sent line is resent in full,
+        since the collector discards the incomplete line when the connection closes.
+        """
+        start = data.rfind(b'\n', 0, sent) + 1
+        self.queue.clear()
+        if start < len(data):
+            self.queue.append(data[start:].decode('utf-8'))
+
+    def alive(self):
+        """
+        Return False if the other end has closed the connection.  Without this check,
+        the first write after telegraf restarts would appear to succeed, but be lost.
+        """
+        try:
+            self.sock.settimeout(0)
+            return self.sock.recv(1, socket.MSG_PEEK) != b''
+        except BlockingIOError:
+            return True
+        except OSError:
+            return False
+        finally:
+            if self.sock is not None:
+                self.sock.settimeout(CONNECT_TIMEOUT)
+
+    def failed(self, now, msg):
+        """
+        Log the failure, and schedule the next connection attempt.
+        """
+        log('%s; %d intervals queued, retrying in %d seconds' % (msg, len(self.queue), self.backoff))
+        self.retry_at = now + self.backoff
+        self.backoff = min(self.backoff * 2, BACKOFF_MAX)
+
+    def describe(self):
+        return '%s:%d' % self.address
+
+    def close(self):
+        if self.sock is not None:
+            try:
+                self.sock.close()
+            except OSError:
+                pass
+            self.sock = None
+
+
+class UnixSink(TCPSink):
+
+    def __init__(self, path, max_queue=MAX_QUEUE):
+        TCPSink.__init__(self, None, None, max_queue)
+        self.address = path
+
+    def connect(self):
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock.settimeout(CONNECT_TIMEOUT)
+        try:
+            sock.connect(self.address)
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    def describe(self):
+        return self.address
+
+
+def pack(lines, size):
+    """
+    Pack the list of lines (as bytes) into as few datagrams of at most size bytes as possible,
+    without splitting lines.  Lines longer than size are sent in a datagram of their own.
+    """
+    datagrams = []
+    current = b''
+    for line in lines:
+        if len(current) and len(current) + len(line) > size:
+            datagrams.append(current)
+            current = b''
+        current += line
+    if len(current):
+        datagrams.append(current)
+    return datagrams
+
+
+class DatagramSink(object):
+
+    def __init__(self, family, address, mtu=MTU):
+        self.family = family
+        self.address = address
+        self.size = mtu - _header_sizes.get(family, 0)
+        self.buffer = []
+        self.sock = socket.socket(family, socket.SOCK_DGRAM)
+        self.failing = False
+
+    def isatty(self):
+        return False
+
+    def write(self, s):
+        """
+        Add the string to the current interval's output.
+        """
+        self.buffer.append(s)
+        return len(s)
+
+    def flush(self):
+        """
+        Send the current interval's output, packed into datagrams.  Errors are logged
+        (once until sending succeeds again) and the output is discarded.
+        """
+        lines = ''.join(self.buffer).encode('utf-8').splitlines(keepends=True)
+        self.buffer = []
+        if len(lines) == 0:
+            return
+        try:
+            for datagram in pack(lines, self.size):
+                self.sock.sendto(datagram, self.address)
+            self.failing = False
+        except OSError as e:
+            if not self.failing:
+                log('Cannot send to %s: %s' % (self.address, e))
+            self.failing = True
+
+    def close(self):
+        self.sock.close()
+
+
+def open_sink(connect, mtu=MTU):
+    """
+    Return a sink for the connect string, which may be host:port or tcp://host:port
+    (TCP), udp://host:port, unix:///path (stream), or unixgram:///path (datagram).
+    """
+    (scheme, sep, address) = connect.partition('://')
+    if not sep:
+        (scheme, address) = ('tcp', connect)
+    if scheme == 'unix':
+        return UnixSink(address)
+    elif scheme == 'unixgram':
+        return DatagramSink(socket.AF_UNIX, address, mtu)
+    elif scheme not in ('tcp', 'udp'):
+        raise ValueError('Unsupported connect string %s' % (connect,))
+
+    (host, sep, port) = address.rpartition(':')
+    if not sep:
+        raise ValueError('No port in connect string %s' % (connect,))
+    host = host.strip('[]')
+    if scheme == 'tcp':
+        return TCPSink(host, int(port))
+    (family, socktype, proto, canonname, sockaddr) = socket.getaddrinfo(host, int(port), type=socket.SOCK_DGRAM)[0]
+    return DatagramSink(family, sockaddr, mtu)
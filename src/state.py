@@ -0,0 +1,167 @@
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Share ntpmon's latest sample with check_ntpmon.
+
+After reporting each interval, ntpmon publishes the metrics of each check
+object, their classifications, and the details needed for the Nagios messages
+to a small JSON file, replacing it atomically.  check_ntpmon answers from that
+file while it is fresh and covers the requested checks, rather than scanning
+the process table and querying the NTP daemon itself.
+"""
+
+import json
+import os
+import sys
+import time
+
+
+STATE_FILE = '/run/ntpmon/state.json'
+
+"""
+The check object needed for each check
+"""
+_check_objs = {
+    'offset': 'peers',
+    'peers': 'peers',
+    'proc': 'proc',
+    'reach': 'peers',
+    'sync': 'peers',
+    'trace': 'trace',
+    'vars': 'vars',
+}
+
+"""
+Check objects which are published; the others only make sense within ntpmon
+"""
+_published_objs = ['peers', 'proc', 'vars']
+
+
+class StoredCheck(object):
+
+    def __init__(self, metrics):
+        self.metrics = metrics
+
+    def getmetrics(self):
+        return self.metrics
+
+
+class StoredProcess(StoredCheck):
+
+    def __init__(self, metrics, name):
+        StoredCheck.__init__(self, metrics)
+        self.name = name
+
+    def getruntime(self):
+        return self.metrics['runtime']
+
+
+class StoredPeers(StoredCheck):
+
+    def __init__(self, metrics, syncpeer):
+        StoredCheck.__init__(self, metrics)
+        self.sync = syncpeer
+
+    def syncpeer(self):
+        return self.sync
+
+
+class StateFile(object):
+
+    def __init__(self, path=STATE_FILE):
+        self.path = path
+        self.failing = False
+
+    def publish(self, alerter, interval, now=None):
+        """
+        Atomically replace the state file with the alerter's latest metrics.  Errors
+        are logged (once until publishing succeeds again); ntpmon keeps running.
+        """
+        objs = dict((o, alerter.objmetrics[o]) for o in _published_objs if o in alerter.objmetrics)
+        state = {
+            'time': time.time() if now is None else now,
+            'interval': interval,
+            'objs': objs,
+            'classification': alerter.mc.results,
+        }
+        if 'proc' in objs:
+            state['proc'] = alerter.objs['proc'].name
+        if 'peers' in objs:
+            state['syncpeer'] = alerter.objs['peers'].syncpeer()
+        try:
+            self.write(json.dumps(state, sort_keys=True))
+            self.failing = False
+        except OSError as e:
+            if not self.failing:
+                print('Cannot publish state to %s: %s' % (self.path, e), file=sys.stderr)
+            self.failing = True
+
+    def write(self, data):
+        """
+        Write the data to a temporary file in the same directory, then rename it into
+        place, so that readers see either the previous sample or this one in full.
+        """
+        import tempfile
+        (fd, tmp) = tempfile.mkstemp(dir=os.path.dirname(self.path), prefix='.state.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                f.write(data)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+
+    def load(self, checks, max_age=None, now=None):
+        """
+        Return check objects for the given checks from the state file, or None if it
+        is missing, older than max_age seconds (by default, two of ntpmon's intervals),
+        or does not include all of the checks.
+        """
+        try:
+            with open(self.path) as f:
+                state = json.load(f)
+        except (OSError, ValueError):
+            return None
+        if now is None:
+            now = time.time()
+        age = now - state['time']
+        if max_age is None:
+            max_age = 2 * state['interval']
+        if not 0 <= age <= max_age:
+            return None
+
+        objs = state['objs']
+        needed = set(_check_objs.get(c) for c in checks)
+        if not needed.issubset(objs):
+            return None
+
+        checkobjs = {}
+        for o in needed:
+            if o == 'proc':
+                metrics = objs['proc']
+                if metrics['runtime'] >= 0:
+                    # the daemon has kept running since the sample, if it is still fresh
+                    metrics['runtime'] += age
+                checkobjs[o] = StoredProcess(metrics, state.get('proc'))
+            elif o == 'peers':
+                checkobjs[o] = StoredPeers(objs['peers'], state.get('syncpeer'))
+            else:
+                checkobjs[o] = StoredCheck(objs[o])
+        return checkobjs
@@ -0,0 +1,65 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measure the import time (using python -X importtime) of check_ntpmon when it
+answers from ntpmon's published sample, and exit with an error if the best of
+several runs exceeds the budget.  Usage:
+python3 unit_tests/bench_check_startup.py [budget in milliseconds] [runs]
+"""
+
+import os
+import sys
+import tempfile
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(topdir, 'src'))
+sys.path.append(os.path.join(topdir, 'unit_tests'))
+
+from test_check_startup import importtimes, publish_state     # NOQA: E402
+
+
+BUDGET = 40     # milliseconds of imports, excluding the interpreter's own start-up modules
+
+
+def bench(path, runs):
+    """Return the total import time in ms of the fastest run, and the import times of its top-level modules."""
+    # modules imported by the interpreter itself, before check_ntpmon starts
+    startup_modules = importtimes(['-c', 'pass'])[2]
+    best = None
+    for i in range(runs):
+        (output, times, toplevel) = importtimes(['check_ntpmon.py', '--state-file', path, '--check', 'offset'])
+        total = sum(times[m] for m in toplevel if m not in startup_modules) / 1000
+        if best is None or total < best[0]:
+            best = (total, dict((m, times[m]) for m in toplevel if m not in startup_modules))
+    return best
+
+
+if __name__ == '__main__':
+    budget = float(sys.argv[1]) if len(sys.argv) > 1 else BUDGET
+    runs = int(sys.argv[2]) if len(sys.argv) > 2 else 5
+    with tempfile.TemporaryDirectory() as d:
+        path = os.path.join(d, 'state.json')
+        publish_state(path)
+        (total, times) = bench(path, runs)
+    for m in sorted(times, key=times.get, reverse=True)[:10]:
+        print('%-24s %8.3f ms' % (m, times[m] / 1000))
+    print('%-24s %8.3f ms (budget %g ms)' % ('total', total, budget))
+    if total > budget:
+        sys.exit(1)
@@ -0,0 +1,116 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+"""
+Measure NTPPeers parsing throughput over the testdata/OK corpus and the
+test_peers fixtures, and compare the time to produce metrics for each sample
+using the running statistics with the statistics module over the lists of
+each peer type.  Usage: python3 unit_tests/bench_peers.py [seconds]
+"""
+
+import glob
+import math
+import os
+import statistics
+import sys
+import time
+
+topdir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(os.path.join(topdir, 'src'))
+sys.path.append(os.path.join(topdir, 'unit_tests'))
+
+import test_peers                   # NOQA: E402
+from peers import NTPPeers          # NOQA: E402
+
+
+def corpus():
+    """Return a dict of corpus names and their lists of lines."""
+    texts = {'testdata/OK': []}
+    for name in sorted(glob.glob(os.path.join(topdir, 'testdata', 'OK', '*'))):
+        with open(name) as f:
+            texts['testdata/OK'].extend(f.read().split('\n'))
+    texts['test_peers'] = [line for t in list(test_peers.testdata) + [test_peers.alllines] for line in t.split('\n')]
+    return texts
+
+
+def bench(lines, seconds):
+    """Parse the lines repeatedly for the given time; return the throughput in lines per second."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        NTPPeers.parse(lines)
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return count * len(lines) / elapsed
+
+
+def statistics_metrics(peers):
+    """Return the peer metrics calculated over the lists of each peer type, using the statistics module."""
+    metrics = {}
+    for t in NTPPeers.peertypes:
+        metrics[t] = len(peers[t]['address'])
+        for f in ['offset', 'reach']:
+            values = peers[t][f]
+            if len(values) == 0:
+                (mean, stdev, rms) = (float('nan'),) * 3
+            else:
+                mean = statistics.mean(values)
+                stdev = statistics.pstdev(values, mean)
+                rms = math.sqrt(statistics.mean([x * x for x in values]))
+            metrics['%s-%s-mean' % (t, f)] = mean
+            metrics['%s-%s-stdev' % (t, f)] = stdev
+            metrics['%s-%s-rms' % (t, f)] = rms
+    return metrics
+
+
+def timeit(func, seconds):
+    """Call func repeatedly for the given time; return the mean time per call in seconds."""
+    count = 0
+    start = time.perf_counter()
+    while True:
+        func()
+        count += 1
+        elapsed = time.perf_counter() - start
+        if elapsed >= seconds:
+            return elapsed / count
+
+
+def bench_metrics(lines, seconds):
+    """
+    Return the time per sample in seconds to parse the lines and produce metrics using the running
+    statistics, the time using the statistics module, and the largest difference between their metrics.
+    """
+    running = timeit(lambda: NTPPeers(lines).getmetrics(), seconds)
+    legacy = timeit(lambda: statistics_metrics(NTPPeers.parse(lines)), seconds)
+    a = NTPPeers(lines).getmetrics()
+    b = statistics_metrics(NTPPeers.parse(lines))
+    diff = max(abs(a[m] - b[m]) for m in a if a[m] == a[m])
+    return (running, legacy, diff)
+
+
+if __name__ == '__main__':
+    seconds = float(sys.argv[1]) if len(sys.argv) > 1 else 2
+    texts = corpus()
+    for name in sorted(texts):
+        print('%-12s %6d lines %12.0f lines/s' % (name, len(texts[name]), bench(texts[name], seconds)))
+    for name in sorted(texts):
+        (running, legacy, diff) = bench_metrics(texts[name], seconds)
+        print('%-12s metrics: running %.3f ms/sample, statistics module %.3f ms/sample, max difference %g' % (
+            name, running * 1000, legacy * 1000, diff))
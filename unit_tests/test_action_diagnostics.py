@@ -7,8 +7,11 @@ import sys
 
 # This is necessary to stop charmhelpers.contrib.templating.jinja (called from ntp_implementation,
 # called from diagnostics) from trying to install apt packages, by giving it an existing jinja2 module.
-# The templating engine isn't required for these tests.
-sys.modules['jinja2'] = mock.MagicMock()
+# The templating engine isn't required for these tests, but the real one is used by other tests if present.
+try:
+    import jinja2  # NOQA: F401
+except ImportError:
+    sys.modules['jinja2'] = mock.MagicMock()
 
 sys.path.append('actions')
 import diagnostics      # NOQA: E402
@@ -150,13 +153,19 @@ class TestNTPActionDiagnostics(unittest.TestCase):
         elif spec == '/var/log/chrony/*.log':
             return ['/var/log/chrony/measurements.log']
 
+    @mock.patch('ntp_host_facts.describe_facts')
     @mock.patch('os.path.exists')
     @mock.patch('glob.glob')
     @mock.patch('subprocess.check_output')
     @mock.patch('ntp_implementation.detect_implementation')
-    def test_collect_actions_known_implementation(self, detect_implementation, check_output, glob, exists):
+    def test_collect_actions_known_implementation(self, detect_implementation, check_output, glob, exists,
+                                                  describe_facts):
         """Test overall action collection if chrony is the detected implementation."""
         detect_implementation.return_value = 'chrony'
+        describe_facts.return_value = {
+            'lsb-release': 'DISTRIB_RELEASE=18.04 (60s old, collected in 0.001s)',
+            'virtual': 'kvm (60s old, collected in 0.002s)',
+        }
         glob.side_effect = self._fake_glob_known_implementation
         exists.return_value = True
         check_output.return_value = b'check_output fake output\n\n'
@@ -164,6 +173,7 @@ class TestNTPActionDiagnostics(unittest.TestCase):
         result = dict(diagnostics.collect_actions())
 
         self.assertEqual(detect_implementation.call_count, 1)
+        describe_facts.assert_called_once_with()
 
         glob.assert_has_calls([
             mock.call('/sys/devices/system/clocksource/clocksource*/*_clocksource'),
@@ -188,6 +198,8 @@ class TestNTPActionDiagnostics(unittest.TestCase):
         self.assertEqual(result, {
             'kernel.release': os.uname().release,
             'kernel.clocksource0.current': 'check_output fake output',
+            'host-facts.lsb-release': 'DISTRIB_RELEASE=18.04 (60s old, collected in 0.001s)',
+            'host-facts.virtual': 'kvm (60s old, collected in 0.002s)',
             'ntp.implementation': 'chrony',
             'ntp.sources': 'check_output fake output',
             'ntp.tracking': 'check_output fake output',
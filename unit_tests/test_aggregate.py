@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import unittest
+
+from aggregate import NTPAggregator, percentile
+from peers import NTPPeers
+
+
+def peers(*offsets):
+    """Return an NTPPeers object with a sync peer and survivors at the given offsets (in milliseconds)."""
+    lines = []
+    for (i, offset) in enumerate(offsets):
+        lines.append('%s10.0.0.%d      10.1.1.1      2 u   17   64  377    0.500   %.3f   0.100' % (
+            '*' if i == 0 else '+', i + 1, offset))
+    # an outlier, which is not aggregated
+    lines.append('-10.0.0.99     10.1.1.1      2 u   17   64  377    0.500   100.000   0.100')
+    return NTPPeers(lines)
+
+
+class TestAggregate(unittest.TestCase):
+
+    def test_percentile(self):
+        values = list(range(1, 101))
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 0), 1)
+        self.assertEqual(percentile([5], 99), 5)
+
+    def test_aggregate(self):
+        aggregator = NTPAggregator()
+        self.assertEqual(aggregator.getmetrics(), {'aggregate-samples': 0})
+        aggregator.add(peers(1, 2))
+        aggregator.add(None)
+        aggregator.add(peers(-3, 50))
+        metrics = aggregator.getmetrics()
+        self.assertEqual(metrics['aggregate-samples'], 2)
+        self.assertEqual(metrics['aggregate-offset-count'], 4)
+        self.assertEqual(metrics['aggregate-offset-min'], -0.003)
+        self.assertEqual(metrics['aggregate-offset-max'], 0.05)
+        self.assertAlmostEqual(metrics['aggregate-offset-mean'], 0.0125)
+        self.assertEqual(metrics['aggregate-offset-p50'], 0.001)
+        self.assertEqual(metrics['aggregate-offset-p99'], 0.05)
+        self.assertEqual(metrics['aggregate-delay-max'], 0.0005)
+        self.assertEqual(metrics['aggregate-jitter-mean'], 0.0001)
+
+        aggregator.reset()
+        self.assertEqual(aggregator.getmetrics(), {'aggregate-samples': 0})
+
+
+if __name__ == '__main__':
+    unittest.main()
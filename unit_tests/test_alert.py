@@ -0,0 +1,74 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import io
+import unittest
+
+from alert import NTPAlerter
+from peers import NTPPeers
+
+peerlines = """-10.0.0.4        10.1.1.1      2 u   17   64  377    0.500   -1.000   0.100
++10.0.0.3        10.1.1.1      2 u   17   64  377    0.500    2.000   0.100
++10.0.0.2        10.1.1.1      3 u   17   64  377    0.500    3.000   0.100
+*10.0.0.1        10.1.1.1      2 u   17   64  376    0.500    4.000   0.100"""
+
+
+class TestNTPAlerter(unittest.TestCase):
+
+    def alert(self, alerter, format):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            alerter.alert({'peers': NTPPeers(peerlines)}, hostname='h', interval=60, format=format)
+        return [line for line in output.getvalue().split('\n') if 'ntpmon_peer,' in line or 'ntpmon-peer-' in line]
+
+    def test_peer_metrics_disabled(self):
+        self.assertEqual(self.alert(NTPAlerter(['offset']), 'telegraf'), [])
+
+    def test_peer_metrics_limit(self):
+        lines = self.alert(NTPAlerter(['offset'], peerlimit=3), 'telegraf')
+        self.assertEqual(lines, [
+            'ntpmon_peer,address=10.0.0.1,peertype=sync delay=0.000500000,jitter=0.000100000,'
+            'offset=0.004000000,reach=87.500000000,stratum=2i',
+            'ntpmon_peer,address=10.0.0.2,peertype=survivor delay=0.000500000,jitter=0.000100000,'
+            'offset=0.003000000,reach=100.000000000,stratum=3i',
+            'ntpmon_peer,address=10.0.0.3,peertype=survivor delay=0.000500000,jitter=0.000100000,'
+            'offset=0.002000000,reach=100.000000000,stratum=2i',
+        ])
+
+    def test_peer_metrics_allow(self):
+        lines = self.alert(NTPAlerter(['offset'], peerlimit=3, peerallow=['10.0.0.4']), 'collectd')
+        self.assertEqual(len(lines), 5)
+        self.assertIn('PUTVAL "h/ntpmon-peer-10.0.0.4/time_offset-offset" interval=60 N:-0.001000000', lines)
+
+    def test_prometheus(self):
+        output = io.StringIO()
+        with contextlib.redirect_stdout(output):
+            NTPAlerter(['offset', 'peers', 'sync']).alert(
+                {'peers': NTPPeers(peerlines)}, hostname='h', interval=60, format='prometheus')
+        lines = output.getvalue().split('\n')
+        self.assertIn('# TYPE ntpmon_offset gauge', lines)
+        self.assertIn('ntpmon_peers{peertype="survivor"} 3.0', lines)
+        self.assertIn('ntpmon_classification{metric="sync"} 0.0', lines)
+        self.assertIn('ntpmon_result 0.0', lines)
+        self.assertFalse(any(line.startswith('ntpmon_peer_') for line in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
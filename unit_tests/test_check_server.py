@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import grp
+import io
+import os
+import stat
+import tempfile
+import threading
+import unittest
+
+import check_ntpmon
+import check_ntpmon_client
+from checkserver import CheckServer
+from test_check_startup import importtimes, publish_state
+
+
+class TestCheckServer(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.socket = os.path.join(self.dir.name, 'check.sock')
+        self.statefile = os.path.join(self.dir.name, 'state.json')
+        publish_state(self.statefile)
+        # a socket left behind by a previous server is replaced
+        open(self.socket, 'w').close()
+        os.unlink(self.socket)
+        self.group = grp.getgrgid(os.getgid()).gr_name
+        self.server = CheckServer(self.socket, lambda argv: check_ntpmon.runrequest(argv, self.statefile), self.group)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.dir.cleanup()
+
+    def request(self, *args):
+        return check_ntpmon_client.request(list(args), path=self.socket)
+
+    def test_same_result(self):
+        st = os.stat(self.socket)
+        self.assertEqual(stat.S_IMODE(st.st_mode), 0o660)
+        self.assertEqual(grp.getgrgid(st.st_gid).gr_name, self.group)
+        for checks in [['offset'], ['sync', 'reachability'], ['peers']]:
+            output = io.StringIO()
+            with contextlib.redirect_stdout(output):
+                args = check_ntpmon.get_args(check_ntpmon.validchecks, ['--state-file', self.statefile, '--check'] +
+                                             checks)
+                rc = check_ntpmon.runchecks(args)
+            self.assertEqual(self.request('--check', *checks), (output.getvalue(), rc))
+
+    def test_repeated_requests(self):
+        # the derived runtime check is not added to the default checks each time
+        first = self.request('--max-age', '0', '--check', 'offset')
+        self.assertEqual(self.request('--max-age', '0', '--check', 'offset'), first)
+        self.assertEqual(check_ntpmon.defaultchecks, ['proc', 'offset', 'peers', 'reach', 'sync', 'vars'])
+
+    def test_invalid_requests(self):
+        (output, rc) = self.request('--check', 'nonexistent')
+        self.assertEqual(rc, 2)
+        self.assertIn('invalid choice', output)
+        # only the checks may be selected
+        for args in [['--test'], ['--debug'], ['--serve'], ['--socket-group', self.group],
+                     ['--state-file', self.statefile]]:
+            (output, rc) = self.request(*args)
+            self.assertEqual(rc, 3, args)
+            self.assertTrue(output.startswith('UNKNOWN: '), args)
+
+    def test_client_imports(self):
+        (output, times, toplevel) = importtimes(['-c', 'import check_ntpmon_client'])
+        self.assertEqual([m for m in ['alert', 'argparse', 'check_ntpmon', 'state'] if m in times], [])
+
+    def test_no_server(self):
+        self.assertIsNone(check_ntpmon_client.request([], path=os.path.join(self.dir.name, 'missing')))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import io
+import os
+import subprocess
+import sys
+import tempfile
+import unittest
+
+from alert import NTPAlerter
+from peers import NTPPeers
+from state import StateFile
+
+srcdir = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'src')
+
+peerlines = """+10.0.0.3        10.1.1.1      2 u   17   64  377    0.500    2.000   0.100
+*10.0.0.1        10.1.1.1      2 u   17   64  376    0.500    4.000   0.100"""
+
+"""
+Modules which check_ntpmon must not import when it answers from ntpmon's sample
+"""
+slow_modules = ['aggregate', 'concurrent.futures', 'control', 'peers', 'pprint', 'process', 'psutil',
+                'readvar', 'statistics', 'subprocess', 'tempfile', 'trace']
+
+
+def publish_state(path):
+    """Publish a sample of the offset, peers, reach, and sync checks to the state file."""
+    alerter = NTPAlerter(['offset', 'peers', 'reach', 'sync'])
+    with contextlib.redirect_stdout(io.StringIO()):
+        alerter.alert({'peers': NTPPeers(peerlines)}, hostname='h', interval=60, format='telegraf')
+    StateFile(path).publish(alerter, 60)
+
+
+def importtimes(args):
+    """
+    Run python -X importtime with the arguments in the src directory.  Return its output,
+    a dict of the cumulative import time in microseconds of each module, and the list of
+    top-level modules (those not imported by another module).
+    """
+    proc = subprocess.run([sys.executable, '-X', 'importtime'] + args, cwd=srcdir, stdout=subprocess.PIPE,
+                          stderr=subprocess.PIPE, universal_newlines=True)
+    times = {}
+    toplevel = []
+    for line in proc.stderr.split('\n'):
+        fields = line.split('|')
+        if line.startswith('import time:') and fields[1].strip().isdigit():
+            name = fields[2].strip()
+            times[name] = int(fields[1])
+            if not fields[2].startswith('  '):
+                toplevel.append(name)
+    return (proc.stdout, times, toplevel)
+
+
+class TestCheckStartup(unittest.TestCase):
+
+    def test_state_imports(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'state.json')
+            publish_state(path)
+            args = ['check_ntpmon.py', '--state-file', path, '--check', 'offset', 'sync']
+            (output, times, toplevel) = importtimes(args)
+        self.assertTrue(output.startswith('OK: '), output)
+        self.assertIn('alert', times)
+        self.assertEqual([m for m in slow_modules if m in times], [])
+
+    def test_process_imports(self):
+        # each check's parser is imported only when it runs
+        (output, times, toplevel) = importtimes(['-c', 'import process'])
+        self.assertIn('psutil', times)
+        self.assertEqual([m for m in ['control', 'peers', 'readvar', 'trace'] if m in times], [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,219 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import socket
+import struct
+import threading
+import unittest
+
+import control
+from peers import NTPPeers
+from readvar import NTPVars
+
+
+def encode_float(x):
+    """Encode x in chronyd's floating point format with a fixed exponent of -20."""
+    return (5 << 25) | (int(round(x * 2 ** 20)) % (1 << 25))
+
+
+class FakeServer(object):
+    """Answer UDP requests on localhost using the supplied handler until closed."""
+
+    def __init__(self, handler):
+        self.handler = handler
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.sock.bind(('127.0.0.1', 0))
+        self.port = self.sock.getsockname()[1]
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self):
+        while True:
+            try:
+                (data, addr) = self.sock.recvfrom(4096)
+            except OSError:
+                return
+            for reply in self.handler(data):
+                self.sock.sendto(reply, addr)
+
+    def close(self):
+        self.sock.close()
+
+
+sources = [
+    # addr, family, poll, stratum, state, mode, reach, since, offset
+    (socket.inet_aton('10.0.0.1'), 1, 6, 2, 0, 0, 0o377, 17, -0.000125),
+    (socket.inet_pton(socket.AF_INET6, '2001:db8::1'), 2, 7, 3, 4, 0, 0o17, 100, 0.0025),
+    (socket.inet_aton('10.0.0.2'), 1, 6, 2, 1, 0, 0, 0xffffffff, 0.0),
+]
+
+
+def chrony_handler(data):
+    (version, pkt_type, res1, res2, command, attempt, sequence, pad1, pad2) = \
+        control._chrony_request.unpack_from(data)
+    for name in control._chrony_commands:
+        if control._chrony_commands[name][0] == command:
+            reply_code = control._chrony_commands[name][2]
+            break
+    if command == 14:
+        body = struct.pack('!I', len(sources))
+    elif command == 15:
+        (index,) = struct.unpack_from('!i', data, control._chrony_request.size)
+        (addr, family, poll, stratum, state, mode, reach, since, offset) = sources[index]
+        body = control._chrony_source_data.pack(
+            addr.ljust(16, b'\0'), family, 0, poll, stratum, state, mode, 0, reach, since,
+            encode_float(offset), encode_float(offset), encode_float(0.001))
+    else:
+        floats = [encode_float(x) for x in [0.00001, -0.00002, 0.00003, -1.5, 0.001, 0.01, 0.0234, 0.0012, 64]]
+        address = socket.inet_aton('10.0.0.1').ljust(16, b'\0')
+        body = control._chrony_tracking.pack(0x0a000001, address, 1, 0, 2, 0, 0x7fffffff, 1500000000, 500000000,
+                                             *floats)
+    header = control._chrony_reply.pack(6, 2, 0, 0, command, reply_code, 0, 0, 0, 0, sequence, 0, 0)
+    # send an unrelated packet first, to check that it is ignored
+    yield control._chrony_reply.pack(6, 2, 0, 0, command, reply_code, 0, 0, 0, 0, sequence ^ 1, 0, 0) + body
+    yield header + body
+
+
+associations = {
+    1: (0x9614, b'srcadr=10.0.0.1, srcport=123, refid=10.1.1.1, stratum=2, hmode=3, ppoll=6, hpoll=7, '
+                b'reach=0xff, rec=0x00000000.00000000, delay=1.250, offset=-0.125, jitter=0.050'),
+    2: (0x8011, b'srcadr=10.0.0.2, refid=INIT, stratum=16, hmode=3, ppoll=6, hpoll=6, reach=0x00, '
+                b'delay=0.000, offset=0.000, jitter=0.000'),
+    3: (0x9414, b'srcadr=10.0.0.3, refid=GPS, stratum=1, hmode=3, ppoll=6, hpoll=6, reach=0x0f, '
+                b'delay=2.000, offset=0.500, jitter=0.100'),
+}
+system = b'version="ntpd 4.2.8p10@1.3728-o (1)", leap=00, stratum=2, rootdelay=1.234, rootdisp=20.5, ' \
+         b'refid=10.0.0.1, offset=-0.125, frequency=-12.5, sys_jitter=0.25, clk_jitter=0.1'
+
+
+def ntpd_handler(data):
+    (flags, opcode, sequence, status, associd, offset, count) = control._mode6_header.unpack_from(data)
+    if opcode == control._mode6_readstat:
+        body = b''.join(struct.pack('!HH', a, associations[a][0]) for a in sorted(associations))
+    elif associd == 0:
+        body = system
+    else:
+        body = associations[associd][1]
+    # send the response in fragments of 64 bytes, last fragment first
+    fragments = []
+    for start in range(0, len(body), 64):
+        chunk = body[start:start + 64]
+        more = control._mode6_more if start + 64 < len(body) else 0
+        fragments.append(control._mode6_header.pack(
+            flags, opcode | control._mode6_response | more, sequence, 0, associd, start, len(chunk)) + chunk)
+    return reversed(fragments)
+
+
+class TestControl(unittest.TestCase):
+
+    def test_chrony_float(self):
+        for x in [0, 1, -1, 0.5, -0.000125, 12.75]:
+            self.assertAlmostEqual(control.chrony_float(encode_float(x)), x, places=6)
+        # 1.0 with the largest and smallest exponents
+        self.assertEqual(control.chrony_float((63 << 25) | 1), 2.0 ** 38)
+        self.assertEqual(control.chrony_float((64 << 25) | 1), 2.0 ** -89)
+
+    def test_chrony_request_padding(self):
+        for command in control._chrony_commands:
+            request = control.chrony_request(command, 1)
+            self.assertEqual(len(request), control._chrony_reply.size + control._chrony_commands[command][3])
+
+    def test_chrony_query(self):
+        server = FakeServer(chrony_handler)
+        try:
+            client = control.ChronyClient(path='/nonexistent/chronyd.sock', port=server.port)
+            records = client.sources()
+            tracking = client.tracking()
+            client.close()
+        finally:
+            server.close()
+
+        self.assertEqual([r['address'] for r in records], ['10.0.0.1', '2001:db8::1', '10.0.0.2'])
+        self.assertEqual([r['tally'] for r in records], ['*', '+', '?'])
+        self.assertEqual([r['reach'] for r in records], [100, 50, 0])
+        self.assertEqual([r['poll'] for r in records], [64, 128, 64])
+        self.assertEqual([r['when'] for r in records], [17, 100, '-'])
+        self.assertEqual([r['offset'] for r in records], [-0.000125, 0.0025, 0])
+
+        peers = NTPPeers(None, records=records)
+        self.assertEqual(peers.syncpeer(), '10.0.0.1')
+        metrics = peers.getmetrics()
+        self.assertEqual(metrics['all'], 3)
+        self.assertEqual(metrics['survivor'], 2)
+        self.assertEqual(metrics['invalid'], 1)
+
+        self.assertEqual(tracking['stratum'], 2)
+        self.assertAlmostEqual(tracking['systime'], 1500000000.5)
+        self.assertAlmostEqual(tracking['frequency'], -1.5, places=6)
+        self.assertAlmostEqual(tracking['rootdelay'], 0.0234, places=6)
+        self.assertEqual(NTPVars(None, 0.5, metrics=tracking).getmetrics()['varstime'], 0.5)
+
+    def test_mode6_vars(self):
+        self.assertEqual(
+            control.mode6_vars(b'version="ntpd 4.2.8, with commas", leap=00,\r\nstratum=2, flag'),
+            {'version': 'ntpd 4.2.8, with commas', 'leap': '00', 'stratum': '2', 'flag': ''})
+
+    def test_ntp_time(self):
+        self.assertIsNone(control.ntp_time('0x00000000.00000000'))
+        self.assertIsNone(control.ntp_time('junk'))
+        self.assertEqual(control.ntp_time('0x83aa7e80.80000000'), 0.5)
+
+    def test_ntpd_query(self):
+        server = FakeServer(ntpd_handler)
+        try:
+            client = control.NTPdClient(port=server.port)
+            records = client.sources()
+            tracking = client.tracking()
+            client.close()
+        finally:
+            server.close()
+
+        self.assertEqual([r['address'] for r in records], ['10.0.0.1', '10.0.0.2', '10.0.0.3'])
+        self.assertEqual([r['tally'] for r in records], ['*', ' ', '+'])
+        self.assertEqual([r['refid'] for r in records], ['10.1.1.1', '.INIT.', '.GPS.'])
+        self.assertEqual(records[0]['when'], '-')
+        self.assertEqual(records[0]['poll'], 64)
+        self.assertEqual(records[0]['offset'], -0.000125)
+        self.assertEqual(records[0]['delay'], 0.00125)
+        self.assertEqual(records[2]['reach'], 50)
+
+        # the .INIT. peer is ignored, as it would be from ntpq output
+        metrics = NTPPeers(None, records=records).getmetrics()
+        self.assertEqual(metrics['all'], 2)
+        self.assertEqual(metrics['sync'], 1)
+        self.assertEqual(metrics['invalid'], 0)
+
+        self.assertEqual(tracking['stratum'], 2)
+        self.assertEqual(tracking['sysoffset'], -0.000125)
+        self.assertEqual(tracking['sysjitter'], 0.00025)
+        self.assertEqual(tracking['rootdelay'], 0.001234)
+        self.assertEqual(tracking['frequency'], -12.5)
+        self.assertNotIn('version', tracking)
+        self.assertNotIn('refid', tracking)
+
+    def test_query_unavailable(self):
+        with self.assertRaises(control.ControlError):
+            control.query('openntpd', 'peers')
+        with self.assertRaises(control.ControlError):
+            control.query('ntpd', 'trace')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import gzip
+import socket
+import unittest
+import urllib.error
+import urllib.request
+
+from exporter import PrometheusExporter, accepts_gzip, parse_listen, resolve_listen
+
+
+class TestPrometheusExporter(unittest.TestCase):
+
+    def setUp(self):
+        self.exporter = PrometheusExporter('127.0.0.1:0')
+        self.url = 'http://127.0.0.1:%d' % (self.exporter.server.server_address[1],)
+
+    def tearDown(self):
+        self.exporter.close()
+
+    def get(self, path='/metrics', headers={}):
+        request = urllib.request.Request(self.url + path, headers=headers)
+        try:
+            response = urllib.request.urlopen(request, timeout=5)
+            return (response.status, response.headers, response.read())
+        except urllib.error.HTTPError as e:
+            return (e.code, e.headers, e.read())
+
+    def test_metrics(self):
+        (status, headers, body) = self.get()
+        self.assertEqual((status, body), (200, b''))
+
+        print('ntpmon_offset 0.001', file=self.exporter)
+        # nothing is published until the end of the interval
+        self.assertEqual(self.get()[2], b'')
+        self.exporter.flush()
+
+        (status, headers, body) = self.get()
+        self.assertEqual(status, 200)
+        self.assertEqual(body, b'ntpmon_offset 0.001\n')
+        self.assertTrue(headers['Content-Type'].startswith('text/plain'))
+        etag = headers['ETag']
+
+        (status, headers, body) = self.get(headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.decompress(body), b'ntpmon_offset 0.001\n')
+        (status, headers, body) = self.get(headers={'Accept-Encoding': 'gzip;q=0'})
+        self.assertNotIn('Content-Encoding', headers)
+        self.assertEqual(body, b'ntpmon_offset 0.001\n')
+
+        self.assertEqual(self.get(headers={'If-None-Match': etag})[0], 304)
+
+        # an empty flush leaves the last interval's metrics in place
+        self.exporter.flush()
+        self.assertEqual(self.get()[1]['ETag'], etag)
+
+        print('ntpmon_offset 0.002', file=self.exporter)
+        self.exporter.flush()
+        (status, headers, body) = self.get(headers={'If-None-Match': etag})
+        self.assertEqual((status, body), (200, b'ntpmon_offset 0.002\n'))
+        self.assertNotEqual(headers['ETag'], etag)
+
+    def test_not_found(self):
+        self.assertEqual(self.get('/')[0], 404)
+
+    @unittest.skipUnless(socket.has_ipv6, 'IPv6 is not supported')
+    def test_ipv6(self):
+        try:
+            exporter = PrometheusExporter('[::1]:0')
+        except OSError as e:
+            self.skipTest('cannot listen on ::1: %s' % (e,))
+        try:
+            print('ntpmon_offset 0.001', file=exporter)
+            exporter.flush()
+            url = 'http://[::1]:%d/metrics' % (exporter.server.server_address[1],)
+            self.assertEqual(urllib.request.urlopen(url, timeout=5).read(), b'ntpmon_offset 0.001\n')
+        finally:
+            exporter.close()
+
+
+class TestExporterFunctions(unittest.TestCase):
+
+    def test_parse_listen(self):
+        self.assertEqual(parse_listen(':9650'), ('', 9650))
+        self.assertEqual(parse_listen('[::1]:9650'), ('::1', 9650))
+        self.assertEqual(resolve_listen('127.0.0.1:9650'), (socket.AF_INET, ('127.0.0.1', 9650)))
+        (family, address) = resolve_listen('[::1]:9650')
+        self.assertEqual((family, address[:2]), (socket.AF_INET6, ('::1', 9650)))
+
+    def test_accepts_gzip(self):
+        self.assertTrue(accepts_gzip('gzip'))
+        self.assertTrue(accepts_gzip('deflate, GZIP;q=0.5'))
+        self.assertTrue(accepts_gzip('*'))
+        self.assertTrue(accepts_gzip('identity, x-gzip'))
+        self.assertFalse(accepts_gzip(''))
+        self.assertFalse(accepts_gzip('gzip;q=0'))
+        self.assertFalse(accepts_gzip('gzip; q=0.000, *'))
+        self.assertFalse(accepts_gzip('*;q=0'))
+        self.assertFalse(accepts_gzip('identity'))
+        self.assertFalse(accepts_gzip('gzip;q=x'))
+
+
+if __name__ == '__main__':
+    unittest.main()
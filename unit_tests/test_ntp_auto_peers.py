@@ -0,0 +1,57 @@
+#!/usr/bin/env python3
+
+import sys
+import unittest
+
+sys.path.append('lib')
+import ntp_auto_peers  # NOQA: E402
+
+
+class TestNtpAutoPeers(unittest.TestCase):
+
+    scores = {
+        'ntp/0': ('10.0.0.10', 10.5),
+        'ntp/1': ('10.0.0.11', 2.0),
+        'ntp/2': ('10.0.0.12', None),
+        'ntp/3': ('10.0.0.13', 7.25),
+        'ntp/4': ('10.0.0.14', 7.25),
+        'ntp/5': ('10.0.0.15', 0.5),
+    }
+
+    def test_choose_upstream(self):
+        self.assertEqual(ntp_auto_peers.choose_upstream(self.scores, 3), {
+            'ntp/0': '10.0.0.10',
+            'ntp/3': '10.0.0.13',
+            'ntp/4': '10.0.0.14',
+        })
+        # ties are broken by unit name
+        self.assertEqual(ntp_auto_peers.choose_upstream(self.scores, 2), {
+            'ntp/0': '10.0.0.10',
+            'ntp/3': '10.0.0.13',
+        })
+        # all units with scores are upstream if there are not enough of them
+        self.assertEqual(sorted(ntp_auto_peers.choose_upstream(self.scores, 6)),
+                         ['ntp/0', 'ntp/1', 'ntp/3', 'ntp/4', 'ntp/5'])
+        self.assertEqual(ntp_auto_peers.choose_upstream({}, 6), {})
+
+    def test_encode(self):
+        upstream = ntp_auto_peers.choose_upstream(self.scores, 3)
+        setting = ntp_auto_peers.encode(upstream)
+        self.assertEqual(setting, '{"upstream":{"ntp/0":"10.0.0.10","ntp/3":"10.0.0.13","ntp/4":"10.0.0.14"}}')
+        self.assertEqual(ntp_auto_peers.decode(setting), upstream)
+        for invalid in [None, '', 'not json', '[]', '{}', '{"upstream":[]}']:
+            self.assertIsNone(ntp_auto_peers.decode(invalid), invalid)
+
+    def test_get_sources(self):
+        setting = ntp_auto_peers.encode(ntp_auto_peers.choose_upstream(self.scores, 3))
+        self.assertIsNone(ntp_auto_peers.get_sources(setting, 'ntp/3'))
+        self.assertEqual(ntp_auto_peers.get_sources(setting, 'ntp/1'), ['10.0.0.10', '10.0.0.13', '10.0.0.14'])
+        # units which joined after the topology was published are clients
+        self.assertEqual(ntp_auto_peers.get_sources(setting, 'ntp/9'), ['10.0.0.10', '10.0.0.13', '10.0.0.14'])
+        # without a topology, all units use their configured sources
+        self.assertIsNone(ntp_auto_peers.get_sources(None, 'ntp/1'))
+        self.assertIsNone(ntp_auto_peers.get_sources(ntp_auto_peers.encode({}), 'ntp/1'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,30 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import unittest
+
+import jinja2
+
+sys.path.append('lib')
+import ntp_check_server  # NOQA: E402
+
+CHARM_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+class TestNtpCheckServer(unittest.TestCase):
+
+    def test_render(self):
+        # as charmhelpers.contrib.templating.jinja.render(..., template_dir=hookenv.charm_dir()) does
+        options = {'install-dir': '/opt/ntpmon-ntp-charm', 'user': 'nobody', 'group': 'nogroup'}
+        env = jinja2.Environment(loader=jinja2.FileSystemLoader(CHARM_DIR))
+        unit = env.get_template(ntp_check_server.TEMPLATE).render(ntp_check_server.get_context(options))
+        lines = unit.split('\n')
+        self.assertIn('ExecStart=/opt/ntpmon-ntp-charm/check_ntpmon.py --serve --socket-group nagios', lines)
+        self.assertIn('User=nobody', lines)
+        self.assertIn('Group=nogroup', lines)
+        self.assertIn('SupplementaryGroups=nagios', lines)
+
+
+if __name__ == '__main__':
+    unittest.main()
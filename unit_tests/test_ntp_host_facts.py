@@ -0,0 +1,103 @@
+#!/usr/bin/env python3
+
+from unittest.mock import Mock, patch
+import sys
+import unittest
+
+sys.path.append('lib')
+import ntp_host_facts  # NOQA: E402
+
+
+class TestNtpHostFacts(unittest.TestCase):
+
+    def setUp(self):
+        self.store = {}
+        self.kv = Mock()
+        self.kv.get.side_effect = lambda key, default=None: self.store.get(key, default)
+        self.kv.set.side_effect = self.store.__setitem__
+        patcher = patch('ntp_status.get_boot_id')
+        self.get_boot_id = patcher.start()
+        self.get_boot_id.return_value = 'boot1'
+        self.addCleanup(patcher.stop)
+        self.virtual = Mock(return_value='lxc')
+        self.release = Mock(return_value={'DISTRIB_RELEASE': '18.04', 'DISTRIB_ID': 'Ubuntu'})
+        patcher = patch.dict('ntp_host_facts._facts', {
+            'lsb-release': self.release,
+            'virtual': self.virtual,
+        }, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.dict('ntp_host_facts._sources', {}, clear=True)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_get_fact(self):
+        self.assertEqual(ntp_host_facts.get_fact('virtual', self.kv), 'lxc')
+        self.assertEqual(ntp_host_facts.get_fact('virtual', self.kv), 'lxc')
+        self.assertEqual(self.virtual.call_count, 1)
+        # facts are gathered only when needed
+        self.release.assert_not_called()
+        self.assertEqual(ntp_host_facts.get_fact('lsb-release', self.kv)['DISTRIB_RELEASE'], '18.04')
+        self.assertEqual(sorted(self.store['host_facts']['facts']), ['lsb-release', 'virtual'])
+
+        # gathered again after a reboot
+        self.virtual.return_value = 'physical'
+        self.get_boot_id.return_value = 'boot2'
+        self.assertEqual(ntp_host_facts.get_fact('virtual', self.kv), 'physical')
+        self.assertEqual(self.virtual.call_count, 2)
+        self.assertEqual(self.store['host_facts']['boot-id'], 'boot2')
+        self.assertEqual(list(self.store['host_facts']['facts']), ['virtual'])
+
+    @patch('ntp_status.get_mtime')
+    def test_release_upgrade(self, get_mtime):
+        get_mtime.return_value = 1000
+        with patch.dict('ntp_host_facts._sources', {'lsb-release': '/etc/lsb-release'}, clear=True):
+            self.assertEqual(ntp_host_facts.get_fact('lsb-release', self.kv)['DISTRIB_RELEASE'], '18.04')
+            self.assertEqual(ntp_host_facts.get_fact('lsb-release', self.kv)['DISTRIB_RELEASE'], '18.04')
+            self.assertEqual(self.release.call_count, 1)
+            get_mtime.assert_called_with('/etc/lsb-release')
+
+            # upgraded, but not yet rebooted
+            self.release.return_value = {'DISTRIB_RELEASE': '20.04', 'DISTRIB_ID': 'Ubuntu'}
+            get_mtime.return_value = 2000
+            self.assertEqual(ntp_host_facts.get_fact('lsb-release', self.kv)['DISTRIB_RELEASE'], '20.04')
+            self.assertEqual(self.release.call_count, 2)
+            # other facts are kept
+            ntp_host_facts.get_fact('virtual', self.kv)
+            ntp_host_facts.get_fact('virtual', self.kv)
+            self.assertEqual(self.virtual.call_count, 1)
+
+    def test_unknown_boot_id(self):
+        self.get_boot_id.return_value = None
+        ntp_host_facts.get_fact('virtual', self.kv)
+        ntp_host_facts.get_fact('virtual', self.kv)
+        self.assertEqual(self.virtual.call_count, 2)
+        self.kv.set.assert_not_called()
+        # but all facts are still available
+        self.assertEqual(sorted(ntp_host_facts.get_facts(self.kv)), ['lsb-release', 'virtual'])
+
+    def test_old_facts(self):
+        self.store['host_facts'] = {'boot-id': 'boot1', 'facts': {
+            'clocksource-current': {'elapsed': 0, 'time': 0, 'value': 'tsc'},
+            'virtual': {'elapsed': 0, 'time': 0, 'value': 'kvm'},
+        }}
+        facts = ntp_host_facts.get_facts(self.kv)
+        self.assertEqual(sorted(facts), ['lsb-release', 'virtual'])
+        self.assertEqual(facts['virtual']['value'], 'kvm')
+        self.assertEqual(sorted(self.store['host_facts']['facts']), ['lsb-release', 'virtual'])
+        self.virtual.assert_not_called()
+
+    @patch('time.time')
+    def test_describe_facts(self, time):
+        time.return_value = 1000
+        ntp_host_facts.get_fact('virtual', self.kv)
+        self.assertEqual(ntp_host_facts.describe_facts(self.kv, now=1120), {
+            'lsb-release': 'DISTRIB_ID=Ubuntu DISTRIB_RELEASE=18.04 (120s old, collected in 0.000s)',
+            'virtual': 'lxc (120s old, collected in 0.000s)',
+        })
+        self.assertEqual(self.virtual.call_count, 1)
+        self.assertEqual(self.release.call_count, 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -2,7 +2,9 @@
 
 from random import shuffle
 from unittest.mock import Mock, patch
+import os
 import sys
+import tempfile
 import unittest
 
 sys.path.append('lib')
@@ -16,64 +18,44 @@ class TestNtpScoring(unittest.TestCase):
         patcher.start()
         self.addCleanup(patcher.stop)
         patcher = patch('charmhelpers.core.unitdata.kv')
-        patcher.start()
+        self.unitdata_kv = patcher.start()
         self.addCleanup(patcher.stop)
 
-    @patch('ntp_source_score.run_cmd')
-    def testGetVirtTypeValues(self, run_cmd):
+    @patch('ntp_virt.detect_virtual')
+    def testGetVirtTypeValues(self, detect_virtual):
         def virt_test(expected, return_value):
-            run_cmd.return_value = [return_value]
+            detect_virtual.return_value = return_value
             self.assertEqual(ntp_scoring.get_virt_type(), expected)
-            run_cmd.assert_called_once_with('facter virtual')
-            run_cmd.reset_mock()
+            detect_virtual.assert_called_once_with()
+            detect_virtual.reset_mock()
 
         virt_test('container', 'docker')
         virt_test('container', 'lxc')
         virt_test('container', 'openvz')
+        virt_test('container', 'systemd_nspawn')
         virt_test('physical', 'physical')
         virt_test('physical', 'xen0')
-        virt_test('vm', '')
-        virt_test('vm', [])
-        virt_test('vm', 1.23)
-        virt_test('vm', 'a')
+        virt_test('vm', 'hyperv')
         virt_test('vm', 'kvm')
-        virt_test('vm', None)
+        virt_test('vm', 'virtual')
+        virt_test('vm', 'xenu')
         virt_test('vm', 'something-else')
-        virt_test('vm', 'The quick brown fox jumps over the lazy dogs')
-
-    @patch('ntp_source_score.run_cmd')
-    def testGetVirtTypeEmptyList(self, run_cmd):
-        run_cmd.return_value = []
-        self.assertEqual(ntp_scoring.get_virt_type(), 'vm')
-        run_cmd.assert_called_once_with('facter virtual')
-
-    @patch('ntp_source_score.run_cmd')
-    def testGetVirtTypeWrongType(self, run_cmd):
-        run_cmd.return_value = {}
-        self.assertEqual(ntp_scoring.get_virt_type(), 'vm')
-        run_cmd.assert_called_once_with('facter virtual')
-
-    @patch('ntp_source_score.run_cmd')
-    def testGetVirtMultiplier(self, run_cmd):
+
+    @patch('ntp_virt.detect_virtual')
+    def testGetVirtMultiplier(self, detect_virtual):
         def multiplier_test(expected, return_value):
-            run_cmd.return_value = [return_value]
+            detect_virtual.return_value = return_value
             self.assertEqual(ntp_scoring.get_virt_multiplier(), expected)
-            run_cmd.assert_called_once_with('facter virtual')
-            run_cmd.reset_mock()
+            detect_virtual.assert_called_once_with()
+            detect_virtual.reset_mock()
 
         multiplier_test(-1, 'docker')
         multiplier_test(-1, 'lxc')
         multiplier_test(-1, 'openvz')
         multiplier_test(1.25, 'physical')
         multiplier_test(1.25, 'xen0')
-        multiplier_test(1, '')
-        multiplier_test(1, [])
-        multiplier_test(1, 1.23)
-        multiplier_test(1, 'a')
         multiplier_test(1, 'kvm')
-        multiplier_test(1, None)
         multiplier_test(1, 'something-else')
-        multiplier_test(1, 'The quick brown fox jumps over the lazy dogs')
 
     def testGetPackageDivisor(self):
 
@@ -106,3 +88,200 @@ class TestNtpScoring(unittest.TestCase):
         test_divisor(1.1 * 1.25 * 1.1, ['swift-1', 'nova-compute-2', 'ceph-3'])
         test_divisor(1.1 * 1.25 * 1.25, ['swift-1', 'nova-compute-2', 'ceph-osd-3'])
         test_divisor(1.1 * 1.25 * 1.1 * 1.25, ['swift-1', 'nova-compute-2', 'ceph-3', 'ceph-osd-4'])
+
+    def testGetFingerprint(self):
+        hosts = ['ntp1.example.com', 'ntp2.example.com']
+        fingerprint = ntp_scoring.get_fingerprint(hosts, 'vm', 1.25)
+        self.assertEqual(fingerprint, ntp_scoring.get_fingerprint(list(reversed(hosts)), 'vm', 1.25))
+        self.assertEqual(fingerprint, ntp_scoring.get_fingerprint(hosts + hosts, 'vm', 1.25))
+        self.assertNotEqual(fingerprint, ntp_scoring.get_fingerprint(hosts[:1], 'vm', 1.25))
+        self.assertNotEqual(fingerprint, ntp_scoring.get_fingerprint(hosts, 'physical', 1.25))
+        self.assertNotEqual(fingerprint, ntp_scoring.get_fingerprint(hosts, 'vm', 1.1))
+
+    @patch('ntp_scoring.check_score')
+    @patch('ntp_scoring.get_package_divisor')
+    @patch('ntp_scoring.get_virt_type')
+    @patch('ntp_scoring.get_kv')
+    @patch('charmhelpers.core.hookenv.config')
+    def testGetScoreCache(self, config, get_kv, get_virt_type, get_package_divisor, check_score):
+        store = {}
+        get_kv.return_value.get.side_effect = lambda key, default=None: store.get(key, default)
+        get_kv.return_value.set.side_effect = store.__setitem__
+        options = {
+            'auto_peers': True,
+            'peers': '',
+            'pools': 'ntp2.example.com',
+            'scoring_service': False,
+            'source': 'ntp1.example.com',
+        }
+        config.side_effect = lambda key: options[key]
+        get_virt_type.return_value = 'vm'
+        get_package_divisor.return_value = 1
+        check_score.side_effect = lambda now, history, virt_type, divisor: {'time': now, 'score': 1}
+
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 1)
+
+        # unchanged inputs use the saved score
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 1)
+
+        # changed hosts, virtualisation type, or divisor recalculate it
+        options['pools'] = 'ntp3.example.com'
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 2)
+        get_virt_type.return_value = 'physical'
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 3)
+        get_package_divisor.return_value = 1.25
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 4)
+        ntp_scoring.get_score()
+        self.assertEqual(check_score.call_count, 4)
+
+    @patch('ntp_scoring.log')
+    @patch('ntp_scoring.use_service')
+    @patch('ntp_scoring.check_score')
+    @patch('ntp_scoring.get_package_divisor')
+    @patch('ntp_scoring.get_virt_type')
+    @patch('ntp_scoring.get_kv')
+    @patch('charmhelpers.core.hookenv.config')
+    def testGetScoreService(self, config, get_kv, get_virt_type, get_package_divisor, check_score, use_service, log):
+        store = {}
+        get_kv.return_value.get.side_effect = lambda key, default=None: store.get(key, default)
+        get_kv.return_value.set.side_effect = store.__setitem__
+        options = {'auto_peers': True, 'peers': '', 'pools': '', 'source': 'ntp1.example.com'}
+        config.side_effect = lambda key: options[key]
+        get_virt_type.return_value = 'vm'
+        get_package_divisor.return_value = 1
+        use_service.return_value = True
+        published = {}
+        check_score.side_effect = lambda now, history, virt_type, divisor: dict(published, time=now)
+
+        def saves():
+            return len([c for c in get_kv.return_value.set.call_args_list if c[0][0] == 'ntp_score'])
+
+        # waiting for the service to publish a score
+        ntp_scoring.get_score()
+        ntp_scoring.get_score()
+        self.assertEqual(saves(), 1)
+
+        # the published score is checked every time, but only saved when it changes
+        published = {'raw': 10, 'score': 10}
+        check_score.side_effect = lambda now, history, virt_type, divisor: dict(published, time=1000)
+        self.assertEqual(ntp_scoring.get_score()['score'], 10)
+        self.assertEqual(ntp_scoring.get_score()['score'], 10)
+        self.assertEqual(check_score.call_count, 4)
+        self.assertEqual(saves(), 2)
+        published = {'raw': 20, 'score': 20}
+        check_score.side_effect = lambda now, history, virt_type, divisor: dict(published, time=2000)
+        self.assertEqual(ntp_scoring.get_score()['score'], 20)
+        self.assertEqual(saves(), 3)
+        self.assertEqual(len([c for c in log.call_args_list if 'saved' in c[0][0]]), 3)
+
+        # changed inputs are always saved
+        get_package_divisor.return_value = 1.25
+        ntp_scoring.get_score()
+        self.assertEqual(saves(), 4)
+
+    @patch('atexit.register')
+    @patch('charmhelpers.core.unitdata.Storage')
+    @patch('ntp_scoring._kv', None)
+    def testGetKv(self, storage, register):
+        kv = ntp_scoring.get_kv()
+        self.assertIs(ntp_scoring.get_kv(), kv)
+        self.assertEqual(storage.call_count, 1)
+        register.assert_called_once_with(kv.flush)
+
+    @patch('ntp_source_score.verify_sources')
+    @patch('ntp_scoring.use_service')
+    @patch('ntp_scoring.check_score')
+    @patch('ntp_scoring.get_package_divisor')
+    @patch('ntp_scoring.get_virt_type')
+    @patch('charmhelpers.core.hookenv.config')
+    @patch('atexit.register')
+    @patch('ntp_scoring._kv', None)
+    def testSharedStorage(self, register, config, get_virt_type, get_package_divisor, check_score,
+                          use_service, verify_sources):
+        # as on the leader: publish_auto_peers and assess_status both get the score during one hook
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        self.unitdata_kv.return_value.db_path = os.path.join(tmpdir.name, '.unit-state.db')
+        options = {'auto_peers': True, 'peers': '', 'pools': '', 'source': 'ntp1.example.com'}
+        config.side_effect = lambda key: options[key]
+        get_virt_type.return_value = 'vm'
+        get_package_divisor.return_value = 1
+        use_service.return_value = True
+        check_score.side_effect = [{'raw': 10, 'score': 10, 'time': 1000}, {'raw': 20, 'score': 20, 'time': 2000}]
+        verify_sources.return_value = (set(['ntp1.example.com']), [])
+
+        self.assertEqual(ntp_scoring.get_score()['score'], 10)
+        self.assertEqual(ntp_scoring.get_unverified_servers(['ntp1.example.com'], now=1000), [])
+        self.assertEqual(ntp_scoring.get_score()['score'], 20)
+        register.assert_called_once_with(ntp_scoring.get_kv().flush)
+        ntp_scoring.get_kv().flush()
+        ntp_scoring.get_kv().conn.close()
+
+    @patch('ntp_source_score.verify_sources')
+    @patch('ntp_scoring.get_kv')
+    def testGetUnverifiedServers(self, get_kv, verify_sources):
+        store = {}
+        get_kv.return_value.get.side_effect = lambda key, default=None: store.get(key, default)
+        get_kv.return_value.set.side_effect = store.__setitem__
+        verify_sources.return_value = (set(['ntp1.example.com']), ['ntp3.example.com'])
+        servers = ['ntp1.example.com', 'ntp2.example.com', 'ntp3.example.com', 'ntp1.example.com']
+
+        failed = ntp_scoring.get_unverified_servers(servers, now=1000)
+        self.assertEqual(failed, ['ntp2.example.com', 'ntp3.example.com'])
+        verify_sources.assert_called_once_with(
+            ['ntp1.example.com', 'ntp2.example.com', 'ntp3.example.com'], budget=ntp_scoring.VERIFY_BUDGET)
+
+        # only the server which was cut off is probed again
+        verify_sources.return_value = (set(['ntp3.example.com']), [])
+        failed = ntp_scoring.get_unverified_servers(servers, now=1300)
+        self.assertEqual(failed, ['ntp2.example.com'])
+        verify_sources.assert_called_with(['ntp3.example.com'], budget=ntp_scoring.VERIFY_BUDGET)
+
+        # failures expire before successes
+        verify_sources.return_value = (set(['ntp2.example.com']), [])
+        now = 1000 + ntp_scoring.VERIFY_FAILED_MAX_AGE + 1
+        self.assertEqual(ntp_scoring.get_unverified_servers(servers, now=now), [])
+        verify_sources.assert_called_with(['ntp2.example.com'], budget=ntp_scoring.VERIFY_BUDGET)
+        self.assertEqual(verify_sources.call_count, 3)
+        ntp_scoring.get_unverified_servers(servers, now=now + 1)
+        self.assertEqual(verify_sources.call_count, 3)
+
+        # servers which are no longer configured are forgotten
+        ntp_scoring.get_unverified_servers(['ntp2.example.com'], now=now + 1)
+        self.assertEqual(sorted(store['ntp_verified']), ['ntp2.example.com'])
+
+    @patch('ntp_scoring_service.read_score')
+    @patch('ntp_scoring.use_service')
+    @patch('ntp_source_score.get_source_delays')
+    @patch('charmhelpers.core.hookenv.relation_ids')
+    @patch('charmhelpers.core.hookenv.config')
+    def testCheckScoreService(self, config, relation_ids, get_source_delays, use_service, read_score):
+        options = {'auto_peers': True, 'source': 'ntp1.example.com ntp2.example.com', 'peers': '', 'pools': ''}
+        config.side_effect = lambda key: options[key]
+        relation_ids.return_value = []
+        use_service.return_value = True
+
+        # no score published yet
+        read_score.return_value = None
+        score = ntp_scoring.check_score(1000, virt_type='physical', divisor=1.25)
+        self.assertNotIn('raw', score)
+
+        # score published for other hosts
+        published = {'cutoff': [], 'host-list': ['ntp1.example.com'], 'probed': [], 'raw': 5, 'time': 900}
+        read_score.return_value = published
+        score = ntp_scoring.check_score(1000, virt_type='physical', divisor=1.25)
+        self.assertNotIn('raw', score)
+
+        published['host-list'] = ['ntp2.example.com', 'ntp1.example.com']
+        score = ntp_scoring.check_score(1000, virt_type='physical', divisor=1.25)
+        self.assertEqual(score['raw'], 5)
+        self.assertEqual(score['score'], 5)
+        self.assertEqual(score['time'], 900)
+
+        # hooks never probe sources themselves
+        get_source_delays.assert_not_called()
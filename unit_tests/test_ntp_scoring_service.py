@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+from unittest.mock import patch
+import json
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('lib')
+import ntp_scoring_service  # NOQA: E402
+
+
+class TestNtpScoringService(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.dir.cleanup)
+        self.config_file = os.path.join(self.dir.name, 'config.json')
+        self.history_file = os.path.join(self.dir.name, 'history.json')
+        self.score_file = os.path.join(self.dir.name, 'score.json')
+        patcher = patch('ntp_scoring_service.log')
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def test_read_write_json(self):
+        self.assertIsNone(ntp_scoring_service.read_json(self.score_file))
+        ntp_scoring_service.write_json(self.score_file, {'raw': 1.5})
+        self.assertEqual(ntp_scoring_service.read_json(self.score_file), {'raw': 1.5})
+        ntp_scoring_service.write_json(self.score_file, {'raw': 2.5})
+        self.assertEqual(ntp_scoring_service.read_score(self.score_file), {'raw': 2.5})
+        # no temporary files are left behind
+        self.assertEqual(os.listdir(self.dir.name), ['score.json'])
+
+        with open(self.score_file, 'w') as f:
+            f.write('{"raw": ')
+        self.assertIsNone(ntp_scoring_service.read_json(self.score_file))
+
+    @patch('ntp_source_score.get_source_delays')
+    def test_run(self, get_source_delays):
+        get_source_delays.return_value = ([('192.0.2.1', ['ntp1.example.com'], [0.1])], [])
+        ntp_scoring_service.write_json(self.config_file, {'hosts': ['ntp1.example.com'], 'interval': 3600})
+
+        ntp_scoring_service.run(self.config_file, self.history_file, self.score_file, once=True)
+        get_source_delays.assert_called_once_with(
+            ['ntp1.example.com'],
+            budget=ntp_scoring_service.SCORE_BUDGET,
+            good_enough=ntp_scoring_service.SCORE_GOOD_ENOUGH)
+        score = ntp_scoring_service.read_score(self.score_file)
+        self.assertEqual(score['host-list'], ['ntp1.example.com'])
+        self.assertEqual(score['probed'], ['ntp1.example.com'])
+        self.assertAlmostEqual(score['raw'], 2.302585, places=6)
+
+        # sources probed within the interval are not probed again
+        get_source_delays.reset_mock()
+        get_source_delays.return_value = ([], [])
+        ntp_scoring_service.run(self.config_file, self.history_file, self.score_file, once=True)
+        get_source_delays.assert_called_once_with(
+            [],
+            budget=ntp_scoring_service.SCORE_BUDGET,
+            good_enough=ntp_scoring_service.SCORE_GOOD_ENOUGH)
+        with open(self.score_file) as f:
+            self.assertAlmostEqual(json.load(f)['raw'], 2.302585, places=6)
+
+    @patch('ntp_source_score.get_source_delays')
+    def test_run_unconfigured(self, get_source_delays):
+        ntp_scoring_service.run(self.config_file, self.history_file, self.score_file, once=True)
+        get_source_delays.assert_not_called()
+        self.assertIsNone(ntp_scoring_service.read_score(self.score_file))
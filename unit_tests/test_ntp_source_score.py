@@ -1,82 +1,88 @@
 #!/usr/bin/env python3
 
 from unittest.mock import patch
+import asyncio
 import math
+import socket
+import struct
 import sys
+import time
 import unittest
 
 sys.path.append('lib')
 from ntp_source_score import (
+    HISTORY_MAX_AGE,
+    HISTORY_SAMPLES,
+    NTP_PACKET,
+    Resolver,
+    calculate_results,
+    ewrms,
+    from_ntp_time,
     get_delay_score,
-    get_source_delays,
+    get_running_loop,
+    history_score,
+    make_request,
+    new_history,
+    parse_response,
+    probe_address,
+    probe_sources,
     rms,
     run_cmd,
+    run_loop,
+    stale_sources,
+    to_ntp_time,
+    update_history,
+    verify_sources,
 )  # NOQA: E402
 
-ntpdate_output = """
-...
-reference time:    dda179ee.3ec34fdd  Mon, Oct 30 2017 20:14:06.245
-originate timestamp: dda17a5b.af7c528b  Mon, Oct 30 2017 20:15:55.685
-transmit timestamp:  dda17a5b.80b4dc04  Mon, Oct 30 2017 20:15:55.502
-filter delay:  0.54126  0.36757  0.36655  0.36743
-         0.00000  0.00000  0.00000  0.00000
-filter offset: 0.099523 0.012978 0.011831 0.011770
-         0.000000 0.000000 0.000000 0.000000
-delay 0.36655, dispersion 0.01126
-offset 0.011831
-...
-reference time:    dda17695.69e65b2f  Mon, Oct 30 2017 19:59:49.413
-originate timestamp: dda17a5b.afcec2dd  Mon, Oct 30 2017 20:15:55.686
-transmit timestamp:  dda17a5b.80bb2488  Mon, Oct 30 2017 20:15:55.502
-filter delay:  0.36520  0.36487  0.36647  0.36604
-         0.00000  0.00000  0.00000  0.00000
-filter offset: 0.012833 0.013758 0.013731 0.013629
-         0.000000 0.000000 0.000000 0.000000
-delay 0.36487, dispersion 0.00049
-offset 0.013758
-...
-reference time:    dda1782c.6aec9646  Mon, Oct 30 2017 20:06:36.417
-originate timestamp: dda17a5b.d2d04ef4  Mon, Oct 30 2017 20:15:55.823
-transmit timestamp:  dda17a5b.b37c4098  Mon, Oct 30 2017 20:15:55.701
-filter delay:  0.28581  0.28406  0.28551  0.28596
-         0.00000  0.00000  0.00000  0.00000
-filter offset: -0.00802 -0.00854 -0.00791 -0.00787
-         0.000000 0.000000 0.000000 0.000000
-delay 0.28406, dispersion 0.00050
-offset -0.008544
-...
-reference time:    dda17735.4a03e3ca  Mon, Oct 30 2017 20:02:29.289
-originate timestamp: dda17a5c.1634d231  Mon, Oct 30 2017 20:15:56.086
-transmit timestamp:  dda17a5b.e6934fad  Mon, Oct 30 2017 20:15:55.900
-filter delay:  0.37044  0.37077  0.37050  0.37086
-         0.00000  0.00000  0.00000  0.00000
-filter offset: 0.013993 0.013624 0.013425 0.013362
-         0.000000 0.000000 0.000000 0.000000
-delay 0.37044, dispersion 0.00046
-offset 0.013993
-...
-reference time:    dda17695.69e65b2f  Mon, Oct 30 2017 19:59:49.413
-originate timestamp: dda17a5c.4944bb52  Mon, Oct 30 2017 20:15:56.286
-transmit timestamp:  dda17a5c.19cf5199  Mon, Oct 30 2017 20:15:56.100
-filter delay:  0.36873  0.36823  0.36911  0.36781
-         0.00000  0.00000  0.00000  0.00000
-filter offset: 0.014635 0.014599 0.014166 0.014239
-         0.000000 0.000000 0.000000 0.000000
-delay 0.36781, dispersion 0.00026
-offset 0.014239
-...
-reference time:    dda179ee.3ec34fdd  Mon, Oct 30 2017 20:14:06.245
-originate timestamp: dda17a5c.7bbd3828  Mon, Oct 30 2017 20:15:56.483
-transmit timestamp:  dda17a5c.4cf92e99  Mon, Oct 30 2017 20:15:56.300
-filter delay:  0.36554  0.36617  0.36673  0.36618
-         0.00000  0.00000  0.00000  0.00000
-filter offset: 0.012466 0.012691 0.012863 0.012346
-         0.000000 0.000000 0.000000 0.000000
-delay 0.36554, dispersion 0.00018
-offset 0.012466
-...
-"""
-ntpdate_delays = [0.36655, 0.36487, 0.28406, 0.37044, 0.36781, 0.36554]
+
+class FakeNTPServer(asyncio.DatagramProtocol):
+    """Reply to every request as a synchronised stratum 2 server which is offset seconds ahead"""
+
+    def __init__(self, offset=0.0, mode=4, stratum=2, silent=False):
+        self.offset = offset
+        self.mode = mode
+        self.stratum = stratum
+        self.silent = silent
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.silent:
+            return
+        origin = struct.unpack('!Q', data[40:48])[0]
+        now = to_ntp_time(time.time() + self.offset)
+        reply = NTP_PACKET.pack(0x20 | self.mode, self.stratum, 6, -20, 0, 0, b'GPS\0', now, origin, now, now)
+        self.transport.sendto(reply, addr)
+
+
+def with_fake_servers(servers, probe):
+    """Start the fake servers on loopback ports and run the probe coroutine function against their addresses"""
+    async def run():
+        loop = get_running_loop()
+        transports = []
+        try:
+            for server in servers:
+                (transport, protocol) = await loop.create_datagram_endpoint(
+                    lambda: server, local_addr=('127.0.0.1', 0))
+                transports.append(transport)
+            return await probe(*[t.get_extra_info('sockname') for t in transports])
+        finally:
+            for t in transports:
+                t.close()
+
+    return run_loop(run())
+
+
+def with_fake_server(server, probe):
+    """Start the fake server on a loopback port and run the probe coroutine function against its address"""
+    return with_fake_servers([server], probe)
+
+
+def probe_fake_server(server, samples=2):
+    """Probe the fake server at a single address"""
+    return with_fake_server(server, lambda sockaddr: probe_address(socket.AF_INET, sockaddr, samples=samples))
 
 
 class TestNtpSourceScore(unittest.TestCase):
@@ -97,6 +103,14 @@ class TestNtpSourceScore(unittest.TestCase):
         with self.assertRaises(TypeError):
             rms(['a', 'b', 'c'])
 
+    def test_ewrms(self):
+        self.assertEqual(ewrms([1, 1, 1, 1]), 1)
+        self.assertAlmostEqual(ewrms([0.5, 0.2], alpha=0), rms([0.5, 0.2]))
+        self.assertAlmostEqual(ewrms([3, 4], alpha=0.5), math.sqrt((0.5 * 9 + 16) / 1.5))
+        # newer values carry more weight
+        self.assertLess(ewrms([0.3, 0.1]), ewrms([0.1, 0.3]))
+        self.assertTrue(math.isnan(ewrms([])))
+
     @patch('subprocess.check_output')
     def test_run_cmd(self, patched):
         patched.return_value = b'a\nb\nc\n'
@@ -107,31 +121,184 @@ class TestNtpSourceScore(unittest.TestCase):
 
         self.assertEqual(patched.call_count, 2)
 
-    def test_get_source_delays(self):
-
-        @patch('ntp_source_score.run_cmd')
-        def test_source_delay(data, expect, patched):
-            patched.return_value = data
-            self.assertEqual(get_source_delays('ntp.example.com'), expect)
-            patched.assert_called_once_with('ntpdate -d -t 0.2 ntp.example.com')
-
-        @patch('ntp_source_score.run_cmd')
-        def test_source_delay_error(data, e, patched):
-            patched.return_value = data
-            with self.assertRaises(e):
-                get_source_delays('ntp.example.com')
-            patched.assert_called_once_with('ntpdate -d -t 0.2 ntp.example.com')
-
-        test_source_delay([], [])
-        test_source_delay('', [])
-        test_source_delay('123', [])
-        test_source_delay(['123 678', '234 asdf', 'yaled 345 901'], [])
-        test_source_delay(['123 678', 'delay 345 901', '234 asdf'], [345])
-        test_source_delay(['delay 123 678', 'delay 234 asdf', 'delay 345 901'], [123, 234, 345])
-        test_source_delay(ntpdate_output.split('\n'), ntpdate_delays)
-
-        test_source_delay_error(None, TypeError)
-        test_source_delay_error(123, TypeError)
+    def test_ntp_time(self):
+        self.assertEqual(to_ntp_time(0), 2208988800 << 32)
+        self.assertEqual(to_ntp_time(0.5), (2208988800 << 32) + (1 << 31))
+        self.assertEqual(from_ntp_time(to_ntp_time(1509394555.25)), 1509394555.25)
+
+    def test_make_request(self):
+        request = make_request(0x0123456789abcdef)
+        self.assertEqual(len(request), 48)
+        # LI = 0, VN = 4, Mode = 3
+        self.assertEqual(request[0], 0x23)
+        self.assertEqual(request[40:48], bytes.fromhex('0123456789abcdef'))
+        self.assertEqual(request[1:40], b'\0' * 39)
+
+    def test_parse_response(self):
+        t1 = 1509394555.0
+        transmit = to_ntp_time(t1)
+
+        def response(flags=0x24, stratum=2, origin=transmit, receive=t1 + 0.1, server_transmit=t1 + 0.15):
+            return NTP_PACKET.pack(flags, stratum, 6, -20, 0, 0, b'GPS\0', 0, origin,
+                                   to_ntp_time(receive), to_ntp_time(server_transmit))
+
+        # 0.25s round trip, of which the server held the request for 0.05s
+        (delay, offset) = parse_response(response(), transmit, t1, 0.25)
+        self.assertAlmostEqual(delay, 0.2, places=6)
+        self.assertAlmostEqual(offset, 0.0, places=6)
+        (delay, offset) = parse_response(response(receive=t1 + 0.2, server_transmit=t1 + 0.2), transmit, t1, 0.1)
+        self.assertAlmostEqual(delay, 0.1, places=6)
+        self.assertAlmostEqual(offset, 0.15, places=6)
+
+        # truncated
+        self.assertIsNone(parse_response(response()[:47], transmit, t1, 0.25))
+        # not a server response
+        self.assertIsNone(parse_response(response(flags=0x23), transmit, t1, 0.25))
+        # response to a different request
+        self.assertIsNone(parse_response(response(origin=transmit + 1), transmit, t1, 0.25))
+        # unsynchronised server
+        self.assertIsNone(parse_response(response(flags=0xe4), transmit, t1, 0.25))
+        # kiss-o'-death
+        self.assertIsNone(parse_response(response(stratum=0), transmit, t1, 0.25))
+        self.assertIsNone(parse_response(response(stratum=16), transmit, t1, 0.25))
+
+    def test_probe_address(self):
+        results = probe_fake_server(FakeNTPServer(offset=1.5))
+        self.assertEqual(len(results), 2)
+        for (delay, offset) in results:
+            self.assertGreaterEqual(delay, 0)
+            self.assertLess(delay, 0.2)
+            self.assertAlmostEqual(offset, 1.5, places=1)
+
+    def test_probe_address_invalid(self):
+        self.assertEqual(probe_fake_server(FakeNTPServer(mode=3)), [])
+        self.assertEqual(probe_fake_server(FakeNTPServer(stratum=0)), [])
+
+    @patch('ntp_source_score.resolve')
+    def test_resolver_cache(self, resolve):
+        async def fake_resolve(source, port):
+            return [(socket.AF_INET, ('192.0.2.1', port))]
+
+        resolve.side_effect = fake_resolve
+        resolver = Resolver(port=1123)
+
+        async def lookups():
+            return await asyncio.gather(*[resolver.resolve(s) for s in ['a', 'b', 'a', 'a', 'b']])
+
+        results = run_loop(lookups())
+        self.assertEqual(results, [[(socket.AF_INET, ('192.0.2.1', 1123))]] * 5)
+        self.assertEqual(resolve.call_count, 2)
+
+    @patch('ntp_source_score.resolve')
+    def test_probe_sources(self, resolve):
+        async def fake_resolve(source, port):
+            # don't depend on the local resolver to fail to resolve ntp1.invalid
+            return [(socket.AF_INET, (source, port))] if source == '127.0.0.1' else []
+
+        resolve.side_effect = fake_resolve
+        hosts = ['127.0.0.1', 'ntp1.invalid', '127.0.0.1']
+        (probes, cutoff) = with_fake_server(
+            FakeNTPServer(),
+            lambda sockaddr: probe_sources(hosts, concurrency=4, port=sockaddr[1]))
+        # overlapping names are only probed once; unresolvable names are skipped
+        self.assertEqual(sorted(c[0][0] for c in resolve.call_args_list), ['127.0.0.1', 'ntp1.invalid'])
+        self.assertEqual(len(probes), 1)
+        (address, names, delays) = probes[0]
+        self.assertEqual(address, '127.0.0.1')
+        self.assertEqual(names, ['127.0.0.1'])
+        self.assertEqual(len(delays), 4)
+        self.assertEqual(cutoff, [])
+
+    def test_probe_sources_budget(self):
+        start = time.time()
+        (probes, cutoff) = with_fake_server(
+            FakeNTPServer(silent=True),
+            lambda sockaddr: probe_sources(['127.0.0.1'], concurrency=4, port=sockaddr[1], budget=0.1))
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual(probes, [])
+        self.assertEqual(cutoff, ['127.0.0.1'])
+
+    @patch('ntp_source_score.resolve')
+    def test_probe_sources_good_enough(self, resolve):
+        async def probe(good, slow):
+            async def fake_resolve(source, port):
+                # pretend each fake server is a separate address
+                sockaddr = good if source == 'good.example.com' else slow
+                return [(socket.AF_INET, (source, sockaddr[1]))]
+
+            resolve.side_effect = fake_resolve
+            # ...which are really both on the loopback address
+            with patch('ntp_source_score.probe_address',
+                       new=lambda f, s: probe_address(f, ('127.0.0.1', s[1]))):
+                return await probe_sources(['good.example.com', 'slow.example.com'], concurrency=4, good_enough=1)
+
+        start = time.time()
+        (probes, cutoff) = with_fake_servers([FakeNTPServer(), FakeNTPServer(silent=True)], probe)
+        self.assertLess(time.time() - start, 0.5)
+        self.assertEqual([p[0] for p in probes], ['good.example.com'])
+        self.assertEqual(cutoff, ['slow.example.com'])
+
+    @patch('ntp_source_score.get_source_delays')
+    def test_verify_sources(self, get_source_delays):
+        hosts = ['ntp1.example.com', 'ntp2.example.com', 'ntp3.example.com', 'ntp4.example.com']
+        get_source_delays.return_value = ([
+            ('192.0.2.1', ['ntp1.example.com'], []),
+            ('192.0.2.2', ['ntp1.example.com', 'ntp2.example.com'], [0.1]),
+            ('192.0.2.3', ['ntp3.example.com'], []),
+        ], ['ntp4.example.com', '192.0.2.4'])
+        (verified, cutoff) = verify_sources(hosts, budget=5)
+        get_source_delays.assert_called_once_with(hosts, budget=5)
+        self.assertEqual(verified, set(['ntp1.example.com', 'ntp2.example.com']))
+        self.assertEqual(cutoff, ['ntp4.example.com'])
+
+    def test_calculate_results(self):
+        results = calculate_results([
+            ('192.0.2.1', ['ntp1.example.com'], [0.1, 0.1]),
+            ('192.0.2.2', ['ntp1.example.com', 'ntp2.example.com'], []),
+            ('2001:db8::1', ['ntp2.example.com'], [0.01]),
+        ])
+        self.assertEqual(sorted(results.keys()), ['192.0.2.1', '2001:db8::1'])
+        self.assertAlmostEqual(results['192.0.2.1'], get_delay_score(0.1))
+        self.assertAlmostEqual(results['2001:db8::1'], get_delay_score(0.01))
+
+    def test_history(self):
+        history = new_history()
+        hosts = ['ntp1.example.com', 'ntp2.example.com']
+        now = 1000000
+        max_age = 86400
+        self.assertEqual(stale_sources(history, hosts, now, max_age), hosts)
+
+        probes = [
+            ('192.0.2.1', ['ntp1.example.com'], [0.1, 0.1]),
+            ('192.0.2.2', ['ntp1.example.com', 'ntp2.example.com'], [0.01]),
+            ('192.0.2.3', ['ntp2.example.com'], []),
+        ]
+        update_history(history, hosts, probes, [], now)
+        self.assertEqual(history['sources']['ntp1.example.com']['addresses'], ['192.0.2.1', '192.0.2.2'])
+        self.assertEqual(history['sources']['ntp2.example.com']['addresses'], ['192.0.2.2', '192.0.2.3'])
+        self.assertEqual(stale_sources(history, hosts + ['ntp3.example.com'], now + 1, max_age),
+                         ['ntp3.example.com'])
+        self.assertEqual(stale_sources(history, hosts, now + max_age + 1, max_age), hosts)
+
+        # addresses shared by several hosts are only scored once; unreachable addresses don't score
+        self.assertAlmostEqual(history_score(history, hosts), -math.log(0.1) - math.log(0.01))
+        self.assertAlmostEqual(history_score(history, ['ntp2.example.com']), -math.log(0.01))
+
+        # new samples are merged with the old, and the ring buffer is bounded
+        later = now + max_age + 1
+        probes = [('192.0.2.1', ['ntp1.example.com'], [0.2] * HISTORY_SAMPLES)]
+        update_history(history, ['ntp1.example.com'], probes, ['192.0.2.2'], later)
+        self.assertEqual(history['addresses']['192.0.2.1']['delays'], [0.2] * HISTORY_SAMPLES)
+        # cut-off addresses keep their history
+        self.assertEqual(history['sources']['ntp1.example.com']['addresses'], ['192.0.2.2', '192.0.2.1'])
+
+        # cut-off hosts remain stale
+        update_history(history, ['ntp2.example.com'], [], ['ntp2.example.com'], later)
+        self.assertEqual(history['sources']['ntp2.example.com']['time'], now)
+
+        # old addresses are forgotten
+        update_history(history, [], [], [], now + HISTORY_MAX_AGE + 1)
+        self.assertEqual(sorted(history['addresses'].keys()), ['192.0.2.1'])
 
     def test_get_delay_score_error(self):
         # You can't have a negative or zero response time
@@ -0,0 +1,82 @@
+#!/usr/bin/env python3
+
+from unittest.mock import Mock, patch
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('lib')
+import ntp_status  # NOQA: E402
+
+
+class FakeKV(dict):
+
+    def set(self, key, value):
+        self[key] = value
+
+
+class TestNtpStatus(unittest.TestCase):
+
+    def setUp(self):
+        patcher = patch('ntp_status.log')
+        self.log = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def testStatusCache(self):
+        kv = FakeKV()
+        func = Mock(return_value='4.2.8')
+        cache = ntp_status.StatusCache(kv, now=1000)
+        self.assertEqual(cache.get('version', ('ntp', 1.5), func), '4.2.8')
+        self.assertEqual(cache.get('virt', None, lambda: 'vm'), 'vm')
+        cache.save()
+        self.assertEqual(func.call_count, 1)
+        self.assertEqual([(name, cached) for (name, elapsed, cached) in cache.timings],
+                         [('version', False), ('virt', False)])
+        self.assertIn('version ', self.log.call_args[0][0])
+
+        # the same key is reused (including after conversion of tuples to lists); unknown keys are not
+        cache = ntp_status.StatusCache(kv, now=2000)
+        self.assertEqual(cache.get('version', ('ntp', 1.5), func), '4.2.8')
+        self.assertEqual(cache.get('virt', None, lambda: 'container'), 'container')
+        self.assertEqual(func.call_count, 1)
+        self.assertIn('version 0.000s (cached)', cache.timing_string())
+
+        # a changed key or expired value is recalculated
+        self.assertEqual(cache.get('version', ('ntp', 2.5), func), '4.2.8')
+        self.assertEqual(func.call_count, 2)
+        self.assertEqual(cache.get('version', ('ntp', 2.5), func, max_age=999), '4.2.8')
+        self.assertEqual(func.call_count, 2)
+        cache = ntp_status.StatusCache(kv, now=3000)
+        self.assertEqual(cache.get('version', ('ntp', 2.5), func, max_age=999), '4.2.8')
+        self.assertEqual(func.call_count, 3)
+
+    def testFileKeys(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'boot_id')
+            with patch('ntp_status.BOOT_ID', new=path):
+                self.assertIsNone(ntp_status.get_boot_id())
+                self.assertIsNone(ntp_status.get_mtime(path))
+                with open(path, 'w') as f:
+                    f.write('7d7b8b1c-4b4f-4a3a-9d3e-0b8f6b0a1c2d\n')
+                self.assertEqual(ntp_status.get_boot_id(), '7d7b8b1c-4b4f-4a3a-9d3e-0b8f6b0a1c2d')
+                self.assertEqual(ntp_status.get_mtime(path), os.stat(path).st_mtime)
+
+    def testNtpmonSample(self):
+        with tempfile.TemporaryDirectory() as d:
+            path = os.path.join(d, 'state.json')
+            self.assertIsNone(ntp_status.get_ntpmon_sample(1000, path))
+            with open(path, 'w') as f:
+                f.write('{"time": 1000, "interval": 60}')
+            self.assertEqual(ntp_status.get_ntpmon_sample(1000, path), (1000, 60))
+            self.assertEqual(ntp_status.get_ntpmon_sample(1120, path), (1000, 60))
+            # stale samples, and those from the future, are ignored
+            self.assertIsNone(ntp_status.get_ntpmon_sample(1121, path))
+            self.assertIsNone(ntp_status.get_ntpmon_sample(999, path))
+            with open(path, 'w') as f:
+                f.write('{"time": 1000')
+            self.assertIsNone(ntp_status.get_ntpmon_sample(1000, path))
+
+
+if __name__ == '__main__':
+    unittest.main()
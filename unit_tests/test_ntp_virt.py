@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+
+import os
+import sys
+import tempfile
+import unittest
+
+sys.path.append('lib')
+import ntp_virt  # NOQA: E402
+
+
+def detect(files):
+    """Create the files (a hash of paths and their contents) under a new root directory;
+    return the virtualisation type detected there."""
+    with tempfile.TemporaryDirectory() as root:
+        for (name, contents) in files.items():
+            path = os.path.join(root, name.lstrip('/'))
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(path, 'w') as f:
+                f.write(contents)
+        return ntp_virt.detect_virtual(root)
+
+
+class TestNtpVirt(unittest.TestCase):
+
+    def testPhysical(self):
+        self.assertEqual(detect({}), 'physical')
+        self.assertEqual(detect({
+            '/proc/1/environ': 'HOME=/\0TERM=linux\0',
+            '/proc/1/cgroup': '0::/init.scope\n',
+            '/proc/cpuinfo': 'processor\t: 0\nflags\t\t: fpu vme de pse msr\n',
+            '/sys/class/dmi/id/sys_vendor': 'Dell Inc.\n',
+            '/sys/class/dmi/id/product_name': 'PowerEdge R640\n',
+            '/proc/vz/version': '',
+            '/proc/bc/0': '',
+        }), 'physical')
+        self.assertEqual(detect({'/proc/xen/capabilities': 'control_d\n'}), 'xen0')
+
+    def testContainers(self):
+        self.assertEqual(detect({'/proc/1/environ': 'container=lxc\0'}), 'lxc')
+        self.assertEqual(detect({'/proc/1/environ': 'container=podman\0'}), 'docker')
+        self.assertEqual(detect({'/proc/1/environ': 'container=systemd-nspawn\0'}), 'systemd_nspawn')
+        self.assertEqual(detect({'/.dockerenv': ''}), 'docker')
+        self.assertEqual(detect({'/dev/lxd/sock': ''}), 'lxc')
+        self.assertEqual(detect({'/proc/1/cgroup': '12:pids:/docker/0123456789abcdef\n'}), 'docker')
+        self.assertEqual(detect({'/proc/vz/version': ''}), 'openvz')
+        # containers see the host's hardware
+        self.assertEqual(detect({
+            '/proc/1/environ': 'container=lxc\0',
+            '/sys/class/dmi/id/product_name': 'KVM\n',
+            '/proc/cpuinfo': 'flags\t\t: fpu hypervisor\n',
+        }), 'lxc')
+
+    def testVirtualMachines(self):
+        self.assertEqual(detect({'/proc/xen/capabilities': ''}), 'xenu')
+        self.assertEqual(detect({
+            '/sys/class/dmi/id/sys_vendor': 'Microsoft Corporation\n',
+            '/sys/class/dmi/id/product_name': 'Virtual Machine\n',
+        }), 'hyperv')
+        self.assertEqual(detect({'/sys/class/dmi/id/sys_vendor': 'QEMU\n'}), 'kvm')
+        self.assertEqual(detect({'/sys/class/dmi/id/product_name': 'VMware Virtual Platform\n'}), 'vmware')
+        self.assertEqual(detect({'/sys/class/dmi/id/bios_vendor': 'innotek GmbH\n'}), 'virtualbox')
+        self.assertEqual(detect({'/proc/cpuinfo': 'processor\t: 0\nflags\t\t: fpu hypervisor lahf_lm\n'}),
+                         'virtual')
+
+
+if __name__ == '__main__':
+    unittest.main()
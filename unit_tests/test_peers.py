@@ -18,9 +18,10 @@
 #
 
 import math
+import statistics
 import unittest
 
-from peers import NTPPeers
+from peers import NTPPeers, RunningStats, summarise
 
 testdata = {
     # 'ntpq -np' output
@@ -334,17 +335,48 @@ class TestNTPPeers(unittest.TestCase):
         for s in peerlines.split('\n'):
             self.assertIsNotNone(NTPPeers.peerline(s))
 
+    def test_chronypeerline(self):
+        """Ensure chronyc peer lines are converted, and invalid ones rejected."""
+        self.assertEqual(NTPPeers.peerline('^,*,10.0.0.1,2,6,377,12,0.000125,0.000126,0.0025'), {
+            'mode': '^',
+            'tally': 'sync',
+            'address': '10.0.0.1',
+            'stratum': 2,
+            'poll_pow2': '6',
+            'poll': 64,
+            'reach': 100,
+            'when': 12,
+            'moffset': 0.000125,
+            'offset': 0.000126,
+            'error': 0.0025,
+        })
+        self.assertIsNone(NTPPeers.peerline('^,!,10.0.0.1,2,6,377,12,0.000125,0.000126,0.0025'))
+        self.assertIsNone(NTPPeers.peerline('^,*,10.0.0.1,16,6,377,12,0.000125,0.000126,0.0025'))
+        self.assertIsNone(NTPPeers.peerline('^,*,10.0.0.1,2,6,9,12,0.000125,0.000126,0.0025'))
+
+    def assertNoPeers(self, parsed):
+        self.assertEqual(sorted(parsed), sorted(NTPPeers.peertypes))
+        for t in parsed:
+            self.assertEqual(parsed[t], dict((f, []) for f in NTPPeers.peerfields))
+
     def test_noparsepeer(self):
         """Ensure the result of parsed noise lines is empty."""
-        parsed = NTPPeers.parse(noiselines)
-        empty = NTPPeers.newpeerdict()
-        self.assertEqual(parsed, empty)
+        self.assertNoPeers(NTPPeers.parse(noiselines))
 
     def test_noparsestratum99(self):
         """Ensure the result of parsed incorrect peer line is empty."""
-        empty = NTPPeers.newpeerdict()
-        parsed = NTPPeers.parse(' 1234 5678 99 u 8 128 377 31.430  -16.143  74.185')
-        self.assertEqual(parsed, empty)
+        self.assertNoPeers(NTPPeers.parse(' 1234 5678 99 u 8 128 377 31.430  -16.143  74.185'))
+
+    def test_recordpeer(self):
+        """Ensure peer records have their tally codes and strata converted, and invalid ones are rejected."""
+        record = {'address': '10.0.0.1', 'refid': '10.0.0.2', 'tally': '*', 'stratum': '2', 'offset': 0.5}
+        self.assertEqual(NTPPeers.recordpeer(record), dict(record, tally='sync', stratum=2))
+        self.assertEqual(record['tally'], '*')
+        self.assertIsNone(NTPPeers.recordpeer(dict(record, tally='!')))
+        self.assertIsNone(NTPPeers.recordpeer(dict(record, stratum='16')))
+        self.assertIsNone(NTPPeers.recordpeer(dict(record, stratum='x')))
+        self.assertIsNone(NTPPeers.recordpeer(dict(record, refid='.INIT.')))
+        self.assertNoPeers(NTPPeers.parserecords([dict(record, stratum='-1')]))
 
     def test_parsepeer(self):
         """Ensure the parsed peer lines matches the expected values."""
@@ -357,6 +389,53 @@ class TestNTPPeers(unittest.TestCase):
         metrics = p.getmetrics()
         self.assertEqual(metrics['sync'], 1)
 
+    def test_typemask(self):
+        """Ensure pps & sync peers are also counted as sync & survivor peers, and all peers in all."""
+        bits = NTPPeers.typebits
+        self.assertEqual(NTPPeers.typemask('pps'), bits['pps'] | bits['sync'] | bits['survivor'] | bits['all'])
+        self.assertEqual(NTPPeers.typemask('sync'), bits['sync'] | bits['survivor'] | bits['all'])
+        self.assertEqual(NTPPeers.typemask('outlier'), bits['outlier'] | bits['all'])
+
+    def assertSummaryEqual(self, a, b):
+        for (x, y) in zip(a, b):
+            if math.isnan(x):
+                self.assertTrue(math.isnan(y))
+            else:
+                self.assertAlmostEqual(x, y)
+
+    def test_tablemetrics(self):
+        """Ensure metrics from the running statistics match those from the dict of peers."""
+        for t in list(testdata) + [alllines]:
+            p = NTPPeers(t)
+            fromtable = p.getmetrics()
+            fromdict = p.getmetrics(p.peers)
+            self.assertEqual(sorted(fromtable), sorted(fromdict))
+            self.assertSummaryEqual([fromtable[m] for m in sorted(fromtable)], [fromdict[m] for m in sorted(fromdict)])
+            for bit in NTPPeers.typebits.values():
+                self.assertSummaryEqual(summarise(p.table.column('offset', bit)), p.table.typesummary('offset', bit))
+
+    def test_runningstats(self):
+        """Ensure running statistics match the statistics module, including when merged."""
+        values = [3.735, -16.143, 11.235, -2.926, 7.865, -1.715, -2.489]
+        whole = RunningStats()
+        parts = [RunningStats(), RunningStats()]
+        for (i, x) in enumerate(values):
+            whole.add(x)
+            parts[i % 2].add(x)
+        parts[0].merge(parts[1])
+        parts[0].merge(RunningStats())
+        mean = statistics.mean(values)
+        expected = (mean, statistics.pstdev(values, mean), math.sqrt(statistics.mean([x * x for x in values])))
+        for stats in whole, parts[0]:
+            self.assertEqual(stats.count, len(values))
+            self.assertSummaryEqual(stats.summary(), expected)
+            self.assertSummaryEqual(summarise(values), expected)
+        self.assertTrue(all(math.isnan(x) for x in RunningStats().summary()))
+
+    def test_syncpeer(self):
+        self.assertEqual(NTPPeers(alllines).syncpeer(), '54.252.129.186')
+        self.assertIsNone(NTPPeers(inactivepeerlines).syncpeer())
+
     def test_parsetestdata(self):
         """Ensure the test data matches the expected number of valid peers."""
         for t in testdata:
@@ -364,26 +443,20 @@ class TestNTPPeers(unittest.TestCase):
             self.assertEqual(len(parsed['all']['address']), testdata[t])
 
     def test_rootmeansquare(self):
-        """Test root mean square function."""
-        self.assertTrue(math.isnan(NTPPeers.rms([])))
-        self.assertEqual(NTPPeers.rms([3]), 3)
-        self.assertEqual(NTPPeers.rms([3, 4]), math.sqrt((9 + 16) / 2))
-        self.assertEqual(NTPPeers.rms([3, 4, 5]), math.sqrt((9 + 16 + 25) / 3))
-        self.assertEqual(NTPPeers.rms([3, 4, 5, 6]), math.sqrt((9 + 16 + 25 + 36) / 4))
+        """Test root mean square calculation."""
+        def rms(values):
+            return summarise(values)[2]
+        self.assertTrue(math.isnan(rms([])))
+        self.assertEqual(rms([3]), 3)
+        self.assertEqual(rms([3, 4]), math.sqrt((9 + 16) / 2))
+        self.assertEqual(rms([3, 4, 5]), math.sqrt((9 + 16 + 25) / 3))
+        self.assertEqual(rms([3, 4, 5, 6]), math.sqrt((9 + 16 + 25 + 36) / 4))
 
     """
     FIXME: Need individual test coverage:
     def time2seconds(t):
-    def validate_tally(cls, fields):
-    def validate_stratum(cls, fields):
-    def validate_when(cls, fields):
-    def validate_poll(cls, fields):
-    def validate_reach(cls, fields):
-    def validate_floats(cls, fields, convert_to_seconds):
-    def validate_peerfields(cls, fields, convert_to_seconds):
-    def appendpeer(cls, peers, peer):
-    def newpeerdict(cls):
-    def syncpeer(self):
+    def reachpercent(reach):
+    def peerdict(cls, table):
     """
 
 
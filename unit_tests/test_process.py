@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import time
+import unittest
+import unittest.mock as mock
+
+import process
+
+
+def fake_runcheck(delays):
+    """Return a runcheck replacement which takes the given time for each check, and records its timeout."""
+    def runcheck(check, debug, implementation, timeout):
+        time.sleep(delays.get(check, 0))
+        return mock.Mock(check=check, timeout=timeout)
+    return runcheck
+
+
+class TestNTPChecks(unittest.TestCase):
+
+    def test_concurrent(self):
+        delays = {'peers': 0.2, 'trace': 0.2, 'vars': 0.2}
+        with mock.patch('process.runcheck', new=fake_runcheck(delays)):
+            start = time.time()
+            objs = process.ntpchecks(['offset', 'proc', 'trace', 'vars'], debug=False, implementation='ntpd')
+            elapsed = time.time() - start
+        self.assertEqual(sorted(objs), ['peers', 'proc', 'trace', 'vars'])
+        self.assertLess(elapsed, 0.5)
+        self.assertEqual(objs['peers'].timeout, process.TIMEOUT)
+
+    def test_deadline(self):
+        delays = {'peers': 0, 'trace': 2, 'vars': 0}
+        with mock.patch('process.runcheck', new=fake_runcheck(delays)):
+            start = time.time()
+            objs = process.ntpchecks(['offset', 'trace', 'vars'], debug=False, implementation='ntpd',
+                                     deadline=start + 0.3)
+            elapsed = time.time() - start
+        self.assertLess(elapsed, 1)
+        self.assertEqual(sorted(objs), ['missed', 'peers', 'vars'])
+        self.assertLessEqual(objs['peers'].timeout, 0.3)
+        self.assertEqual(objs['missed'].getmetrics(), {
+            'missed': 1,
+            'missed-peers': 0,
+            'missed-trace': 1,
+            'missed-vars': 0,
+        })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import unittest
+import unittest.mock as mock
+
+import psutil
+
+from procindex import ProcessIndex, starttime
+
+
+class TestProcessIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.name = psutil.Process(os.getpid()).name()
+        self.matchers = {
+            'self': lambda name: name == self.name,
+            'missing': lambda name: name == 'no-such-process-name',
+        }
+
+    def test_starttime(self):
+        self.assertIsInstance(starttime(os.getpid()), int)
+        self.assertEqual(starttime(os.getpid()), starttime(os.getpid()))
+        self.assertIsNone(starttime(2 ** 30))
+        self.assertIsNone(starttime(None))
+
+    def test_cached(self):
+        index = ProcessIndex(self.matchers)
+        pids = index.getpids()
+        self.assertIn(pids.get('self'), [p.pid for p in psutil.process_iter() if p.name() == self.name])
+        self.assertNotIn('missing', pids)
+
+        # while the cached process is running, the process table is not scanned
+        with mock.patch('psutil.process_iter') as process_iter:
+            self.assertEqual(index.getpids(), pids)
+            process_iter.assert_not_called()
+
+        # once it is gone (or its PID is reused), the process table is scanned again
+        with mock.patch('procindex.starttime', return_value=-1):
+            with mock.patch('psutil.process_iter', return_value=[]) as process_iter:
+                self.assertEqual(index.getpids(), {})
+                process_iter.assert_called_once_with()
+
+    def test_max_age(self):
+        state = {}
+        index = ProcessIndex({'missing': self.matchers['missing']}, max_age=3600, state=state)
+        self.assertEqual(index.getpids(), {})
+        self.assertGreater(state['time'], 0)
+
+        # nothing was found, but the scan is recent enough
+        with mock.patch('psutil.process_iter') as process_iter:
+            self.assertEqual(ProcessIndex(self.matchers, max_age=3600, state=state).getpids(), {})
+            process_iter.assert_not_called()
+
+        # without a maximum age, a scan which found nothing is always repeated
+        with mock.patch('psutil.process_iter', return_value=[]) as process_iter:
+            self.assertEqual(ProcessIndex(self.matchers, state=state).getpids(), {})
+            process_iter.assert_called_once_with()
+
+        state['time'] -= 3601
+        pids = ProcessIndex(self.matchers, max_age=3600, state=state).getpids()
+        self.assertIn('self', pids)
+        self.assertEqual(state['pids']['self'], [pids['self'], starttime(pids['self'])])
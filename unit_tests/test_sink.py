@@ -0,0 +1,199 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os
+import socket
+import tempfile
+import unittest
+import unittest.mock as mock
+
+import sink
+
+
+def listen(port=0):
+    server = socket.socket()
+    server.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    server.bind(('127.0.0.1', port))
+    server.listen(1)
+    server.settimeout(2)
+    return server
+
+
+def receive(server, conn=None):
+    """Accept a connection if none is given, and return it and the data available on it."""
+    if conn is None:
+        (conn, addr) = server.accept()
+        conn.settimeout(0.5)
+    data = b''
+    try:
+        while True:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+    except socket.timeout:
+        pass
+    return (conn, data.decode())
+
+
+class TestTCPSink(unittest.TestCase):
+
+    def test_reconnect(self):
+        server = listen()
+        port = server.getsockname()[1]
+        output = sink.TCPSink('127.0.0.1', port)
+        with mock.patch('sink.log'):
+            print('ntpmon a=1', file=output)
+            print('ntpmon b=2', file=output)
+            output.flush()
+            (conn, data) = receive(server)
+            self.assertEqual(data, 'ntpmon a=1\nntpmon b=2\n')
+
+            # telegraf restarts: output is queued while it is down, and sent when it returns
+            conn.close()
+            server.close()
+            print('ntpmon c=3', file=output)
+            output.flush()
+            self.assertEqual(len(output.queue), 1)
+            self.assertGreater(output.retry_at, 0)
+
+            server = listen(port)
+            print('ntpmon d=4', file=output)
+            output.retry_at = 0
+            output.flush()
+            (conn, data) = receive(server)
+            self.assertEqual(data, 'ntpmon c=3\nntpmon d=4\n')
+            self.assertEqual(len(output.queue), 0)
+            self.assertEqual(output.backoff, sink.BACKOFF_MIN)
+        conn.close()
+        server.close()
+        output.close()
+
+    def test_backoff_and_queue_limit(self):
+        output = sink.TCPSink('127.0.0.1', 1, max_queue=3)
+        with mock.patch('sink.log'), mock.patch.object(output, 'connect', side_effect=ConnectionRefusedError):
+            for i in range(5):
+                print('ntpmon i=%d' % (i,), file=output)
+                output.retry_at = 0
+                output.flush()
+            self.assertEqual(output.connect.call_count, 5)
+            self.assertEqual(list(output.queue), ['ntpmon i=2\n', 'ntpmon i=3\n', 'ntpmon i=4\n'])
+            self.assertEqual(output.backoff, 32)
+
+            # no connection attempt until the backoff has expired
+            output.flush()
+            self.assertEqual(output.connect.call_count, 5)
+
+    def test_partial_send(self):
+        output = sink.TCPSink('127.0.0.1', 1)
+        sock = mock.Mock()
+        sock.recv.side_effect = BlockingIOError
+        with mock.patch('sink.log'), mock.patch.object(output, 'connect', return_value=sock):
+            # the first line and part of the second are sent before the connection fails
+            sock.send.side_effect = [8, 7, ConnectionResetError]
+            print('ntpmon a=1', file=output)
+            print('ntpmon b=2', file=output)
+            print('ntpmon c=3', file=output)
+            output.flush()
+            self.assertIsNone(output.sock)
+            self.assertEqual(list(output.queue), ['ntpmon b=2\nntpmon c=3\n'])
+
+            # only the unsent lines are sent after reconnecting
+            sock.send.side_effect = lambda data: len(data)
+            output.retry_at = 0
+            output.flush()
+            self.assertEqual(len(output.queue), 0)
+            self.assertEqual(bytes(sock.send.call_args[0][0]), b'ntpmon b=2\nntpmon c=3\n')
+
+
+class TestDatagramSink(unittest.TestCase):
+
+    def test_pack(self):
+        lines = [b'a' * 10 + b'\n', b'b' * 5 + b'\n', b'c' * 30 + b'\n', b'd\n']
+        self.assertEqual(sink.pack(lines, 20), [lines[0] + lines[1], lines[2], lines[3]])
+        self.assertEqual(sink.pack(lines, 100), [b''.join(lines)])
+        self.assertEqual(sink.pack([], 100), [])
+
+    def test_udp(self):
+        server = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        server.bind(('127.0.0.1', 0))
+        server.settimeout(2)
+        output = sink.open_sink('udp://127.0.0.1:%d' % (server.getsockname()[1],), mtu=120)
+        self.assertIsInstance(output, sink.DatagramSink)
+        self.assertEqual(output.size, 92)
+        for i in range(10):
+            print('ntpmon_peer,address=10.0.0.%d offset=0.001' % (i,), file=output)
+        output.flush()
+        datagrams = []
+        while sum(d.count(b'\n') for d in datagrams) < 10:
+            datagrams.append(server.recv(65536))
+        self.assertEqual(len(datagrams), 5)
+        self.assertTrue(all(len(d) <= 92 for d in datagrams))
+        self.assertEqual(b''.join(datagrams).decode().split('\n')[9], 'ntpmon_peer,address=10.0.0.9 offset=0.001')
+        output.close()
+        server.close()
+
+    def test_unix(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'dgram.sock')
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_DGRAM)
+            server.bind(path)
+            server.settimeout(2)
+            output = sink.open_sink('unixgram://' + path)
+            print('ntpmon a=1', file=output)
+            output.flush()
+            self.assertEqual(server.recv(65536), b'ntpmon a=1\n')
+            server.close()
+
+            # the collector has gone away: output is discarded
+            with mock.patch('sink.log') as log:
+                print('ntpmon b=2', file=output)
+                output.flush()
+                output.flush()
+                print('ntpmon c=3', file=output)
+                output.flush()
+                self.assertEqual(log.call_count, 1)
+            output.close()
+
+            path = os.path.join(tmpdir, 'stream.sock')
+            server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            server.bind(path)
+            server.listen(1)
+            server.settimeout(2)
+            output = sink.open_sink('unix://' + path)
+            self.assertIsInstance(output, sink.UnixSink)
+            print('ntpmon a=1', file=output)
+            output.flush()
+            (conn, data) = receive(server)
+            self.assertEqual(data, 'ntpmon a=1\n')
+            conn.close()
+            server.close()
+            output.close()
+
+    def test_open_sink(self):
+        self.assertEqual(sink.open_sink('127.0.0.1:8094').address, ('127.0.0.1', 8094))
+        self.assertEqual(sink.open_sink('tcp://[::1]:8094').address, ('::1', 8094))
+        with self.assertRaises(ValueError):
+            sink.open_sink('http://localhost:8094')
+        with self.assertRaises(ValueError):
+            sink.open_sink('udp://localhost')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+#
+# Copyright:    (c) 2016 Paul D. Gear
+# License:      GPLv3 <http://www.gnu.org/licenses/gpl.html>
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import contextlib
+import io
+import os
+import stat
+import tempfile
+import unittest
+
+from alert import NTPAlerter
+from peers import NTPPeers
+from state import StateFile
+
+peerlines = """-10.0.0.4        10.1.1.1      2 u   17   64  377    0.500   -1.000   0.100
++10.0.0.3        10.1.1.1      2 u   17   64  377    0.500    2.000   0.100
+*10.0.0.1        10.1.1.1      2 u   17   64  376    0.500    4.000   0.100"""
+
+
+class FakeProcess(object):
+
+    name = 'ntpd'
+
+    def getruntime(self):
+        return 1000
+
+    def getmetrics(self):
+        return {'runtime': self.getruntime()}
+
+
+def nagios(checks, checkobjs):
+    output = io.StringIO()
+    alerter = NTPAlerter(list(checks))
+    with contextlib.redirect_stdout(output):
+        alerter.alert_nagios(checkobjs=checkobjs, debug=False)
+    return (output.getvalue(), alerter.return_code())
+
+
+class TestStateFile(unittest.TestCase):
+
+    checks = ['proc', 'offset', 'peers', 'reach', 'sync']
+
+    def setUp(self):
+        self.dir = tempfile.TemporaryDirectory()
+        self.statefile = StateFile(os.path.join(self.dir.name, 'state.json'))
+
+    def tearDown(self):
+        self.dir.cleanup()
+
+    def publish(self, now=1000):
+        alerter = NTPAlerter(list(self.checks))
+        with contextlib.redirect_stdout(io.StringIO()):
+            alerter.alert({'peers': NTPPeers(peerlines), 'proc': FakeProcess()},
+                          hostname='h', interval=60, format='telegraf')
+        self.statefile.publish(alerter, 60, now=now)
+
+    def test_same_result(self):
+        self.publish()
+        self.assertEqual(stat.S_IMODE(os.stat(self.statefile.path).st_mode), 0o644)
+        self.assertEqual(os.listdir(self.dir.name), ['state.json'])
+        live = nagios(self.checks, {'peers': NTPPeers(peerlines), 'proc': FakeProcess()})
+        stored = nagios(self.checks, self.statefile.load(self.checks, now=1000))
+        self.assertEqual(stored, live)
+        self.assertTrue(stored[0].startswith('WARNING: Number of peers is too low (3)'))
+        stored = nagios(['sync'], self.statefile.load(['sync'], now=1000))
+        self.assertTrue(stored[0].startswith('OK: Time is in sync with 10.0.0.1 |'))
+
+    def test_runtime(self):
+        self.publish()
+        checkobjs = self.statefile.load(['proc'], now=1030)
+        self.assertEqual(sorted(checkobjs), ['proc'])
+        self.assertEqual(checkobjs['proc'].getruntime(), 1030)
+        self.assertEqual(checkobjs['proc'].name, 'ntpd')
+
+    def test_stale(self):
+        self.publish()
+        self.assertIsNotNone(self.statefile.load(self.checks, now=1120))
+        self.assertIsNone(self.statefile.load(self.checks, now=1121))
+        self.assertIsNone(self.statefile.load(self.checks, max_age=10, now=1011))
+        # the clock has gone backwards
+        self.assertIsNone(self.statefile.load(self.checks, now=999))
+
+    def test_missing_checks(self):
+        self.publish()
+        self.assertIsNone(self.statefile.load(['vars'], now=1000))
+        self.assertIsNone(self.statefile.load(['offset', 'trace'], now=1000))
+
+    def test_unavailable(self):
+        self.assertIsNone(self.statefile.load(self.checks))
+        with open(self.statefile.path, 'w') as f:
+            f.write('{"time": ')
+        self.assertIsNone(self.statefile.load(self.checks))
+
+    def test_publish_error(self):
+        self.statefile.path = os.path.join(self.dir.name, 'missing', 'state.json')
+        with contextlib.redirect_stderr(io.StringIO()) as err:
+            self.publish()
+            self.publish()
+        self.assertEqual(err.getvalue().count('Cannot publish state'), 1)
+
+
+if __name__ == '__main__':
+    unittest.main()